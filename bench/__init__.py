@@ -0,0 +1 @@
+'''Headless benchmarks of mdnoteman hot paths on a generated notebook, run with python -m bench.run'''
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+import sys
+if sys.hexversion < 0x03070000:
+    print("!!! This component requires Python version 3.7 at least !!!")
+    sys.exit(1)
+
+import os
+import random
+from dataclasses import dataclass, asdict
+from PIL import Image, ImageDraw
+
+from mdnoteman_core import format_note, NOTE_ENCODING
+from mdnoteman_save import note_file_name
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'ta', 'shi', 'po', 'den', 'var', 'ix', 'ol', 'um', 'be', 'sa', 'tor']
+COLORS    = ['#FFFFFF'] * 6 + ['#FFF2AB', '#CBF1C4', '#FFCCE5', '#CDE9FF']
+
+@dataclass
+class CorpusSpec:
+    '''Shape of a synthetic notebook, (lo, hi) pairs are inclusive ranges drawn per day or per note'''
+    days            : int   = 365
+    notes_per_day   : tuple = (1, 4)
+    tags            : int   = 40   # tag vocabulary
+    labels          : int   = 12   # top level labels, each with a few sub-labels
+    label_depth     : int   = 2
+    tags_per_note   : tuple = (0, 3)
+    labels_per_note : tuple = (0, 2)
+    words           : tuple = (8, 160) # content words per note
+    image_ratio     : float = 0.05 # notes with an image
+    remote_images   : float = 0.0  # share of those images that are http links
+    images          : int   = 8    # distinct local images
+    start           : int   = 1600000000 # timestamp of first day
+    seed            : int   = 1
+
+    @property
+    def dict (self):
+        return asdict (self)
+
+def make_words (rnd, count):
+    words = set ()
+    while len (words) < count:
+        words.add (''.join (rnd.choice (SYLLABLES) for k in range (rnd.randint (1, 3))))
+    return sorted (words)
+
+def make_labels (rnd, spec):
+    tops   = make_words (rnd, spec.labels)
+    labels = list (tops)
+    for top in tops:
+        prefix = top
+        for depth in range (1, spec.label_depth):
+            prefix += '/' + rnd.choice (SYLLABLES) + str (depth)
+            labels.append (prefix)
+    return labels
+
+def make_content (rnd, spec, vocab, image):
+    n_words = rnd.randint (*spec.words)
+    lines   = ['# ' + ' '.join (rnd.choice (vocab) for k in range (rnd.randint (1, 4))).capitalize (), '']
+    while n_words > 0:
+        kind = rnd.random ()
+        n    = min (n_words, rnd.randint (4, 24))
+        text = ' '.join (rnd.choice (vocab) for k in range (n))
+        n_words -= n
+        if kind < 0.55:
+            lines += [text + '.', '']
+        elif kind < 0.75:
+            lines += ['- ' + word for word in text.split ()[:6]] + ['']
+        elif kind < 0.85:
+            words = text.split ()
+            words [0] = f"**{words[0]}**"
+            words [-1] = f"`{words[-1]}`"
+            lines += [' '.join (words), '']
+        elif kind < 0.95:
+            lines += ['> ' + text, '']
+        else:
+            lines += ['```', text, '```', '']
+    if image:
+        lines += [f"![image]({image})", '']
+    return '\n'.join (lines).strip ()
+
+def make_images (path, spec, rnd):
+    folder = os.path.join (path, 'images')
+    os.makedirs (folder, exist_ok = True)
+    names = []
+    for i in range (spec.images):
+        w, h = rnd.choice ([(320, 200), (640, 480), (1280, 720), (200, 200)])
+        img  = Image.new ('RGB', (w, h), tuple (rnd.randrange (256) for k in range (3)))
+        draw = ImageDraw.Draw (img)
+        for k in range (12):
+            x, y = rnd.randrange (w), rnd.randrange (h)
+            draw.ellipse ((x, y, x + w // 8, y + h // 8), fill = tuple (rnd.randrange (256) for k in range (3)))
+        name = f"images/img_{i}." + ('png' if i % 2 else 'jpg')
+        img.save (os.path.join (path, name))
+        names.append (name)
+    return names
+
+def generate (path, spec = None):
+    '''Write a deterministic notebook for spec into path (daily YYYY_MM_DD.md files, images/)
+    Return counts of what was written'''
+    spec   = spec or CorpusSpec ()
+    rnd    = random.Random (spec.seed)
+    vocab  = make_words (rnd, 600)
+    tags   = make_words (rnd, spec.tags)
+    labels = make_labels (rnd, spec)
+    os.makedirs (path, exist_ok = True)
+    images = make_images (path, spec, rnd) if spec.image_ratio > 0 and spec.images > 0 else []
+
+    files = {} # name -> formatted notes, a day of notes may span two local dates
+    idx   = 1
+    for day in range (spec.days):
+        day_ts = spec.start + day * 86400
+        count  = rnd.randint (*spec.notes_per_day)
+        stamps = sorted (rnd.sample (range (86400), count))
+        for offset in stamps:
+            image = None
+            if images and rnd.random () < spec.image_ratio:
+                if rnd.random () < spec.remote_images:
+                    image = f"https://example.com/bench/{rnd.randrange (1000)}.png"
+                else:
+                    image = rnd.choice (images)
+            files.setdefault (note_file_name (day_ts + offset), []).append (
+                format_note (day_ts + offset, rnd.choice (COLORS), idx,
+                             rnd.sample (tags, rnd.randint (*spec.tags_per_note)),
+                             rnd.sample (labels, rnd.randint (*spec.labels_per_note)),
+                             make_content (rnd, spec, vocab, image)))
+            idx += 1
+
+    size = 0
+    for name, parts in files.items ():
+        data = ''.join (parts).encode (NOTE_ENCODING)
+        with open (os.path.join (path, name), 'wb') as f:
+            f.write (data)
+        size += len (data)
+    return {'files': len (files), 'notes': idx - 1, 'bytes': size, 'tags': tags, 'labels': labels}
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser (description = 'Write a synthetic notebook')
+    parser.add_argument ('path')
+    parser.add_argument ('--days', type = int, default = CorpusSpec.days)
+    parser.add_argument ('--seed', type = int, default = CorpusSpec.seed)
+    args = parser.parse_args ()
+    info = generate (args.path, CorpusSpec (days = args.days, seed = args.seed))
+    print (f"{info['notes']} notes in {info['files']} files, {info['bytes']} bytes")
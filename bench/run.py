@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+import sys
+if sys.hexversion < 0x03070000:
+    print("!!! This component requires Python version 3.7 at least !!!")
+    sys.exit(1)
+
+import os
+import io
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import statistics
+import configparser
+import contextlib
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import List, Dict
+
+import mdnoteman_dsl as dsl
+from mdnoteman_core import Notebook, parse_note_file, markdown_config, note_file_re
+from mdnoteman_pkm import NoteCard
+from mdnoteman_render import ThumbnailCache, CardLayout, estimate_height
+from mdnoteman_fetch import ImageStore
+from bench.corpus import CorpusSpec, generate
+
+RESULTS_VERSION = 1
+SAMPLE_NOTES    = 50  # notes rendered by render benchmarks
+REGRESSION      = 1.10 # median slower than baseline by this factor is reported
+REPO_PATH       = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+
+BENCHMARKS = {} # name -> function (ctx) returning (setup or None, run), run returns items processed
+
+def benchmark (name):
+    def register (fn):
+        BENCHMARKS [name] = fn
+        return fn
+    return register
+
+@dataclass
+class Context:
+    path       : str  = None # corpus
+    cache_path : str  = None
+    info       : Dict = None # returned by generate
+    md         : object = None # Markdown_Ext, None when fonts are not available
+    image_store : object = None # ImageStore of md
+    queries    : List = field (default_factory = lambda: [])
+    _notebook  : Notebook = None
+
+    @property
+    def files (self):
+        return sorted (os.path.join (self.path, fn) for fn in os.listdir (self.path) if note_file_re.fullmatch (fn))
+
+    @property
+    def notebook (self):
+        '''Notebook pulled once, shared by benchmarks that only read it'''
+        if self._notebook is None:
+            self._notebook = Notebook (path = self.path)
+            quiet (self._notebook.Refresh)
+        return self._notebook
+
+    def sample (self, count = SAMPLE_NOTES):
+        notes = self.notebook.notes
+        step  = max (1, len (notes) // count)
+        return notes [::step][:count]
+
+def quiet (fn, *args, **kwargs):
+    with contextlib.redirect_stdout (io.StringIO ()):
+        return fn (*args, **kwargs)
+
+def make_queries (info):
+    tags, labels = info ['tags'], info ['labels']
+    return [f"tags {tags[0]}",
+            f"tags {tags[1]}, {tags[2]}",
+            f"tags {tags[3]} & labels {labels[0]}",
+            f"labels {labels[1].split ('/')[0]}",
+            f"not tags {tags[4]}",
+            f"(tags {tags[5]} | tags {tags[6]}) & not labels {labels[2]}",
+            '"ka"',
+            f"tags {tags[7]} & \"lo\""]
+
+def make_markdown (cfg_file, ctx):
+    '''Markdown_Ext as configured for cards, None if fonts of config can not be loaded'''
+    from md2img import Markdown_Ext
+
+    cfg = configparser.ConfigParser ()
+    cfg.read (cfg_file)
+    if 'Fonts' not in cfg:
+        return None
+    try:
+        md = Markdown_Ext ([(0, 0, 240)], markdown_config (cfg))
+    except (OSError, KeyError, ValueError) as err:
+        print (f"Render benchmarks skipped - {err}")
+        return None
+    ctx.image_store = ImageStore (path = os.path.join (ctx.cache_path, 'images'), base_path = ctx.path)
+    md.image_loader = ctx.image_store.load
+    return md
+
+@benchmark ('parse_note_file')
+def bench_parse (ctx):
+    files = ctx.files
+    return None, lambda: sum (len (parse_note_file (fn)) for fn in files)
+
+@benchmark ('refresh_cold')
+def bench_refresh_cold (ctx):
+    nb = {}
+    def setup ():
+        shutil.rmtree (ctx.cache_path + '/notebooks', ignore_errors = True)
+        nb ['nb'] = Notebook (path = ctx.path, cache_path = ctx.cache_path)
+    def run ():
+        quiet (nb ['nb'].Refresh)
+        return len (nb ['nb'].notes)
+    return setup, run
+
+@benchmark ('refresh_snapshot')
+def bench_refresh_snapshot (ctx):
+    '''First Refresh of a new Notebook once the cache holds a snapshot'''
+    quiet (Notebook (path = ctx.path, cache_path = ctx.cache_path).Refresh)
+    nb = {}
+    def setup ():
+        nb ['nb'] = Notebook (path = ctx.path, cache_path = ctx.cache_path)
+    def run ():
+        quiet (nb ['nb'].Refresh)
+        return len (nb ['nb'].notes)
+    return setup, run
+
+@benchmark ('refresh_unchanged')
+def bench_refresh_unchanged (ctx):
+    nb = Notebook (path = ctx.path, cache_path = ctx.cache_path)
+    quiet (nb.Refresh)
+    def run ():
+        quiet (nb.Refresh)
+        return len (nb.notes)
+    return None, run
+
+@benchmark ('dsl_parse')
+def bench_dsl_parse (ctx):
+    def run ():
+        dsl._compile_query.cache_clear ()
+        for query in ctx.queries:
+            dsl.compile_query (query)
+        return len (ctx.queries)
+    return None, run
+
+@benchmark ('query_index')
+def bench_query_index (ctx):
+    nb = ctx.notebook
+    def setup ():
+        nb._query_idx_ready = False
+    def run ():
+        nb.build_query_index (full_text = True)
+        return len (nb.notes)
+    return setup, run
+
+@benchmark ('filter')
+def bench_filter (ctx):
+    nb = ctx.notebook
+    nb.build_query_index (full_text = True)
+    def run ():
+        dsl._compile_query.cache_clear ()
+        return sum (len (dsl.compile_query (query).select (nb)) for query in ctx.queries)
+    return None, run
+
+@benchmark ('cli_query')
+def bench_cli_query (ctx):
+    '''Cold start of a headless query process over a warm notebook'''
+    quiet (Notebook (path = ctx.path, cache_path = ctx.cache_path).Refresh)
+    cli = os.path.join (REPO_PATH, 'mdnoteman_cli.py')
+    cmd = [sys.executable, cli, 'query', ctx.queries [-1], '--format', 'ids',
+           '--notebook', ctx.path, '--cache', ctx.cache_path, '--config', os.devnull]
+    def run ():
+        # Exit status 1 only tells that nothing matched, which happens on small notebooks
+        proc = subprocess.run (cmd, stdout = subprocess.DEVNULL)
+        if proc.returncode not in (0, 1):
+            raise subprocess.CalledProcessError (proc.returncode, cmd)
+        return 1
+    return None, run
+
+@benchmark ('startup_import')
+def bench_startup_import (ctx):
+    '''Fresh interpreter importing the GUI modules, as on app launch before the first window'''
+    cmd = [sys.executable, '-c', 'import mdnoteman_gui']
+    def run ():
+        subprocess.run (cmd, check = True, cwd = REPO_PATH, stdout = subprocess.DEVNULL)
+        return 1
+    return None, run
+
+@benchmark ('startup_icons')
+def bench_startup_icons (ctx):
+    '''Icons of first frame, from the scaled icon cache once it is filled'''
+    import mdnoteman_gui as gui
+
+    gui.icon_cache = os.path.join (ctx.cache_path, 'icons')
+    def setup ():
+        gui.assets.clear ()
+    def run ():
+        cwd = os.getcwd ()
+        os.chdir (REPO_PATH) # assets/ is relative, as when the app runs
+        try:
+            for name in gui.ICONS:
+                gui.icon (name)
+        finally:
+            os.chdir (cwd)
+        return len (gui.ICONS)
+    return setup, run
+
+@benchmark ('convert_img')
+def bench_convert_img (ctx):
+    if ctx.md is None:
+        return None
+    contents = [note.simple_content for note in ctx.sample ()]
+    def run ():
+        for content in contents:
+            ctx.md.convert_img (content)
+        return len (contents)
+    return None, run
+
+@benchmark ('card_update')
+def bench_card_update (ctx):
+    if ctx.md is None:
+        return None
+    notes = ctx.sample ()
+    def run ():
+        for note in notes:
+            NoteCard (note = note).update (ctx.md)
+        return len (notes)
+    return None, run
+
+@benchmark ('card_update_cached')
+def bench_card_update_cached (ctx):
+    if ctx.md is None:
+        return None
+    notes = ctx.sample ()
+    cache = ThumbnailCache (path = os.path.join (ctx.cache_path, 'thumbs'), image_store = ctx.image_store)
+    for note in notes:
+        NoteCard (note = note).update (ctx.md, cache)
+    def run ():
+        for note in notes:
+            NoteCard (note = note).update (ctx.md, cache)
+        return len (notes)
+    return None, run
+
+@benchmark ('layout')
+def bench_layout (ctx):
+    heights = [estimate_height (note.simple_content, note.simple_context) for note in ctx.notebook.notes]
+    def run ():
+        layout = CardLayout (n_cols = 3).build (heights)
+        for y in range (0, int (layout.height), 600):
+            layout.slots_in_range (y - 800, y + 1400)
+        return len (heights)
+    return None, run
+
+def measure (setup, run, repeat):
+    times = []
+    items = 0
+    for k in range (repeat):
+        if setup is not None:
+            setup ()
+        start = time.perf_counter ()
+        items = run ()
+        times.append (time.perf_counter () - start)
+    median = statistics.median (times)
+    return {'repeat': repeat, 'items': items,
+            'min_ms': min (times) * 1000, 'median_ms': median * 1000, 'mean_ms': statistics.mean (times) * 1000,
+            'per_item_us': median * 1e6 / items if items else None}
+
+def git_revision ():
+    try:
+        return subprocess.run (['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True,
+                               cwd = REPO_PATH).stdout.strip () or None
+    except OSError:
+        return None
+
+def compare (results, baseline_file, threshold = REGRESSION):
+    '''Print median of each benchmark against baseline, return names of regressed ones'''
+    with open (baseline_file, 'r') as f:
+        baseline = json.load (f)
+    regressed = []
+    print (f"\n{'benchmark':<22}{'base ms':>12}{'now ms':>12}{'ratio':>8}")
+    for name, res in results ['benchmarks'].items ():
+        old = baseline.get ('benchmarks', {}).get (name)
+        if not old or 'median_ms' not in old or 'median_ms' not in res:
+            continue
+        ratio = res ['median_ms'] / old ['median_ms'] if old ['median_ms'] else float ('inf')
+        flag  = ''
+        if ratio > threshold:
+            regressed.append (name)
+            flag = '  <-- slower'
+        print (f"{name:<22}{old['median_ms']:>12.2f}{res['median_ms']:>12.2f}{ratio:>8.2f}{flag}")
+    return regressed
+
+def pair (text):
+    lo, _, hi = text.partition (',')
+    return (int (lo), int (hi or lo))
+
+def main (argv = None):
+    parser = argparse.ArgumentParser (prog = 'python -m bench.run', description = 'Time hot paths of mdnoteman on a synthetic notebook')
+    parser.add_argument ('--days', type = int, default = CorpusSpec.days)
+    parser.add_argument ('--notes-per-day', type = pair, default = CorpusSpec.notes_per_day, metavar = 'LO,HI')
+    parser.add_argument ('--words', type = pair, default = CorpusSpec.words, metavar = 'LO,HI')
+    parser.add_argument ('--tags', type = int, default = CorpusSpec.tags)
+    parser.add_argument ('--labels', type = int, default = CorpusSpec.labels)
+    parser.add_argument ('--image-ratio', type = float, default = CorpusSpec.image_ratio)
+    parser.add_argument ('--seed', type = int, default = CorpusSpec.seed)
+    parser.add_argument ('--repeat', type = int, default = 5)
+    parser.add_argument ('--only', default = '', help = 'comma separated benchmarks, default all of: ' + ', '.join (BENCHMARKS))
+    parser.add_argument ('--config', default = str (Path.home ()) + '/.mdnote/config', help = 'app config, its Fonts are used to render')
+    parser.add_argument ('--dir', default = None, help = 'keep corpus and caches in this folder')
+    parser.add_argument ('--out', default = None, help = 'write results to this JSON file')
+    parser.add_argument ('--compare', default = None, help = 'JSON results of an earlier run')
+    args = parser.parse_args (argv)
+
+    spec = CorpusSpec (days = args.days, notes_per_day = args.notes_per_day, words = args.words,
+                       tags = args.tags, labels = args.labels, image_ratio = args.image_ratio, seed = args.seed)
+    names = [name.strip () for name in args.only.split (',') if name.strip ()] or list (BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error (f"unknown benchmark {name}")
+
+    work = args.dir or tempfile.mkdtemp (prefix = 'mdnote-bench-')
+    try:
+        corpus = os.path.join (work, 'notebook')
+        shutil.rmtree (corpus, ignore_errors = True)
+        shutil.rmtree (os.path.join (work, 'cache'), ignore_errors = True)
+        info = generate (corpus, spec)
+        print (f"Corpus: {info['notes']} notes in {info['files']} files, {info['bytes']} bytes")
+
+        ctx = Context (path = corpus, cache_path = os.path.join (work, 'cache'), info = info,
+                       queries = make_queries (info))
+        ctx.md = make_markdown (args.config, ctx)
+
+        results = {'version': RESULTS_VERSION, 'time': time.strftime ('%Y-%m-%dT%H:%M:%S'),
+                   'revision': git_revision (), 'python': platform.python_version (),
+                   'platform': platform.platform (), 'cpus': os.cpu_count (),
+                   'corpus': dict (spec.dict, files = info ['files'], notes = info ['notes'], bytes = info ['bytes']),
+                   'benchmarks': {}}
+        for name in names:
+            job = BENCHMARKS [name] (ctx)
+            if job is None:
+                results ['benchmarks'][name] = {'skipped': 'no fonts, see --config'}
+                print (f"{name:<22} skipped")
+                continue
+            res = measure (*job, args.repeat)
+            results ['benchmarks'][name] = res
+            print (f"{name:<22}{res['median_ms']:>10.2f} ms  ({res['items']} items, min {res['min_ms']:.2f} ms)")
+    finally:
+        if args.dir is None:
+            shutil.rmtree (work, ignore_errors = True)
+
+    if args.out:
+        with open (args.out, 'w') as f:
+            json.dump (results, f, indent = 1)
+    if args.compare:
+        return 1 if compare (results, args.compare) else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit (main ())
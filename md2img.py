@@ -1,28 +1,96 @@
 #!/usr/bin/env python
 
+import os
 import re
+import hashlib
+import threading
 import markdown
-import requests
 from PIL import Image, ImageDraw, ImageFont
-from functools import reduce
+from functools import lru_cache
 from pathlib import Path
 
 BULLET_DIAMETER = 4
-IMAGE_BLOCK_HEIGHT = 1000
+RENDER_VERSION = 4 # bump when output of convert_img changes for the same input
+TEXTSIZE_CACHE_SIZE = 8192
+IMAGE_TIMEOUT = 10 # seconds
+
+_measure_draw = None
+_fonts = {}
+_fonts_lock = threading.Lock()
+
+def get_font (path, size):
+    """
+    Process-wide registry of fonts keyed by (path, size), each font file is
+    opened once however many Markdown_Ext instances or threads use it.
+    """
+    key = (path, size)
+    font = _fonts.get(key)
+    if font is None:
+        with _fonts_lock:
+            font = _fonts.get(key)
+            if font is None:
+                font = _fonts[key] = ImageFont.truetype(path, size)
+    return font
+
+@lru_cache (maxsize = TEXTSIZE_CACHE_SIZE)
+def measure_text (font, text):
+    """
+    (width, height) of text in font. All measurements share one scratch
+    draw context and results are kept in an LRU keyed by (font, text).
+    """
+    global _measure_draw
+    if _measure_draw is None:
+        _measure_draw = ImageDraw.Draw (Image.new (mode="P", size=(0, 0)))
+    _, _, width, height = _measure_draw.textbbox((0, 0), text=text, font=font)
+    return width, height + 2
+
+@lru_cache (maxsize = TEXTSIZE_CACHE_SIZE)
+def measure_advance (font, text):
+    """
+    Advance width of text in font, additive along a line except for kerning
+    """
+    return font.getlength (text)
+
+class DrawList:
+    """
+    Draw commands recorded while laying out, painted on an image once its
+    final height is known. Records the ImageDraw calls used by Markdown_Ext
+    and Image.paste.
+    """
+    def __init__(self):
+        self.commands = []
+
+    def text(self, *args, **kwargs):
+        self.commands.append(("text", args, kwargs))
+
+    def line(self, *args, **kwargs):
+        self.commands.append(("line", args, kwargs))
+
+    def ellipse(self, *args, **kwargs):
+        self.commands.append(("ellipse", args, kwargs))
+
+    def paste(self, *args, **kwargs):
+        self.commands.append(("paste", args, kwargs))
+
+    def paint(self, image):
+        draw = ImageDraw.Draw(image)
+        for op, args, kwargs in self.commands:
+            if op == "paste":
+                image.paste(*args, **kwargs)
+            else:
+                getattr(draw, op)(*args, **kwargs)
+        return image
 
 class Markdown_Ext (markdown.Markdown):
     """
-    Recusively walks the parsed markdown and renders to an image.  Uses chunks
-    of IMAGE_BLOCK_HEIGHT to render parts of the markdown incrementally (without
-    pre-measuring) and assembles the chunks at the end.
+    Recusively walks the parsed markdown and renders to an image in two
+    passes: layout records draw commands and advances y, then a single image
+    of the final height is allocated and the commands are painted on it.
     """
 
     def init (self):
-        # List of (Image, height) to be merged for the result
-        self.image = None
-        self.image_draw = None
+        self.canvas = DrawList()
         self.image_x = 0
-        self.image_y = 0
         self.indent = 0
         self.links = []
 
@@ -30,12 +98,13 @@ class Markdown_Ext (markdown.Markdown):
         self.list_types = []
         self.list_item_nums = []
         self.y = 0
-        self.images = []
         self.line_height = 0
         self.in_pre = False
+        self.pending_images = []
 
     def __init__(self, width_spec, config = None, **kwargs):
         super().__init__ (**kwargs)
+        self.image_loader = None # callable (src, max_width) -> (image or None, pending)
         self.image_width = max(width_spec, key=lambda x: x[2])[2]
 
         self.init ()
@@ -62,24 +131,57 @@ class Markdown_Ext (markdown.Markdown):
         if config:
             self.config.update(config)
 
-        font_size = self.config["font_size"]
-        default_font_path = self.config["default_font_path"]
-        self.default_font = ImageFont.truetype(default_font_path, font_size)
-        self.bold_font = ImageFont.truetype(self.config["bold_font_path"], font_size)
-        self.code_font = ImageFont.truetype(self.config["code_font_path"], self.config["code_font_size"])
-        self.h1_font = ImageFont.truetype(self.config["default_font_path"], font_size * 2)
-        self.h2_font = ImageFont.truetype(self.config["default_font_path"], int(font_size * 1.75))
-        self.h3_font = ImageFont.truetype(self.config["default_font_path"], font_size * 1.6)
-        self.h4_font = ImageFont.truetype(self.config["default_font_path"], int(font_size * 1.5))
-        self.h5_font = ImageFont.truetype(self.config["default_font_path"], int(font_size * 1.25))
-        self.h6_font = ImageFont.truetype(self.config["default_font_path"], int(font_size * 1))
-        self.italics_font = ImageFont.truetype(self.config["italics_font_path"], font_size)
+        self.default_font # fail early on a bad font config, other fonts load on first use
 
         self.width_spec = width_spec
         self.width_spec.sort()
         self.width_spec_index = -1
         self.apply_width_spec()
 
+    # Font attribute -> (config key of font path, size from config)
+    font_specs = {
+        "default_font": ("default_font_path", lambda c: c["font_size"]),
+        "bold_font": ("bold_font_path", lambda c: c["font_size"]),
+        "code_font": ("code_font_path", lambda c: c["code_font_size"]),
+        "italics_font": ("italics_font_path", lambda c: c["font_size"]),
+        "h1_font": ("default_font_path", lambda c: c["font_size"] * 2),
+        "h2_font": ("default_font_path", lambda c: int(c["font_size"] * 1.75)),
+        "h3_font": ("default_font_path", lambda c: c["font_size"] * 1.6),
+        "h4_font": ("default_font_path", lambda c: int(c["font_size"] * 1.5)),
+        "h5_font": ("default_font_path", lambda c: int(c["font_size"] * 1.25)),
+        "h6_font": ("default_font_path", lambda c: int(c["font_size"] * 1)),
+    }
+
+    def __getattr__(self, name):
+        # Only called for missing attributes, fonts are fetched from the registry on first use
+        spec = Markdown_Ext.font_specs.get(name)
+        if spec is None:
+            raise AttributeError(name)
+        path_key, size = spec
+        font = get_font(self.config[path_key], size(self.config))
+        setattr(self, name, font)
+        return font
+
+    @property
+    def fingerprint (self):
+        """
+        Stable digest of everything besides the markdown source that affects
+        the rendered image: renderer version, width spec, config and fonts.
+        """
+        if getattr(self, "_fingerprint", None) is not None:
+            return self._fingerprint
+
+        fonts = []
+        for k in sorted (self.config):
+            if k.endswith ("_font_path"):
+                try:
+                    fonts.append ((k, os.path.getmtime (self.config[k])))
+                except OSError:
+                    fonts.append ((k, None))
+        spec = (RENDER_VERSION, self.width_spec, sorted (self.config.items ()), fonts)
+        self._fingerprint = hashlib.sha1 (repr (spec).encode ()).hexdigest ()
+        return self._fingerprint
+
     def apply_width_spec(self, h=0):
         if self.width_spec_index + 1 < len(self.width_spec):
             if self.width_spec[self.width_spec_index + 1][0] <= self.y + h:
@@ -90,21 +192,9 @@ class Markdown_Ext (markdown.Markdown):
     def compact_whitespace(self, text):
         return re.sub(r'\s+', ' ', text)
 
-    def ensure_image(self, h, retain = False, draw = True):
+    def ensure_image(self, h):
         self.apply_width_spec(h)
-
-        if (not retain) and (self.image_y + h > self.image.size[1]):
-            if self.image_y == 0:
-                print("Image block size too small! Results will be cropped...")
-            self.new_image_block()
-        else:
-            self.image = self.image.crop ((0, 0, self.image_width, self.image_y + h))
-            self.image_draw = ImageDraw.Draw(self.image)
-
-        if draw:
-            return self.image_draw
-        else:
-            return self.image
+        return self.canvas
 
     def get_links(self):
         return self.links
@@ -164,8 +254,8 @@ class Markdown_Ext (markdown.Markdown):
         self.newline()
         h = self.config["margin_bottom"]
         horizontal_padding = self.config["hr_padding"]
-        self.image_draw.line((self.start_x + horizontal_padding, self.image_y + h / 2,
-                              self.end_x - horizontal_padding, self.image_y + h / 2), fill=self.config["hr_color"])
+        self.canvas.line((self.start_x + horizontal_padding, self.y + h / 2,
+                          self.end_x - horizontal_padding, self.y + h / 2), fill=self.config["hr_color"])
         self.newline(h)
 
     def handle_li (self, node):
@@ -176,7 +266,7 @@ class Markdown_Ext (markdown.Markdown):
             draw = self.ensure_image(h)
 
             x = self.image_x - BULLET_DIAMETER - self.config["bullet_outdent"]
-            y = self.image_y + (h - BULLET_DIAMETER) / 2
+            y = self.y + (h - BULLET_DIAMETER) / 2
             draw.ellipse((x, y,
                           x + BULLET_DIAMETER,
                           y + BULLET_DIAMETER),
@@ -192,7 +282,7 @@ class Markdown_Ext (markdown.Markdown):
             draw = self.ensure_image(h)
 
             x = self.image_x - w - self.config["bullet_outdent"]
-            draw.text((x, self.image_y), current_number + ".",
+            draw.text((x, self.y), current_number + ".",
                       font=self.default_font,
                       fill=self.config["color"])
 
@@ -260,12 +350,26 @@ class Markdown_Ext (markdown.Markdown):
         self.indent -= indent
         self.newline()
 
-    def handle_img (self, node):
+    def load_image (self, src):
+        """
+        Return (image or None, pending). image_loader, when set, must not
+        block: it returns pending for images not available yet, those are
+        rendered as alt text and listed in pending_images. Images it returns
+        are expected to be at most max_width wide already.
+        """
+        if self.image_loader is not None:
+            return self.image_loader(src, self.image_width)
+        import requests # only without image_loader, app and workers set one
         try:
-            rsp = requests.get(node.attrib['src'], stream = True)
-            img = Image.open (rsp.raw)
+            rsp = requests.get(src, stream = True, timeout = IMAGE_TIMEOUT)
+            return Image.open (rsp.raw), False
         except:
-            img = None
+            return None, False
+
+    def handle_img (self, node):
+        img, pending = self.load_image(node.attrib.get('src', ''))
+        if pending:
+            self.pending_images.append(node.attrib.get('src', ''))
 
         if img:
             self.render_img (img)
@@ -322,25 +426,56 @@ class Markdown_Ext (markdown.Markdown):
         if h == -1:
             h = self.line_height
 
-        self.image_y += h
         self.y += h
         self.image_x = self.start_x + self.indent
 
         self.line_height = 0
 
-    def new_image_block(self):
-        self.save_image_block()
-
-        self.image = Image.new("RGBA", (self.image_width, IMAGE_BLOCK_HEIGHT))
-        self.image_draw = ImageDraw.Draw(self.image)
-        self.image_y = 0
-
     @staticmethod
     def textsize (text, font):
-        im = Image.new (mode="P", size=(0, 0))
-        draw = ImageDraw.Draw (im)
-        _, _, width, height = draw.textbbox((0, 0), text=text, font=font)
-        return width, height + 2
+        return measure_text (font, text)
+
+    def fit_line(self, parts, advances, space, start, eliminate, font):
+        """
+        Find how many parts from start fit before end_x, return (end, h).
+        The guess from summed advances is corrected with real measurements,
+        a part too wide for a line on its own is split with a binary search.
+        """
+        avail = self.end_x - self.image_x
+
+        end = start + 1
+        x = advances[start]
+        while end < len(parts) and x + space + advances[end] <= avail:
+            x += space + advances[end]
+            end += 1
+
+        w, h = self.textsize(eliminate.join(parts[start:end]), font=font)
+        while w > avail and end > start + 1:
+            end -= 1
+            w, h = self.textsize(eliminate.join(parts[start:end]), font=font)
+
+        part = parts[start]
+        if w > avail and len(part) > 1: # split the part, keep at least one char at line start
+            lo, hi = 0, len(part) - 1
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if self.textsize(part[:mid], font=font)[0] <= avail:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            if lo == 0 and self.image_x <= self.start_x + self.indent:
+                lo = 1
+            parts[start:start + 1] = [part[:lo], part[lo:]]
+            advances[start:start + 1] = [measure_advance(font, part[:lo]), measure_advance(font, part[lo:])]
+            return start + 1, self.textsize(part[:lo], font=font)[1]
+
+        # take more parts while they fit, h comes from the first one that does not
+        while end < len(parts):
+            w, h = self.textsize(eliminate.join(parts[start:end + 1]), font=font)
+            if w > avail:
+                break
+            end += 1
+        return end, h
 
     def render_text(self, text, color, end_block=False, font=None, eliminate = ' '):
         if text is None:
@@ -357,7 +492,7 @@ class Markdown_Ext (markdown.Markdown):
                 w, h = self.textsize (line, font=font)
                 draw = self.ensure_image(h)
 
-                draw.text((self.image_x, self.image_y), line, font=font, fill=color)
+                draw.text((self.image_x, self.y), line, font=font, fill=color)
                 blocks.append((self.image_x, self.y, w, h))
 
                 self.line_height = max(h, self.line_height)
@@ -369,34 +504,13 @@ class Markdown_Ext (markdown.Markdown):
 
             eliminate = '' if not eliminate else eliminate
             if eliminate == '':
-                parts = text
+                parts = list(text)
             else:
                 parts = text.split(eliminate)
-            #print (parts)
-            #print ("image_x %d and end_x %d"% (self.image_x, self.end_x))
+            advances = [measure_advance(font, part) for part in parts]
+            space = measure_advance(font, eliminate)
             while end_index < len(parts):
-                w = 0
-                while end_index < len(parts):
-                    (w, h) = self.textsize(eliminate.join(parts[start_index:end_index + 1]),
-                                           font=font)
-                    if self.image_x + w > self.end_x:
-                        if end_index > start_index:
-                            break
-                        else: # break into smaller parts
-                            delta = self.end_x - self.image_x
-                            avg_w = w / len(eliminate.join(parts[start_index:end_index + 1]))
-                            split_index = int((delta // avg_w))
-                            #print (split_index)
-                            tmp1, tmp2 = parts[start_index][:split_index], parts[start_index][split_index:]
-                            parts [start_index] = tmp1
-                            parts.insert (start_index + 1, tmp2)
-
-                    end_index += 1
-
-                # In the case that we can't fit a single word on this line
-                # just render the first word
-                if start_index == end_index:
-                    end_index = start_index + 1
+                end_index, h = self.fit_line(parts, advances, space, start_index, eliminate, font)
 
                 text_frag = eliminate.join(parts[start_index:end_index])
                 #print (text_frag)
@@ -405,7 +519,7 @@ class Markdown_Ext (markdown.Markdown):
                 self.line_height = max(h, self.line_height)
 
                 #print ("At start_index %d and end_index %d, rendering %s" %(start_index, end_index, text_frag))
-                draw.text((self.image_x, self.image_y),
+                draw.text((self.image_x, self.y),
                           text_frag,
                           font=font, fill=color)
 
@@ -439,27 +553,19 @@ class Markdown_Ext (markdown.Markdown):
                 img = img.resize ((self.image_width, int (self.image_width * (h/w))))
             self.newline ()
 
-        draw = self.ensure_image(h, retain = True, draw = False)
+        canvas = self.ensure_image(h)
         self.line_height = max (img.size[1], self.line_height)
 
-        draw.paste (img, (self.image_x, self.y))
+        canvas.paste (img, (self.image_x, self.y))
 
         if self.image_x + img.size[0] > self.end_x:
             self.newline()
         else:
             self.image_x += img.size[0]
 
-    def save_image_block(self):
-        if self.image is not None:
-            self.images.append((self.image, self.image_y))
-            try:
-                del self.image_draw
-            except:
-                pass
-
-            self.image = None
-
     def convert_img (self, source):
+        self.pending_images = []
+
         # Fixup the source text
         if not source.strip():
             return ''  # a blank unicode string
@@ -485,20 +591,12 @@ class Markdown_Ext (markdown.Markdown):
             if newRoot is not None:
                 root = newRoot
 
-        self.new_image_block()
         self.handle_node(root)
 
-        # Add the last used image if necessary
-        self.save_image_block()
-
-        height = reduce(lambda x, y: x + y[1], self.images, 0)
-        final = Image.new("RGBA", (self.image_width, height))
-        y = 0
-        for img in self.images:
-            final.paste(img[0], (0, y))
-            y += img[1]
-
+        final = self.canvas.paint(Image.new("RGBA", (self.image_width, self.y)))
+        pending = self.pending_images
         self.init ()
+        self.pending_images = pending # kept for the caller until next conversion
         return final
 
 def md2png(md_str, width_spec, config = None):
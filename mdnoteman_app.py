@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+import sys
+if sys.hexversion < 0x03050000:
+    print("!!! This component requires Python version 3.5 at least !!!")
+    sys.exit(1)
+
+import configparser
+import time
+import math
+from pathlib import Path
+
+import FreeSimpleGUI as sg
+import mdnoteman_gui as gui
+from mdnoteman_pkm import Notebook
+from mdnoteman_save import AutoSaver
+import mdnoteman_trace as trace
+from mdnoteman_profile import EventProfiler
+
+cfgpath_str = str(Path.home ()) + "/.mdnote"
+cfgfile_str = cfgpath_str + '/config'
+cfg = configparser.ConfigParser ()
+cfg_file = Path(cfgfile_str)
+if cfg_file.exists() and cfg_file.is_file():
+    cfg.read (cfgfile_str)
+
+dflt_cfg = {}
+dflt_cfg['Appearance'] = {'Theme': 'SystemDefault1'}
+dflt_cfg['Notebook'] = {'Path': ''}
+dflt_cfg['Cache'] = {'Path': cfgpath_str + '/cache'}
+dflt_cfg['Render'] = {'Workers': 'auto'} # number of render processes, 'auto' == one per core, 0 == off
+dflt_cfg['Autosave'] = {'Delay': '2'} # seconds without changes before dirty notes are written, 0 == on refresh/exit only
+
+if sys.platform == 'linux':
+    font_path = str(Path.home()) + "/.local/share/fonts"
+elif sys.platform == 'darwin':
+    font_path = str(Path.home()) + "/Library/Fonts"
+else:
+    print ("Unsupported platform")
+    font_path = '' # TODO
+
+dflt_cfg['Fonts'] = {'Bold':   font_path + "/FreeSansBold.otf"
+                    ,'Code':   font_path + "/FreeMono.otf"
+                    ,'Dflt':   font_path + "/FreeSans.otf"
+                    ,'Italic': font_path + "/FreeSansOblique.otf"
+                    ,'Code_size' : 14
+                    ,'Size':   12}
+
+def add_dict (a, b):
+    for k in b:
+        if k not in a:
+            a [k] = b [k]
+        else:
+            if b [k] is dict:
+                a [k] = add_dict (a [k], b [k])
+    return a
+
+cfg = add_dict (cfg, dflt_cfg)
+
+default_theme = cfg ['Appearance']['Theme']
+
+Nb = Notebook (path = cfg['Notebook']['Path'], cache_path = cfg['Cache']['Path'])
+autosave_delay = float (cfg['Autosave']['Delay'])
+autosaver = AutoSaver (delay = autosave_delay) if autosave_delay > 0 else None
+
+def save_config ():
+    global cfgpath_str
+    global cfg
+
+    Path(cfgpath_str).mkdir (parents = True, exist_ok = True)
+    with open (cfgpath_str + '/config', 'w') as cfgfile:
+        cfg.write (cfgfile)
+
+def new_notebook (path):
+    global Nb
+
+    Nb = Notebook (path = path, cache_path = cfg['Cache']['Path'])
+    Nb.Refresh ()
+    if autosaver:
+        autosaver.attach (Nb)
+
+def call_note (**kwargs):
+    notes = gui.cardbox.find_notes_from_fig (gui.window[(gui.cardbox.name, 'graph')].selected_fig)
+    gui.window[(gui.cardbox.name, 'graph')].selected_fig = None
+
+    #print (notes)
+    if kwargs['cmd'] == 'color':
+        l = len (notes)
+        color = notes[0].note.color if l == 1 else None
+        new_color = gui.call_color_chooser_window (color = color, location = kwargs['location'])
+        print (new_color)
+        gui.cardbox.update_note (notes, color = new_color)
+        return True
+
+    if kwargs['cmd'] == 'delete':
+        gui.cardbox.update_note (notes, delete = True)
+        gui.update_show_tags    (Nb.tags)
+        gui.update_show_labels  (Nb.labels)
+        return True
+
+    if kwargs['cmd'] == 'tags':
+        l = len (notes)
+        tags          = gui.cardbox.notebook.tags
+        selected_tags = notes[0].note.tags if l == 1 else []
+        new_tags      = gui.call_tags_chooser_window ("Tag note", tags = tags, selected_tags = selected_tags,
+                                                      location = kwargs['location'], relax_list_order = True, row_limit = 8)
+        gui.cardbox.update_note (notes, tags = new_tags)
+        gui.update_show_tags    (Nb.tags)
+        return True
+
+    if kwargs['cmd'] == 'labels':
+        l = len (notes)
+        lbls          = gui.cardbox.notebook.labels_flatten
+        selected_lbls = notes[0].note.labels if l == 1 else []
+        new_labels    = gui.call_tags_chooser_window ("Label note", tags = lbls, selected_tags = selected_lbls,
+                                                      location = kwargs['location'], relax_list_order = False)
+        gui.cardbox.update_note (notes, labels = new_labels)
+        gui.update_show_labels  (Nb.labels)
+        return True
+
+    if kwargs['cmd'] == 'note':
+        return gui.call_edit_window (note = kwargs['note'])
+
+def call_new_note (note = None):
+        return gui.call_edit_window (note)
+
+def call_open ():
+    global cfg
+
+    sel_notebook = sg.popup_get_folder (message = 'Select path to notebook',
+                                        default_path = cfg['Notebook']['Path'],
+        initial_folder = str(Path.home()), grab_anywhere = True, keep_on_top = True) \
+                   or cfg['Notebook']['Path']
+    gui.flush_events ()
+    if sel_notebook != cfg['Notebook']['Path']:
+        cfg['Notebook']['Path'] = sel_notebook
+    save_config ()
+    new_notebook (sel_notebook)
+
+def create_gui (theme):
+    global Nb
+
+    return gui.create_gui (theme, label_tree = Nb.labels)
+
+def call_dump_trace ():
+    filename = trace.dump (cfgpath_str + time.strftime ('/traces/trace-%Y%m%d-%H%M%S.json'))
+    print (f"Trace written to {filename}")
+
+def call_settings ():
+    global cfg
+
+    cfg = gui.theme_change (cfg)
+    save_config ()
+
+def clean_up ():
+    global Nb
+
+    save_config ()
+    if autosaver:
+        autosaver.stop ()
+    Nb.Refresh ()
+    gui.cardbox.close ()
+
+USAGE = "Usage: mdnoteman.py [debug] [--profile[=MS]] [--stall=MS] [--cprofile] | COMMAND ... (see --help)"
+
+def option_ms (arg, value):
+    '''Milliseconds of option arg, exit with usage if value is not a number >= 0'''
+    try:
+        ms = float (value)
+    except ValueError:
+        ms = None
+    if ms is None or not math.isfinite (ms) or ms < 0:
+        print (f"Invalid option {arg}, expected milliseconds >= 0\n{USAGE}", file = sys.stderr)
+        sys.exit (2)
+    return ms
+
+def main ():
+    profiler = None
+    for arg in sys.argv[1:]:
+        # debug              : keep stdout on terminal and profile events
+        # --profile[=MS]     : report events taking longer than MS
+        # --stall=MS         : save stack of main thread when an event runs longer than MS, 0 == off
+        # --cprofile         : run events under cProfile, keep profiles of slow ones
+        name, _, value = arg.partition ('=')
+        if name in ('debug', '--profile', '--stall', '--cprofile') and profiler is None:
+            profiler = EventProfiler (timeout_event = sg.TIMEOUT_KEY, path = cfgpath_str + '/profiles')
+        if name == 'debug':
+            gui.debug = True
+        elif name == '--profile':
+            if value or arg.endswith ('='):
+                profiler.slow_ms = option_ms (arg, value)
+        elif name == '--stall':
+            profiler.stall_ms = option_ms (arg, value)
+        elif name == '--cprofile':
+            profiler.cprofile = True
+        else:
+            print (f"Unknown option {arg}\n{USAGE}", file = sys.stderr)
+            sys.exit (2)
+    if profiler:
+        profiler.start ()
+        gui.profiler = profiler
+
+    #Nb.Create_random_notes (num = 10)
+    if cfg['Notebook']['Path'] != '':
+        Nb.Refresh ()
+    if autosaver:
+        autosaver.attach (Nb)
+
+    gui.window = create_gui (cfg)
+
+    gui.cardbox.set_notebook (Nb)
+    gui.update_show_tags     (Nb.tags)
+    gui.update_show_labels   (Nb.labels)
+
+    cb = {'settings': call_settings,
+          'open'    : call_open,
+          'note'    : call_note,
+          'new_note': call_new_note,
+          'trace'   : call_dump_trace,
+          }
+    while gui.handle (cb = cb):
+        pass
+
+    clean_up ()
+    if profiler:
+        profiler.stop ()
+    gui.pop_nested_window ()
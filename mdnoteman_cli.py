@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+import sys
+if sys.hexversion < 0x03070000:
+    print("!!! This component requires Python version 3.7 at least !!!")
+    sys.exit(1)
+
+import os
+import io
+import json
+import time
+import argparse
+import contextlib
+import configparser
+from pathlib import Path
+
+import mdnoteman_dsl as dsl
+import mdnoteman_trace as trace
+from mdnoteman_core import Notebook, format_note, markdown_config
+
+CONFIG_FILE = str(Path.home ()) + "/.mdnote/config"
+COMMANDS    = ('query', 'stats', 'render', 'refresh') # dispatched here by mdnoteman.py before any GUI import
+TOP_COUNT   = 10 # tags and labels listed by stats
+
+def load_config (args):
+    cfg = configparser.ConfigParser ()
+    cfg.read (args.config)
+    if args.notebook:
+        cfg ['Notebook'] = {'Path': args.notebook}
+    if args.cache:
+        cfg ['Cache'] = {'Path': args.cache}
+    if 'Cache' not in cfg:
+        cfg ['Cache'] = {'Path': os.path.join (os.path.dirname (args.config), 'cache')}
+    return cfg
+
+def open_notebook (cfg, args, refresh = False):
+    '''Notebook of config pulled from disk, warm from its snapshot. Nothing is written back unless refresh'''
+    path = cfg.get ('Notebook', 'Path', fallback = '')
+    if not path or not os.path.isdir (path):
+        raise SystemExit (f"No notebook at '{path}', set it in {args.config} or use --notebook")
+    nb = Notebook (path = path, cache_path = cfg ['Cache']['Path'])
+    with chatter (args):
+        if refresh:
+            nb.Refresh ()
+        else:
+            nb.Pull_From_Disk ()
+    return nb
+
+def chatter (args):
+    '''Messages of notebook operations go to stderr with --verbose, else nowhere'''
+    return contextlib.redirect_stdout (sys.stderr if args.verbose else io.StringIO ())
+
+def select_notes (nb, query):
+    '''Notes matching query (all for empty one) in notebook order, a bare number selects by timestamp'''
+    query = ' '.join (query).strip ()
+    if query == '':
+        return list (nb.notes)
+    if query.isdigit ():
+        note = nb.get_note (int (query))
+        return [note] if note is not None else []
+    try:
+        ids = dsl.compile_query (query).select (nb)
+    except ValueError:
+        raise SystemExit (f"Invalid query string {query}")
+    return sorted ((nb.get_note (ts) for ts in ids if nb.get_note (ts) is not None), key = lambda note: nb.find_note (note.timestamp))
+
+def title (note):
+    for line in note.content.split ('\n'):
+        line = line.strip ().lstrip ('#').strip ()
+        if line:
+            return line
+    return ''
+
+def cmd_query (args, cfg):
+    nb    = open_notebook (cfg, args)
+    notes = select_notes (nb, args.query)
+    if args.limit:
+        notes = notes [:args.limit]
+    if args.format == 'json':
+        json.dump ([note.dict for note in notes], sys.stdout, indent = 1, ensure_ascii = False)
+        print ()
+    elif args.format == 'md':
+        for note in notes:
+            sys.stdout.write (format_note (note.timestamp, note.color, note.prefer_idx, note.tags, note.labels, note.content))
+    elif args.format == 'ids':
+        for note in notes:
+            print (note.timestamp)
+    else:
+        for note in notes:
+            context = ' '.join (['#' + tag for tag in sorted (note.tags)] + ['@' + lbl for lbl in sorted (note.labels)])
+            print (f"{note.timestamp}  {time.strftime ('%Y-%m-%d %H:%M', time.localtime (note.timestamp))}  "
+                   f"{title (note)[:60]}" + (f"  {context}" if context else ''))
+    return 0 if notes else 1
+
+def cmd_stats (args, cfg):
+    start = time.perf_counter ()
+    nb    = open_notebook (cfg, args)
+    stats = {'path': os.path.abspath (nb.path),
+             'notes': len (nb.notes),
+             'files': len (nb.manifest),
+             'bytes': sum (entry ['size'] for entry in nb.manifest.values ()),
+             'first': min ((note.timestamp for note in nb.notes), default = None),
+             'last': max ((note.timestamp for note in nb.notes), default = None),
+             'tags': len (nb.tags),
+             'labels': len (nb.labels_flatten),
+             'top_tags': sorted (nb.tags.items (), key = lambda kv: -kv[1])[:TOP_COUNT],
+             'top_labels': sorted (nb.labels_flatten.items (), key = lambda kv: -kv[1])[:TOP_COUNT],
+             'snapshot': nb.cache_dir is not None and os.path.exists (os.path.join (nb.cache_dir, 'notebook.snapshot')),
+             'load_ms': round ((time.perf_counter () - start) * 1000, 1)}
+    if args.json:
+        json.dump (stats, sys.stdout, indent = 1, ensure_ascii = False)
+        print ()
+        return 0
+    day = lambda ts: time.strftime ('%Y-%m-%d', time.localtime (ts)) if ts is not None else '-'
+    print (f"Notebook {stats['path']}")
+    print (f"  {stats['notes']} notes in {stats['files']} files, {trace.format_bytes (stats['bytes'])}, "
+           f"{day (stats['first'])} .. {day (stats['last'])}")
+    print (f"  {stats['tags']} tags: " + ', '.join (f"{tag} ({n})" for tag, n in stats ['top_tags']))
+    print (f"  {stats['labels']} labels: " + ', '.join (f"{lbl} ({n})" for lbl, n in stats ['top_labels']))
+    print (f"  loaded in {stats['load_ms']} ms" + (" from snapshot" if stats ['snapshot'] else ''))
+    return 0
+
+def cmd_render (args, cfg):
+    from md2img import Markdown_Ext # fonts and markdown only when rendering
+    from mdnoteman_render import render_card
+    from mdnoteman_fetch import ImageStore
+
+    if 'Fonts' not in cfg:
+        raise SystemExit (f"No Fonts in {args.config}")
+    nb    = open_notebook (cfg, args)
+    notes = select_notes (nb, args.query)
+    if args.limit:
+        notes = notes [:args.limit]
+
+    md    = Markdown_Ext ([(0, 0, args.width)], markdown_config (cfg))
+    store = ImageStore (path = os.path.join (cfg ['Cache']['Path'], 'images'), base_path = nb.path)
+    md.image_loader = store.load
+    os.makedirs (args.out, exist_ok = True)
+    for note in notes:
+        data, pending = render_card (md, note.simple_content, note.simple_context, args.width)
+        if pending:
+            # No event loop to wait for, fetch remote images now and render again
+            for src in pending:
+                store.fetch (src)
+            data, pending = render_card (md, note.simple_content, note.simple_context, args.width)
+        filename = os.path.join (args.out, f"{note.timestamp}.png")
+        with open (filename, 'wb') as f:
+            f.write (data)
+        print (filename)
+    return 0 if notes else 1
+
+def cmd_refresh (args, cfg):
+    nb = open_notebook (cfg, args, refresh = True)
+    print (f"{len (nb.notes)} notes in {len (nb.manifest)} files")
+    return 0
+
+def make_parser ():
+    common = argparse.ArgumentParser (add_help = False)
+    common.add_argument ('--config', default = CONFIG_FILE, help = 'app config, default %(default)s')
+    common.add_argument ('--notebook', default = None, help = 'notebook folder instead of the one in config')
+    common.add_argument ('--cache', default = None, help = 'cache folder instead of the one in config')
+    common.add_argument ('-v', '--verbose', action = 'store_true', help = 'show notebook messages and timings on stderr')
+
+    parser = argparse.ArgumentParser (prog = 'mdnoteman', description = 'Query and maintain a notebook without the GUI')
+    sub = parser.add_subparsers (dest = 'command', required = True)
+
+    query = sub.add_parser ('query', parents = [common], help = 'list notes matching a query, e.g. tags work & "meeting"')
+    query.add_argument ('query', nargs = '*', help = 'query, all notes if empty, a timestamp selects one note')
+    query.add_argument ('--format', choices = ('text', 'json', 'md', 'ids'), default = 'text')
+    query.add_argument ('--limit', type = int, default = 0)
+    query.set_defaults (fn = cmd_query)
+
+    stats = sub.add_parser ('stats', parents = [common], help = 'notes, files, tags and labels of notebook')
+    stats.add_argument ('--json', action = 'store_true')
+    stats.set_defaults (fn = cmd_stats)
+
+    render = sub.add_parser ('render', parents = [common], help = 'render cards of matching notes to PNG files')
+    render.add_argument ('query', nargs = '*', help = 'query, all notes if empty, a timestamp selects one note')
+    render.add_argument ('--out', default = '.', help = 'folder of <timestamp>.png files')
+    render.add_argument ('--width', type = int, default = 240)
+    render.add_argument ('--limit', type = int, default = 0)
+    render.set_defaults (fn = cmd_render)
+
+    refresh = sub.add_parser ('refresh', parents = [common], help = 'pull note files, write back pending changes, update cache')
+    refresh.set_defaults (fn = cmd_refresh)
+    return parser
+
+def main (argv = None):
+    args = make_parser ().parse_args (argv)
+    cfg  = load_config (args)
+    ret  = args.fn (args, cfg)
+    if args.verbose:
+        print (trace.summary (), file = sys.stderr)
+    return ret
+
+if __name__ == '__main__':
+    sys.exit (main ())
@@ -0,0 +1,961 @@
+#!/usr/bin/env python
+
+import sys
+if sys.hexversion < 0x03070000:
+    print("!!! This component requires Python version 3.7 at least !!!")
+    sys.exit(1)
+
+# Notes, notebook, note files and queries; no GUI or rendering imports so scripts and the CLI stay light
+from dataclasses import dataclass, field
+from typing import List, Dict, Set, Callable
+import random
+import os
+import re
+import json
+import pickle
+import gc
+import hashlib
+import locale
+import shutil
+import threading
+import time
+import io
+import mdnoteman_dsl as dsl
+import mdnoteman_trace as trace
+from mdnoteman_save import note_file_name
+
+class SnapshotUnpickler (pickle.Unpickler):
+    '''Snapshots hold builtin types only, refuse anything else'''
+    def find_class (self, module, name):
+        raise pickle.UnpicklingError (f"{module}.{name} not allowed in snapshot")
+
+def copy_manifest (manifest):
+    return {fn: dict (entry, timestamps = list (entry ['timestamps'])) for fn, entry in manifest.items ()}
+
+def listdir_nohidden (path):
+    return list(filter(lambda f: not f.startswith('.'), os.listdir(path)))
+
+def file_digest (path):
+    h = hashlib.sha1 ()
+    with open (path, 'rb') as f:
+        for chunk in iter (lambda: f.read (1 << 16), b''):
+            h.update (chunk)
+    return h.hexdigest ()
+
+color_re     = re.compile(r"^\[color:[a-zA-Z0-9#]+\]\s*$")
+idx_re       = re.compile(r"^\[idx:\d+\]\s*$")
+timestamp_re = re.compile(r"^@\[\d+\]$")
+label_re     = re.compile(r'^[\s\t]*(@\b[^,|&!~\s|]+\b[\s\t]*)+$')
+tag_re       = re.compile(r'^[\s\t]*(#\b[^,|&!~\s|]+\b[\s\t]*)+$')
+link_re      = re.compile(r'\(\d+\)')
+note_file_re = re.compile(r"\d\d\d\d_\d\d_\d\d\.md")
+
+FT_INDEX_AFTER   = 1 # content queries answered by scanning notes before full-text index is built
+SNAPSHOT_VERSION = 1 # bump when notes or snapshot layout change
+
+HEADER_START  = frozenset ('@#[ \t') # first chars of timestamp, tags, labels, color and idx lines
+NOTE_ENCODING = locale.getpreferredencoding (False) # as open () in text mode
+
+def scan_note_file (f, spans = False):
+    '''Yield raw notes of an open note file as (timestamp, color, prefer_idx, tags, labels, content)
+    tags and labels are in file order, text before the first timestamp comes as note 0
+    With spans, f is opened in binary mode and (start, end) byte offsets are added to each note.
+    Spans of notes follow each other from start of file, a trailing part that is not a note
+    (after an empty note 0) is in none'''
+    pos        = 0
+    start      = 0
+    timestamp  = 0
+    color      = '#FFFFFF'
+    prefer_idx = 0
+    tags       = []
+    labels     = []
+    content    = []
+    is_tags_read       = False
+    is_labels_read     = False
+    is_color_read      = False
+    is_prefer_idx_read = False
+
+    for line in f:
+        if spans:
+            line_start = pos
+            pos       += len (line)
+            line       = line.decode (NOTE_ENCODING).replace ('\r\n', '\n')
+
+        if line[:1] not in HEADER_START: # plain content, most lines
+            content.append (line)
+            continue
+
+        if line[:2] == '@[' and timestamp_re.match(line):
+            new_timestamp = int(line.strip()[2:-1])
+            if content or len(labels) > 0 or len(tags) > 0:
+                note = (timestamp, color, prefer_idx, tags, labels, ''.join (content).rstrip ('\n\t '))
+                if spans:
+                    note += ((start, line_start),)
+                    start = line_start
+                yield note
+
+                labels     = []
+                tags       = []
+                color      = '#FFFFFF'
+                content    = []
+                prefer_idx = 0
+                is_tags_read       = False
+                is_labels_read     = False
+                is_color_read      = False
+                is_prefer_idx_read = False
+            timestamp = new_timestamp
+            continue
+
+        head = line.lstrip()[:1]
+        if not is_tags_read:
+            if head == '#' and tag_re.match(line):
+                for tag in line.split('#'):
+                    t = tag.strip().lower()
+                    if t != '':
+                        tags.append (t)
+                is_tags_read = True
+                continue
+
+        if not is_labels_read:
+            if head == '@' and label_re.match(line):
+                for lbl in line.split('@'):
+                    l = lbl.strip().lower()
+                    if l != '':
+                        labels.append (l)
+                is_labels_read = True
+                continue
+
+        if not is_color_read:
+            if line[:7] == '[color:' and color_re.match(line):
+                color = line.strip()[7:-1]
+                is_color_read = True
+                continue
+
+        if not is_prefer_idx_read:
+            if line[:5] == '[idx:' and idx_re.match(line):
+                prefer_idx = int(line.strip()[5:-1])
+                is_prefer_idx_read = True
+                continue
+
+        content.append (line)
+
+    if timestamp != 0:
+        note = (timestamp, color, prefer_idx, tags, labels, ''.join (content).rstrip ('\n\t '))
+        yield note + ((start, pos),) if spans else note
+
+def read_note_file (path):
+    '''Yield note records of a note file, one pass over its lines'''
+    if not os.path.isfile (path):
+        return
+    with open (path, 'r', encoding = NOTE_ENCODING) as f:
+        for timestamp, color, prefer_idx, tags, labels, content in scan_note_file (f):
+            yield {'timestamp': timestamp, 'tags': list(set(tags)),
+                   'content': content, 'labels': list(set(labels)),
+                   'links': list(set(link_re.findall (content))), 'color': color, 'prefer_idx': prefer_idx}
+
+def format_note (timestamp, color, prefer_idx, tags, labels, content):
+    parts = [f"@[{timestamp}]\n", f"[color:{color}]\n", f"[idx:{prefer_idx}]\n"]
+    if len(tags) > 0:
+        parts.append ('#' + ' #'.join(tags) + "\n")
+    if len(labels) > 0:
+        parts.append ('@' + ' @'.join(labels) + "\n")
+    parts.append (content + "\n\n")
+    return ''.join (parts)
+
+def replace_file (path, data):
+    '''Write data to a hidden temp file next to path, fsync it, then rename it over path'''
+    folder, name = os.path.split (path)
+    tmp = os.path.join (folder, f".{name}.{os.getpid ()}.tmp")
+    try:
+        with open (tmp, 'wb') as f:
+            f.write (data)
+            f.flush ()
+            os.fsync (f.fileno ())
+        if os.path.exists (path):
+            shutil.copymode (path, tmp)
+        os.replace (tmp, path)
+    except BaseException:
+        if os.path.exists (tmp):
+            os.remove (tmp)
+        raise
+    try: # make the rename itself durable
+        fd = os.open (folder or '.', os.O_RDONLY)
+        try:
+            os.fsync (fd)
+        finally:
+            os.close (fd)
+    except OSError:
+        pass
+
+def write_note_file (path, upd_records):
+    '''Write updated records to a note file, upd_records: timestamp -> (record, keep)
+    Notes not in upd_records are kept byte for byte, updated ones not in file are added at its end,
+    file is removed if no note is left.
+    Changed notes are overwritten in place when all keep their size and new notes are appended,
+    other changes rewrite the file through a temp file and rename.
+    Return how file was written: unchanged, inplace, append, rewrite or removed'''
+    remaining = dict (upd_records)
+
+    try:
+        with open (path, 'rb') as f:
+            data = f.read ()
+        trace.add (bytes_read = len (data))
+    except FileNotFoundError:
+        data = None
+
+    in_place = data is not None
+    if data is not None and data.count (b'\r') != data.count (b'\r\n'):
+        # Lone CR ends lines in text mode but not in binary, work on a normalized copy and rewrite
+        text = data.decode (NOTE_ENCODING).replace ('\r\n', '\n').replace ('\r', '\n')
+        data = text.encode (NOTE_ENCODING)
+        in_place = False
+    newline = '\r\n' if data and b'\r\n' in data else '\n'
+
+    def separator (before):
+        '''Line breaks after before so that an appended note starts after a blank line, none at start of file
+        Without the blank line a note of header lines only would take the next note's lines as its own'''
+        nl = newline.encode ()
+        if not before or before.endswith (nl + nl):
+            return b''
+        return nl if before.endswith (nl) else nl + nl
+
+    def encode (rec):
+        txt = format_note (rec['timestamp'], rec['color'], rec['prefer_idx'], rec['tags'], rec['labels'], rec['content'])
+        if newline != '\n':
+            txt = txt.replace ('\n', newline)
+        return txt.encode (NOTE_ENCODING)
+
+    # (start, end, new bytes) for notes in file that changed
+    changes = []
+    end     = 0
+    if data:
+        for note in scan_note_file (io.BytesIO (data), spans = True):
+            start, end = note[6]
+            if note[0] in remaining:
+                rec, keep = remaining.pop (note[0])
+                new = encode (rec) if keep else b''
+                if new != data[start:end]:
+                    changes.append ((start, end, new))
+    tail     = data[end:] if data else b''
+    appended = b''.join (encode (rec) for rec, keep in remaining.values () if keep)
+
+    if not changes and not appended:
+        return 'unchanged'
+
+    if in_place and data and not tail and all (len (new) == e - s for s, e, new in changes):
+        with open (path, 'r+b') as f:
+            for s, e, new in changes:
+                f.seek (s)
+                f.write (new)
+            if appended:
+                appended = separator (data) + appended
+                f.seek (len (data))
+                f.write (appended)
+            f.flush ()
+            os.fsync (f.fileno ())
+        trace.add (bytes_written = sum (len (new) for s, e, new in changes) + len (appended))
+        return 'append' if appended and not changes else 'inplace'
+
+    # Splice: unchanged notes are copied, appended notes go before a trailing non-note part
+    pieces = []
+    pos    = 0
+    for s, e, new in changes:
+        pieces.append (data[pos:s])
+        pieces.append (new)
+        pos = e
+    if data:
+        pieces.append (data[pos:end])
+    head   = b''.join (pieces)
+    result = head + (separator (head) + appended if appended else b'') + tail
+
+    if data is not None and result.strip () == b'': #if all notes were deleted, rm file
+        os.remove (path)
+        return 'removed'
+    replace_file (path, result)
+    trace.add (bytes_written = len (result))
+    return 'rewrite'
+
+def parse_note_file (path, upd_records = None):
+    '''Return records of a note file, or write upd_records into it (see write_note_file)'''
+    if upd_records is not None:
+        write_note_file (path, upd_records)
+        return []
+    return list (read_note_file (path))
+
+def markdown_config (cfg):
+    '''Markdown_Ext config of cards from Fonts section of app config'''
+    return {'color': (0,0,0,255), 'margin_bottom': 8,
+            'bold_font_path' : cfg['Fonts']['Bold'],
+            'code_font_path' : cfg['Fonts']['Code'],
+            'code_font_size' : int(cfg['Fonts']['Code_size']),
+            'default_font_path': cfg['Fonts']['Dflt'],
+            'italics_font_path': cfg['Fonts']['Italic'],
+            'font_size': int(cfg['Fonts']['Size'])}
+
+@dataclass
+class Note:
+    tags      : Set[str] = field (default_factory = lambda: {})
+    labels    : Set[str] = field (default_factory = lambda: {})
+    content   : str = ''
+    timestamp : int = 0
+    links     : List[int] = field (default_factory = lambda: [])
+    color     : str = '#FFFFFF'
+    prefer_idx: int = 0 # start from 1, 0 == undefined
+    dirty     : bool = False
+    deleted   : bool = False
+
+    @property
+    def simple_context (self):
+        _content = "---\n\n"
+        _content += ' '.join(['\#' + tag for tag in sorted (self.tags)]) + "\n\n"
+        _content += ' '.join(['@' + lbl for lbl in sorted (self.labels)])
+        return _content
+
+    @property
+    def simple_content (self):
+        _content = ''
+        if self.content != '':
+            _content += f"{self.content}\n\n"
+        return _content
+
+    @property
+    def dict (self):
+        return {'timestamp': self.timestamp, 'tags': self.tags.copy(), 'labels': self.labels.copy(),
+                'content': self.content, 'links': self.links.copy(), 'color': self.color, 'prefer_idx': self.prefer_idx}
+
+    def set (self, note_info, set_dirty = False):
+        if isinstance (note_info, dict):
+            for k in note_info:
+                setattr (self, k, note_info [k])
+        else:
+            self.set (note_info.dict)
+        if set_dirty:
+            self.set_dirty ()
+
+    def set_dirty (self, delete = False):
+        self.dirty   = True
+        self.deleted = delete
+
+    def __str__ (self):
+        inf = self.dict.copy ()
+        inf ['content'] = inf ['content'][:20] + ('...' if len(inf['content']) > 20 else '')
+        inf ['dirty'] = self.dirty
+        inf ['deleted'] = self.deleted
+        return f"{inf}"
+
+@dataclass
+class Notebook:
+    tags   : Dict = field (default_factory = lambda: {})
+    labels : Dict = field (default_factory = lambda: {})
+    #labels : Dict = field (default_factory = lambda: {'A': {'count' : 10, 'children': {}},
+    #                                                  'B': {'count' : 5, 'children': {'B1': {'count': 2, 'children': {}},
+    #                                                                                  'B2': {'count': 3, 'children': {}}}},
+    #                                                  'C': {'count' : 3, 'children': {}}})
+    path   : str  = None
+    notes  : List[Note] = field (default_factory = lambda: [])
+    cache_path : str = None
+    manifest   : Dict = field (default_factory = lambda: {}) # note file -> {mtime, size, hash, timestamps}
+    moved_timestamps : Dict = field (default_factory = lambda: {}) # old -> new timestamp of edited notes
+    _by_ts     : Dict = field (default_factory = lambda: {}, repr = False) # timestamp -> note
+    _idx       : Dict = field (default_factory = lambda: {}, repr = False) # timestamp -> position in notes
+    _idx_from  : int  = field (default = None, repr = False) # positions from here are stale
+    _tag_idx   : Dict = field (default_factory = lambda: {}, repr = False) # lowercased tag -> timestamps
+    _lbl_idx   : Dict = field (default_factory = lambda: {}, repr = False) # label path -> timestamps, with sub-labels
+    _ft_idx    : Dict = field (default_factory = lambda: {}, repr = False) # content word -> timestamps
+    _ft_text   : Dict = field (default_factory = lambda: {}, repr = False) # timestamp -> normalized content
+    _query_idx_ready : bool = field (default = False, repr = False) # tag and label indexes
+    _ft_idx_ready    : bool = field (default = False, repr = False) # full-text index, built on second content query
+    _ft_scans        : int  = field (default = 0, repr = False) # content queries answered by scanning notes
+    on_dirty   : Callable = field (default = None, repr = False) # called with note each time it is marked dirty
+    io_lock    : threading.RLock = field (default_factory = threading.RLock, repr = False) # note files and manifest
+    refreshes  : int  = field (default = 0, repr = False) # completed Refresh, notes dirtied before were written by it
+    _snapshot_of : Dict = field (default = None, repr = False) # copy of manifest of saved or loaded snapshot
+
+    @property
+    def labels_flatten (self):
+        def travel_labels (prefix, lbl_dict):
+            lbls = {}
+            for k, v in lbl_dict.items():
+                prefix_k = prefix + k 
+                lbls [prefix_k] = v ['count']
+                if v['children']:
+                    lbls = lbls | travel_labels (prefix_k + '/', v['children'])
+            return lbls
+
+        return travel_labels ('', self.labels)
+
+    @property
+    def cache_dir (self):
+        if not self.cache_path or not self.path:
+            return None
+        key = hashlib.sha1 (os.path.abspath (self.path).encode ()).hexdigest ()[:16]
+        return os.path.join (self.cache_path, 'notebooks', key)
+
+    def load_manifest (self):
+        if self.cache_dir is None:
+            return
+        try:
+            with open (os.path.join (self.cache_dir, 'manifest.json'), 'r') as f:
+                self.manifest = json.load (f)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def save_manifest (self):
+        if self.cache_dir is None:
+            return
+        os.makedirs (self.cache_dir, exist_ok = True)
+        tmp = os.path.join (self.cache_dir, 'manifest.json.tmp')
+        with open (tmp, 'w') as f:
+            f.write (json.dumps (self.manifest)) # one C encoder pass, dump () encodes piecewise
+        os.replace (tmp, os.path.join (self.cache_dir, 'manifest.json'))
+
+    def load_snapshot (self):
+        '''Restore notes, tags, labels and manifest saved by save_snapshot, return False if there is
+        no usable snapshot. Files changed since are found stale by their manifest entry on next pull'''
+        if self.cache_dir is None:
+            return False
+        gc_was_enabled = gc.isenabled ()
+        gc.disable () # collections triggered by the many small containers created here would double load time
+        try:
+            with open (os.path.join (self.cache_dir, 'notebook.snapshot'), 'rb') as f:
+                snapshot = SnapshotUnpickler (f).load ()
+            if snapshot.get ('version') != SNAPSHOT_VERSION or snapshot.get ('path') != os.path.abspath (self.path):
+                return False
+            notes = [Note (tags = tags, labels = labels, content = content, timestamp = timestamp,
+                           links = links, color = color, prefer_idx = prefer_idx)
+                     for timestamp, tags, labels, content, links, color, prefer_idx in snapshot ['notes']]
+            tags, labels, manifest = snapshot ['tags'], snapshot ['labels'], snapshot ['manifest']
+        except (OSError, EOFError, ValueError, TypeError, KeyError, AttributeError, pickle.UnpicklingError):
+            return False
+        finally:
+            if gc_was_enabled:
+                gc.enable ()
+
+        self.notes    = notes
+        self.tags     = tags
+        self.labels   = labels
+        self.manifest = manifest
+        self._by_ts   = {note.timestamp: note for note in notes}
+        self._idx     = {note.timestamp: i for i, note in enumerate (notes)}
+        self._idx_from = None
+        self._query_idx_ready = False
+        self._snapshot_of = copy_manifest (manifest)
+        return True
+
+    def save_snapshot (self):
+        '''Save notes in order with tags, labels and manifest they were read from, skipped when
+        manifest is the one of last snapshot, i.e. no note file changed'''
+        if self.cache_dir is None:
+            return
+        if self.manifest == self._snapshot_of:
+            return
+        snapshot = {'version': SNAPSHOT_VERSION, 'path': os.path.abspath (self.path),
+                    'manifest': self.manifest, 'tags': self.tags, 'labels': self.labels,
+                    'notes': [(note.timestamp, note.tags, note.labels, note.content, note.links,
+                               note.color, note.prefer_idx) for note in self.notes]}
+        try:
+            os.makedirs (self.cache_dir, exist_ok = True)
+            tmp = os.path.join (self.cache_dir, 'notebook.snapshot.tmp')
+            with open (tmp, 'wb') as f:
+                pickle.dump (snapshot, f, protocol = pickle.HIGHEST_PROTOCOL)
+            os.replace (tmp, os.path.join (self.cache_dir, 'notebook.snapshot'))
+            self._snapshot_of = copy_manifest (self.manifest)
+        except OSError as err:
+            print (f"Can not save notebook snapshot - {err}")
+
+    def check_note_file (self, note_file, loaded):
+        '''Return a fresh manifest entry if note_file must be (re-)parsed, None if it is unchanged
+        since last pull and all of its notes are still in app'''
+
+        filename = os.path.join (self.path, note_file)
+        st       = os.stat (filename)
+        entry    = self.manifest.get (note_file)
+        digest   = None
+
+        if entry is not None and all (ts in loaded for ts in entry['timestamps']):
+            if entry['mtime'] == st.st_mtime_ns and entry['size'] == st.st_size:
+                return None
+            if entry['size'] == st.st_size:
+                digest = file_digest (filename)
+                if digest == entry['hash']: # touched only
+                    entry['mtime'] = st.st_mtime_ns
+                    return None
+
+        return {'mtime': st.st_mtime_ns, 'size': st.st_size,
+                'hash': digest or file_digest (filename), 'timestamps': []}
+
+    @trace.traced ('Pull')
+    def Pull_From_Disk (self):
+        '''Fetch notes from disk, override note by version on disk if it was not modified in app
+        It returns in-app modified version if conflict
+        Only files added or changed since last pull (per manifest) are parsed, notes of vanished
+        files or records are dropped unless modified in app'''
+
+        if not self.manifest:
+            if self.notes or not self.load_snapshot ():
+                self.load_manifest ()
+
+        on_disk = [note_file for note_file in listdir_nohidden (self.path) if note_file_re.match (note_file)]
+        file_hndl, changed = self.pull_files (on_disk, set (self.manifest.keys ()) - set (on_disk))
+
+        #print (file_hndl)
+        print ("Pulled from storage.")
+        return file_hndl
+
+    def pull_files (self, note_files, gone = ()):
+        '''Pull given note files (see Pull_From_Disk), notes of files in gone are dropped
+        Return (records of in-app modified notes by file, timestamps of notes added, changed or removed)'''
+
+        file_hndl = {}
+        loaded    = set (note.timestamp for note in self.notes)
+        vanished  = set ()
+        pulled    = set ()
+        new_recs  = {}
+        changed   = set ()
+
+        for note_file in note_files:
+            entry = self.check_note_file (note_file, loaded)
+            if entry is None:
+                continue
+
+            filename = os.path.join (self.path, note_file)
+            records  = read_note_file (filename)
+            #print (records)
+
+            for rec in records:
+                found = self.get_note (rec['timestamp'])
+                #print (f"{rec['timestamp']} - {rec['tags']}")
+                if found is not None:
+                    if found.dirty:
+                        found.prefer_idx = self.find_note (found.timestamp) + 1
+                        if note_file not in file_hndl:
+                            file_hndl [note_file] = {}
+                        file_hndl [note_file][found.timestamp] = (found.dict, not found.deleted)
+                    else:
+                        if (found.content != rec['content'] or found.color != rec['color'] or
+                            set (found.tags) != set (rec['tags']) or set (found.labels) != set (rec['labels'])):
+                            changed.add (found.timestamp)
+                        self.update_note (found, rec)
+                else:
+                    new_recs [rec['timestamp']] = rec
+                entry ['timestamps'].append (rec['timestamp'])
+
+            trace.add (items = len (entry['timestamps']), bytes_read = entry['size'])
+            if note_file in self.manifest:
+                vanished.update (self.manifest[note_file]['timestamps'])
+            pulled.update (entry['timestamps'])
+            self.manifest [note_file] = entry
+
+        self.add_notes (list (new_recs.values ()))
+        changed.update (new_recs.keys ())
+
+        for note_file in gone:
+            if note_file in self.manifest:
+                vanished.update (self.manifest[note_file]['timestamps'])
+                del self.manifest [note_file]
+
+        for timestamp in vanished - pulled:
+            found_idx = self.find_note (timestamp)
+            if found_idx is not None and not self.notes[found_idx].dirty:
+                self.remove_note (found_idx, delete = True)
+                changed.add (timestamp)
+
+        return file_hndl, changed
+
+    @trace.traced ('Reload')
+    def Reload (self, note_files):
+        '''Pull only given note files (all if None), e.g. the ones a Watcher saw changing
+        In-app modified notes are kept, they are written by autosave or next Refresh
+        Return timestamps of notes added, changed or removed'''
+
+        with self.io_lock:
+            if not self.manifest:
+                self.load_manifest ()
+            if note_files is None:
+                note_files = set (fn for fn in listdir_nohidden (self.path) if note_file_re.match (fn)) | set (self.manifest.keys ())
+            note_files = set (note_files)
+            on_disk    = set (fn for fn in note_files if os.path.isfile (os.path.join (self.path, fn)))
+            file_hndl, changed = self.pull_files (sorted (on_disk), note_files - on_disk)
+            self.save_manifest ()
+        return changed
+
+    @trace.traced ('Sync')
+    def Sync (self, file_records = dict(), delete_sync = False):
+        '''Check and resolve note, tags, labels and index coherency
+        It appends in-app modified version of notes'''
+
+        file_hndl = file_records
+
+        i = 0
+        l = len (self.notes)
+        while i < l:
+            note = self.notes[i]
+            #print (f"{i}: {note.dict}")
+            if note.dirty or (note.prefer_idx != i + 1):
+                filename = note_file_name (note.timestamp)
+                #print (f"{note.timestamp} -> {filename}")
+                if filename not in file_hndl:
+                    file_hndl [filename] = {}
+                note.prefer_idx = i + 1
+                file_hndl [filename][note.timestamp] = (note.dict, not note.deleted)
+
+                if note.deleted:
+                    self.remove_note (i, delete = delete_sync)
+                    i += (1 if not delete_sync else 0)
+                    if delete_sync:
+                        l = len (self.notes)
+                else:
+                    i += 1
+
+            else:
+                i += 1
+        trace.add (items = len (self.notes))
+        print ("Synced notes.")
+        return file_hndl
+
+    @trace.traced ('Push')
+    def Push_To_Disk (self, file_records):
+        '''Push modified version of notes to disk'''
+
+        file_hndl = file_records
+
+        with self.io_lock:
+            for fn, records in file_hndl.items():
+                self.write_records (fn, records)
+
+            self.save_manifest ()
+        print ("Write-back done.")
+
+    def write_records (self, fn, records):
+        '''Write records {timestamp: (record, keep)} into note file fn and update its manifest entry
+        Caller holds io_lock, return value is the one of write_note_file'''
+
+        filename   = os.path.join (self.path, fn)
+        timestamps = set (self.manifest[fn]['timestamps']) if fn in self.manifest else set ()
+        for timestamp, (rec, keep) in records.items ():
+            if keep:
+                timestamps.add (timestamp)
+            else:
+                timestamps.discard (timestamp)
+
+        written = write_note_file (filename, records)
+        if written != 'unchanged':
+            trace.add (items = 1)
+
+        if written == 'unchanged' and fn in self.manifest:
+            self.manifest [fn]['timestamps'] = sorted (timestamps)
+        elif os.path.isfile (filename):
+            st = os.stat (filename)
+            self.manifest [fn] = {'mtime': st.st_mtime_ns, 'size': st.st_size,
+                                  'hash': file_digest (filename), 'timestamps': sorted (timestamps)}
+        elif fn in self.manifest:
+            del self.manifest [fn]
+        return written
+
+    def Refresh (self):
+        with self.io_lock:
+            file_records = self.Pull_From_Disk ()
+            #print (file_records)
+            #for note in self.notes:
+            #    print (note)
+            file_records = self.Sync (file_records, delete_sync = True)
+            #for note in self.notes:
+            #    print (note)
+            #print (file_records)
+            self.Push_To_Disk (file_records)
+            self.save_snapshot ()
+            self.refreshes += 1
+
+    def mark_dirty (self, note, delete = False):
+        '''Mark note as modified in app and tell on_dirty (e.g. autosave) about it'''
+        note.set_dirty (delete = delete)
+        if self.on_dirty is not None:
+            self.on_dirty (note)
+
+    def reindex (self):
+        '''Rebuild positions of notes from the first stale one'''
+        if self._idx_from is not None:
+            for i in range (self._idx_from, len (self.notes)):
+                self._idx [self.notes[i].timestamp] = i
+            self._idx_from = None
+
+    def invalidate_index (self, idx = 0):
+        if self._idx_from is None or idx < self._idx_from:
+            self._idx_from = idx
+
+    def count_note (self, note):
+        for t in note.tags:
+            if t not in self.tags:
+                self.tags [t] = 1
+            else:
+                self.tags [t] += 1
+
+        for l in note.labels:
+            lbl = l.split ('/')
+            self.add_lbl (self.labels, lbl)
+
+        if self._query_idx_ready:
+            self.index_note (note)
+
+    def uncount_note (self, note):
+        for t in note.tags:
+            if t in self.tags:
+                if self.tags[t] > 1:
+                    self.tags[t] -= 1
+                else:
+                    del self.tags[t]
+        for lbl in note.labels:
+            lbls = lbl.split ('/')
+            self.remove_lbl (self.labels, lbls)
+
+        if self._query_idx_ready:
+            self.unindex_note (note)
+
+    @staticmethod
+    def label_paths (note):
+        '''Lowercased labels of note and all of their ancestors'''
+        return dsl.label_paths (note.labels)
+
+    def index_note (self, note):
+        for t in note.tags:
+            self._tag_idx.setdefault (t.lower (), set ()).add (note.timestamp)
+        for path in self.label_paths (note):
+            self._lbl_idx.setdefault (path, set ()).add (note.timestamp)
+        if self._ft_idx_ready:
+            self.index_text (note)
+
+    def index_text (self, note):
+        text = dsl.normalize_content (note.content)
+        self._ft_text [note.timestamp] = text
+        for token in set (dsl.content_tokens (text)):
+            self._ft_idx.setdefault (token, set ()).add (note.timestamp)
+
+    def unindex_note (self, note):
+        text = self._ft_text.pop (note.timestamp, None)
+        for idx, keys in ((self._tag_idx, set (t.lower () for t in note.tags)),
+                          (self._lbl_idx, self.label_paths (note)),
+                          (self._ft_idx, set (dsl.content_tokens (text)) if text is not None else ())):
+            for k in keys:
+                ids = idx.get (k)
+                if ids is not None:
+                    ids.discard (note.timestamp)
+                    if not ids:
+                        del idx [k]
+
+    def build_query_index (self, full_text = False):
+        '''Inverted indexes are built on first query, then kept up to date by count/uncount_note
+        Full-text index costs most, it is only built once content queries repeat (see content_ids)'''
+        if not self._query_idx_ready:
+            self._tag_idx = {}
+            self._lbl_idx = {}
+            self._ft_idx  = {}
+            self._ft_text = {}
+            self._ft_idx_ready = False
+            for note in self.notes:
+                if not note.deleted:
+                    self.index_note (note)
+            self._query_idx_ready = True
+        if full_text and not self._ft_idx_ready:
+            for note in self.notes:
+                if not note.deleted:
+                    self.index_text (note)
+            self._ft_idx_ready = True
+
+    def all_ids (self):
+        return self._by_ts.keys ()
+
+    def tag_ids (self, tag):
+        self.build_query_index ()
+        return self._tag_idx.get (tag.lower (), set ())
+
+    def label_ids (self, label):
+        '''Notes labelled with label or any of its sub-labels'''
+        self.build_query_index ()
+        return self._lbl_idx.get (label.lower (), set ())
+
+    def content_ids (self, text):
+        '''Notes containing text, candidates come from token postings then are verified on normalized content'''
+        text = dsl.normalize_content (text)
+        if not self._ft_idx_ready and self._ft_scans < FT_INDEX_AFTER:
+            # A one-off query (e.g. from CLI) is cheaper as a scan than building the index
+            self._ft_scans += 1
+            return set (note.timestamp for note in self.notes
+                        if not note.deleted and text in dsl.normalize_content (note.content))
+        self.build_query_index (full_text = True)
+        tokens = dsl.content_tokens (text, bounds = True)
+
+        candidates = None
+        for token, whole in sorted (tokens, key = lambda t: not t[1]): # whole words are cheapest, go first
+            if whole:
+                ids = self._ft_idx.get (token, set ())
+            else: # token may be part of a longer word in note
+                ids = set ()
+                for word, word_ids in self._ft_idx.items ():
+                    if token in word:
+                        ids |= word_ids
+            candidates = set (ids) if candidates is None else candidates & ids
+            if not candidates:
+                return set ()
+
+        if candidates is None: # no word in text, check all
+            candidates = self._ft_text.keys ()
+        return set (ts for ts in candidates if text in self._ft_text [ts])
+
+    def remove_note (self, idx, delete = False):
+        if delete:
+            note = self.notes.pop (idx)
+            if self._by_ts.get (note.timestamp) is note:
+                del self._by_ts [note.timestamp]
+                self._idx.pop (note.timestamp, None)
+            self.invalidate_index (idx)
+        else:
+            note = self.notes [idx]
+
+        self.uncount_note (note)
+
+        return note
+
+    def get_note (self, timestamp):
+        return self._by_ts.get (timestamp)
+
+    def find_note (self, timestamp):
+        if timestamp not in self._by_ts:
+            return None
+        self.reindex ()
+        return self._idx.get (timestamp)
+
+    def swap_notes (self, idx1, idx2):
+        note1 = self.notes [idx1]
+        note2 = self.notes [idx2]
+        self.notes [idx1] = note2
+        self.notes [idx2] = note1
+        if self._idx.get (note1.timestamp) == idx1 and self._idx.get (note2.timestamp) == idx2:
+            self._idx [note1.timestamp] = idx2
+            self._idx [note2.timestamp] = idx1
+        else:
+            self.invalidate_index (min (idx1, idx2))
+
+    def remove_lbl (self, lbl_dict, lbl):
+        #print (lbl)
+        if lbl [0] in lbl_dict:
+            if lbl_dict[lbl[0]]['count'] > 0:
+                lbl_dict[lbl[0]]['count'] -= 1
+                if len (lbl) > 1:
+                    self.remove_lbl (lbl_dict[lbl[0]]['children'], lbl [1:])
+            else:
+                del (lbl_dict[lbl[0]])
+
+    def add_lbl (self, lbl_dict, lbl):
+        if lbl[0] not in lbl_dict:
+            lbl_dict[lbl[0]] = {'count': 1, 'children': {}}
+        else:
+            lbl_dict[lbl[0]]['count'] += 1
+        if len (lbl) > 1:
+            self.add_lbl (lbl_dict[lbl[0]]['children'], lbl [1:])
+
+    def update_note (self, note_or_idx, note_info, set_dirty = False):
+        if isinstance (note_info, Note):
+            rec = note_info.dict
+        else:
+            rec = note_info
+
+        if isinstance (note_or_idx, Note):
+            idx = self.find_note (note_or_idx.timestamp)
+            if idx is None or self.notes [idx] is not note_or_idx:
+                idx = self.notes.index (note_or_idx)
+        else:
+            idx = note_or_idx
+
+        self.remove_note (idx, delete = False)
+
+        note = self.notes [idx]
+        old_timestamp = note.timestamp
+        note.set (rec)
+
+        if note.timestamp != old_timestamp:
+            if self._by_ts.get (old_timestamp) is note:
+                del self._by_ts [old_timestamp]
+                self._idx.pop (old_timestamp, None)
+            self._by_ts [note.timestamp] = note
+            self._idx [note.timestamp] = idx
+            self.moved_timestamps [old_timestamp] = note.timestamp
+
+        self.count_note (note)
+        if set_dirty:
+            self.mark_dirty (note)
+
+    def add_note (self, note_info, set_dirty = False):
+        note = Note ()
+        note.set (note_info)
+
+        if note.prefer_idx == 0: # undefined
+            self.notes.append (note)
+            i = len (self.notes) - 1
+            self._idx [note.timestamp] = i
+        else:
+            i = 0
+            l = len(self.notes)
+            while i < l and self.notes[i].prefer_idx > 0 and self.notes[i].prefer_idx < note.prefer_idx:
+                i += 1
+            self.notes.insert (i, note)
+            self.invalidate_index (i)
+        self._by_ts [note.timestamp] = note
+
+        self.count_note (note)
+        if set_dirty:
+            self.mark_dirty (note)
+
+    def add_notes (self, notes_info, set_dirty = False):
+        '''Add many notes at once, same placement as add_note but merged in a single pass'''
+
+        # Head of list (before first undefined index) must be ordered to merge
+        k = 0
+        l = len (self.notes)
+        while k < l and self.notes[k].prefer_idx > 0:
+            if k > 0 and self.notes[k].prefer_idx < self.notes[k - 1].prefer_idx:
+                for note_info in notes_info:
+                    self.add_note (note_info, set_dirty = set_dirty)
+                return
+            k += 1
+
+        ordered   = []
+        unordered = []
+        for note_info in notes_info:
+            note = Note ()
+            note.set (note_info)
+            (ordered if note.prefer_idx > 0 else unordered).append (note)
+            self._by_ts [note.timestamp] = note
+            self.count_note (note)
+        ordered.sort (key = lambda n: n.prefer_idx)
+
+        merged = []
+        i = j = 0
+        while i < k and j < len (ordered):
+            if ordered[j].prefer_idx <= self.notes[i].prefer_idx:
+                merged.append (ordered[j])
+                j += 1
+            else:
+                merged.append (self.notes[i])
+                i += 1
+        merged.extend (self.notes[i:k])
+        merged.extend (ordered[j:])
+
+        self.notes [:k] = merged
+        self.notes.extend (unordered)
+        self.invalidate_index (0)
+
+        if set_dirty:
+            for note in ordered + unordered:
+                self.mark_dirty (note)
+
+    def Create_random_notes (self, name_prf = '', num = 10):
+        timestamp = int (time.time ())
+        for i in range (num):
+            while timestamp in self._by_ts:
+                timestamp += 1
+            note = Note(timestamp = timestamp,
+                        content = f"# {name_prf}{i} Test note {i}\n\n" + "Test note " * random.randrange (2, 240, 2))
+            self.add_note (note)
+
+if __name__ == '__main__':
+    pass
@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 
-import ply.lex as lex
+import os
 import re
+import sys
+from functools import lru_cache
+
+LEXTAB     = 'mdnoteman_lextab' # lexer tables cached by ply next to this file, see get_lexer
+LEXTAB_DIR = os.path.dirname (os.path.abspath (__file__))
 
 # Token definitions
 tokens = (
@@ -54,7 +59,7 @@ def t_IDEN (t):
     return t
 
 def t_CTN (t):
-    r'["\'](\b.+\b)+["\']'
+    r'["\']\b.+\b["\']'
     t.type = 'CTN'
     return t
 
@@ -63,7 +68,29 @@ def t_error(t):
     print("Illegal character '%s'" % t.value[0])
     t.lexer.skip(1)
 
-lexer = lex.lex ()
+_lexer = None
+
+def get_lexer ():
+    '''Lexer is built on first query (not at import), from tables cached in LEXTAB when they are
+    newer than the rules above. Building by reflection reads and checks this whole file'''
+    global _lexer
+
+    if _lexer is None:
+        import ply.lex as lex
+
+        tab = os.path.join (LEXTAB_DIR, LEXTAB + '.py')
+        try:
+            if os.path.getmtime (tab) < os.path.getmtime (__file__):
+                os.remove (tab) # rules changed
+        except OSError:
+            pass
+        _lexer = lex.lex (module = sys.modules [__name__], optimize = True, lextab = LEXTAB, outputdir = LEXTAB_DIR)
+    return _lexer
+
+def __getattr__ (name):
+    if name == 'lexer':
+        return get_lexer ()
+    raise AttributeError (f"module {__name__!r} has no attribute {name!r}")
 
 class Node():
     def __init__ (self, type, value = False, children = None):
@@ -187,8 +214,10 @@ class EqlNode (Node):
             self._value = False
             if self._children[0].type == 'LABEL':
                 if 'labels' in kwargs:
+                    value = self._children[0].value.lower()
                     for lbl in kwargs['labels']:
-                        if self._children[0].value.lower() == lbl.lower():
+                        lbl = lbl.lower()
+                        if value == lbl or lbl.startswith (value + '/'): # sub-labels belong to label
                            self._value = True
                            break
             elif self._children[0].type == 'TAG':
@@ -201,7 +230,7 @@ class EqlNode (Node):
                            break
             elif self._children[0].type == 'CTN':
                 if 'ctn' in kwargs:
-                    self._value = re.sub(' +', ' ', self._children[0].value.casefold()) in  re.sub(' +', ' ', kwargs['ctn'].casefold())
+                    self._value = content_match (self._children[0].value, kwargs['ctn'])
             else:
                 raise ValueError ("Invald AST - Invalid type %s in EQL node" %(self._children[0]))
         else:
@@ -215,6 +244,236 @@ class EqlNode (Node):
         else:
             return False
 
+spaces_re = re.compile (' {2,}')
+
+def normalize_content (text):
+    text = text.casefold ()
+    if '  ' in text: # rare, skip the regex pass otherwise
+        text = spaces_re.sub (' ', text)
+    return text
+
+def content_match (text, content):
+    return normalize_content (text) in normalize_content (content)
+
+word_re = re.compile (r'\w+')
+
+def content_tokens (text, bounds = False):
+    '''Words of normalized text. With bounds, also tell if each word is whole,
+    i.e. not at an edge of text where it may continue into a longer word'''
+    if not bounds:
+        return word_re.findall (text)
+    tokens = []
+    for m in word_re.finditer (text):
+        tokens.append ((m.group (), m.start () > 0 and m.end () < len (text)))
+    return tokens
+
+def select (node, index):
+    '''Evaluate AST as set algebra over an index of notes, return ids of matched notes
+    index provides all_ids (), tag_ids (tag), label_ids (label), content_ids (text) and get_note (id)
+    Returned set may belong to the index, do not modify it'''
+    return Query (str (node), node).select (index)
+
+# Relative cost of evaluating a term, cheap terms go first in AND/OR
+COST = {'ALL': 0, 'TAGS': 1, 'LABELS': 2, 'CTN': 20}
+
+class PlanError (ValueError):
+    '''Query parsed but its AST can not be evaluated, e.g. an operator without operand
+    Node.analyze fails on these too, as soon as it reaches the faulty node'''
+
+def plan_cost (plan):
+    if plan[0] in ('AND', 'OR'):
+        return sum (plan_cost (p) for p in plan[1])
+    if plan[0] == 'NOT':
+        return plan_cost (plan[1]) + 1
+    return COST [plan[0]]
+
+def make_plan (node):
+    '''Flatten AST into nested tuples with lowercased constants:
+    ('ALL',), ('TAGS', frozenset), ('LABELS', frozenset), ('CTN', text),
+    ('NOT', plan), ('AND', [plans]) and ('OR', [plans]) ordered by cost'''
+
+    if node.type == 'EQL':
+        if len (node._children) != 1:
+            raise PlanError ("Invald AST - EQL must have only 1 child node")
+        term = node._children[0]
+        if term.type == 'TAG':
+            if term.value.lower() == 'all':
+                return ('ALL',)
+            return ('TAGS', frozenset ([term.value.lower ()]))
+        if term.type == 'LABEL':
+            return ('LABELS', frozenset ([term.value.lower ()]))
+        if term.type == 'CTN':
+            return ('CTN', normalize_content (term.value))
+        raise PlanError ("Invald AST - Invalid type %s in EQL node" %(term))
+
+    if node.type == 'NOT':
+        if len (node._children) != 1:
+            raise PlanError ("Invald AST - NOT must have only 1 child node")
+        return ('NOT', make_plan (node._children[0]))
+
+    if node.type not in ('AND', 'OR'):
+        raise PlanError ("Invald AST - Unknown node %s" %(node.type))
+    if len (node._children) == 0:
+        raise PlanError ("Invald AST - %s must have at least 1 child node" %(node.type))
+
+    plans = []
+    for child in node._children:
+        plan = make_plan (child)
+        if plan[0] == node.type: # nested node of same type
+            plans.extend (plan[1])
+        else:
+            plans.append (plan)
+    if node.type == 'OR':
+        if ('ALL',) in plans:
+            return ('ALL',)
+        merged = []
+        for kind in ('TAGS', 'LABELS'): # tags a, b, c -> one membership test
+            values = [p[1] for p in plans if p[0] == kind]
+            if values:
+                merged.append ((kind, frozenset ().union (*values)))
+        plans = merged + [p for p in plans if p[0] not in ('TAGS', 'LABELS')]
+    else:
+        plans = [p for p in plans if p != ('ALL',)] or [('ALL',)]
+    if len (plans) == 1:
+        return plans[0]
+    plans.sort (key = plan_cost)
+    return (node.type, plans)
+
+def label_paths (labels):
+    '''Lowercased labels and all of their ancestors'''
+    paths = set ()
+    for l in labels:
+        lbl = l.lower ().split ('/')
+        for i in range (1, len (lbl) + 1):
+            paths.add ('/'.join (lbl[:i]))
+    return paths
+
+def make_predicate (plan):
+    '''Compile plan into a function of a Subject'''
+    kind = plan[0]
+    if kind == 'ALL':
+        return lambda subj: True
+    if kind == 'TAGS':
+        values = plan[1]
+        return lambda subj: not values.isdisjoint (subj.tags)
+    if kind == 'LABELS':
+        values = plan[1]
+        return lambda subj: not values.isdisjoint (subj.labels)
+    if kind == 'CTN':
+        text = plan[1]
+        return lambda subj: text in subj.content
+    if kind == 'NOT':
+        pred = make_predicate (plan[1])
+        return lambda subj: not pred (subj)
+    preds = [make_predicate (p) for p in plan[1]]
+    if kind == 'AND':
+        return lambda subj: all (pred (subj) for pred in preds)
+    return lambda subj: any (pred (subj) for pred in preds)
+
+class Subject ():
+    '''Note fields as the predicates want them, each computed on first use'''
+    def __init__ (self, tags = (), labels = (), ctn = ''):
+        self._raw     = (tags, labels, ctn)
+        self._tags    = None
+        self._labels  = None
+        self._content = None
+
+    @property
+    def tags (self):
+        if self._tags is None:
+            self._tags = frozenset (t.lower () for t in self._raw[0])
+        return self._tags
+
+    @property
+    def labels (self):
+        if self._labels is None:
+            self._labels = frozenset (label_paths (self._raw[1]))
+        return self._labels
+
+    @property
+    def content (self):
+        if self._content is None:
+            self._content = normalize_content (self._raw[2])
+        return self._content
+
+class Query ():
+    '''Compiled query, match () tests one note and select () evaluates on an index'''
+    # Below this many candidates, AND checks remaining terms note by note
+    REFINE_LIMIT = 64
+
+    def __init__ (self, query_str, ast):
+        self.query_str = query_str
+        self.ast       = ast
+        self.plan      = make_plan (ast)
+        self._pred     = make_predicate (self.plan)
+
+    def __str__ (self):
+        return str (self.ast)
+
+    def match (self, tags = (), labels = (), ctn = ''):
+        return self._pred (Subject (tags, labels, ctn))
+
+    def select (self, index):
+        '''Ids of matched notes, index is as for select () plus get_note (id)
+        Returned set may belong to the index, do not modify it'''
+        return self._select (self.plan, index)
+
+    def _select (self, plan, index):
+        kind = plan[0]
+        if kind == 'ALL':
+            return set (index.all_ids ())
+        if kind == 'TAGS':
+            if len (plan[1]) == 1:
+                return index.tag_ids (next (iter (plan[1])))
+            return set ().union (*(index.tag_ids (v) for v in plan[1]))
+        if kind == 'LABELS':
+            if len (plan[1]) == 1:
+                return index.label_ids (next (iter (plan[1])))
+            return set ().union (*(index.label_ids (v) for v in plan[1]))
+        if kind == 'CTN':
+            return index.content_ids (plan[1])
+        if kind == 'NOT':
+            return index.all_ids () - self._select (plan[1], index)
+        if kind == 'OR':
+            ids = set ()
+            for p in plan[1]:
+                ids |= self._select (p, index)
+            return ids
+
+        # AND, terms are sorted by cost
+        ids = None
+        for n, p in enumerate (plan[1]):
+            if ids is not None and len (ids) <= self.REFINE_LIMIT:
+                # few candidates left, cheaper to test rest on the notes
+                pred = make_predicate (('AND', plan[1][n:]))
+                return set (i for i in ids if self._match_note (pred, index.get_note (i)))
+            if p[0] == 'NOT' and ids is not None:
+                ids = ids - self._select (p[1], index)
+            else:
+                child_ids = self._select (p, index)
+                ids = set (child_ids) if ids is None else ids & child_ids
+            if not ids:
+                break
+        return ids
+
+    @staticmethod
+    def _match_note (pred, note):
+        return note is not None and pred (Subject (note.tags, note.labels, note.content))
+
+def normalize_query (query_str):
+    return re.sub (r'\s+', ' ', query_str.strip ())
+
+@lru_cache (maxsize = 256)
+def _compile_query (query_str):
+    lexer = get_lexer ()
+    lexer.input (query_str)
+    return Query (query_str, build_ast (lexer))
+
+def compile_query (query_str):
+    '''Parse and compile query, plans of recent queries are reused
+    Raises ValueError on invalid query'''
+    return _compile_query (normalize_query (query_str))
+
 def build_ast (tokens, factor = None):
     stack      = [OrNode()]
     indent     = 0
@@ -242,7 +501,7 @@ def build_ast (tokens, factor = None):
                 #print (f"{tok.type} -> {tok.value}")
                 if tok.type == 'CTN':
                     _factor = None
-                    node = EqlNode ([Node(tok.type, tok.value)])
+                    node = EqlNode ([Node(tok.type, tok.value[1:-1])]) # strip quotes
                     if not stack[-1].acquire (node):
                         tmp_node = stack.pop ()
                         stack[-1].acquire (tmp_node)
@@ -286,6 +545,7 @@ def build_ast (tokens, factor = None):
     return reduced if reduced is not None else stack [0]
 
 def filter (query_str):
+    lexer = get_lexer ()
     lexer.input (query_str)
     return (build_ast(lexer))
 
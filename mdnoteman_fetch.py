@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+import sys
+if sys.hexversion < 0x03070000:
+    print("!!! This component requires Python version 3.7 at least !!!")
+    sys.exit(1)
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable
+from urllib.parse import urlparse, unquote
+from PIL import Image
+
+IMAGE_TIMEOUT   = 10           # seconds, connect and read
+IMAGE_MAX_BYTES = 32 * 1024 ** 2
+IMAGE_MAX_AGE   = 24 * 60 * 60 # seconds before a cached image is checked again
+TILES_MAX_BYTES = 32 * 1024 ** 2
+
+# ![alt](src), <img src="src"> and [ref]: src definitions of reference images
+image_src_re = re.compile (r'!\[[^\]]*\]\(\s*<?([^\s)>]+)'
+                           r'|<img\b[^>]*?\bsrc\s*=\s*["\']([^"\']+)'
+                           r'|^[ ]{0,3}\[[^\]]+\]:\s*<?([^\s>]+)', re.M | re.I)
+
+def is_remote (src):
+    return urlparse (src).scheme in ('http', 'https')
+
+def image_sources (text):
+    '''Sources of images markdown text may embed, link definitions included'''
+    return [inline or tag or ref for inline, tag, ref in image_src_re.findall (text)]
+
+def decode_tile (filename, max_width = None):
+    '''Decode image as RGBA at most max_width wide, large images are decoded
+    at reduced scale (JPEG draft, then reduce) before the final resample'''
+    img = Image.open (filename)
+    w, h = img.size
+    if max_width and w > max_width:
+        size = (max_width, int (max_width * (h / w)))
+        img.draft ('RGB', size) # JPEG only, picks a DCT scale still >= size
+        if img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            img = img.convert ('RGBA')
+        factor = min (img.size[0] // size[0], img.size[1] // max (size[1], 1))
+        if factor >= 2:
+            img = img.reduce (factor)
+        img = img.convert ('RGBA').resize (size, Image.LANCZOS)
+    else:
+        img = img.convert ('RGBA')
+    return img
+
+@dataclass
+class TileCache:
+    '''LRU of decoded images, bounded by their size in bytes'''
+    max_bytes : int = TILES_MAX_BYTES
+    nbytes    : int = 0
+    _tiles    : OrderedDict = field (default_factory = OrderedDict, repr = False)
+    _lock     : threading.Lock = field (default_factory = threading.Lock, repr = False)
+
+    def get (self, key):
+        with self._lock:
+            tile = self._tiles.get (key)
+            if tile is not None:
+                self._tiles.move_to_end (key)
+            return tile
+
+    def put (self, key, tile):
+        size = tile.size[0] * tile.size[1] * 4
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._tiles.pop (key, None)
+            if old is not None:
+                self.nbytes -= old.size[0] * old.size[1] * 4
+            self._tiles [key] = tile
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                k, t = self._tiles.popitem (last = False)
+                self.nbytes -= t.size[0] * t.size[1] * 4
+
+tiles = TileCache () # per process, shared by all stores
+
+@dataclass
+class ImageStore:
+    '''Resolves image sources of notes, remote images are read from a disk cache filled by ImageFetcher
+    Local paths are relative to base_path (the notebook folder). Picklable, so render workers can use it'''
+    path      : str   = None # cache folder
+    base_path : str   = None
+    max_age   : float = IMAGE_MAX_AGE
+
+    def local_path (self, src):
+        if src.startswith ('file:'):
+            src = unquote (urlparse (src).path)
+        src = os.path.expanduser (src)
+        if not os.path.isabs (src) and self.base_path:
+            src = os.path.join (self.base_path, src)
+        return src
+
+    def entry (self, src):
+        key = hashlib.sha1 (src.encode ()).hexdigest ()
+        return os.path.join (self.path, key[:2], key[2:])
+
+    def meta (self, src):
+        try:
+            with open (self.entry (src) + '.json', 'r') as f:
+                return json.load (f)
+        except (OSError, ValueError):
+            return None
+
+    def identity (self, src):
+        '''Version of image src as load would read it: mtime and size of local file or cached copy
+        A remote copy is only replaced when the image changed, revalidation keeps it'''
+        filename = self.entry (src) + '.img' if is_remote (src) else self.local_path (src)
+        try:
+            st = os.stat (filename)
+        except OSError:
+            return 'missing'
+        return f"{st.st_mtime_ns}:{st.st_size}"
+
+    def stale (self, meta):
+        return time.time () - meta.get ('checked', 0) > self.max_age
+
+    @staticmethod
+    def open (filename, max_width = None):
+        '''Downscaled tile of image file from tiles, decoded on a miss'''
+        st   = os.stat (filename)
+        key  = (filename, st.st_mtime_ns, st.st_size, max_width)
+        tile = tiles.get (key)
+        if tile is None:
+            tile = decode_tile (filename, max_width)
+            tiles.put (key, tile)
+        return tile
+
+    def load (self, src, max_width = None):
+        '''Image loader of Markdown_Ext, return (image or None, pending), image is read-only
+        pending is True when the image is not fetched yet, failed to fetch or is due to be checked again,
+        a card drawn with a pending image is not cached so it gets the image once a fetch succeeds'''
+        if not is_remote (src):
+            try:
+                return self.open (self.local_path (src), max_width), False
+            except (OSError, ValueError, Image.DecompressionBombError):
+                return None, False
+
+        meta = self.meta (src)
+        if meta is None:
+            return None, True
+        if meta.get ('status') != 'ok':
+            return None, True # retried no sooner than ImageFetcher.retry_after
+        try:
+            return self.open (self.entry (src) + '.img', max_width), self.stale (meta)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return None, True
+
+    def save (self, src, meta, data = None):
+        entry = self.entry (src)
+        os.makedirs (os.path.dirname (entry), exist_ok = True)
+        tmp = f"{entry}.{os.getpid ()}.{threading.get_ident ()}.tmp"
+        if data is not None:
+            with open (tmp, 'wb') as f:
+                f.write (data)
+            os.replace (tmp, entry + '.img')
+        with open (tmp, 'w') as f:
+            json.dump (meta, f)
+        os.replace (tmp, entry + '.json')
+
+    def fetch (self, src, timeout = IMAGE_TIMEOUT):
+        '''Download src into the cache, revalidating a cached copy with ETag / Last-Modified'''
+        import requests # only needed once a note links a remote image
+
+        old     = self.meta (src)
+        headers = {}
+        if old is not None and old.get ('status') == 'ok':
+            if old.get ('etag'):
+                headers ['If-None-Match'] = old ['etag']
+            if old.get ('last_modified'):
+                headers ['If-Modified-Since'] = old ['last_modified']
+
+        meta = {'src': src, 'checked': time.time ()}
+        try:
+            with requests.get (src, headers = headers, stream = True, timeout = timeout) as rsp:
+                if rsp.status_code == 304:
+                    self.save (src, dict (old, checked = meta ['checked']))
+                    return True
+                rsp.raise_for_status ()
+                chunks = []
+                size   = 0
+                for chunk in rsp.iter_content (64 * 1024):
+                    size += len (chunk)
+                    if size > IMAGE_MAX_BYTES:
+                        raise ValueError ("image larger than %d bytes" %(IMAGE_MAX_BYTES))
+                    chunks.append (chunk)
+                meta.update (status = 'ok',
+                             etag = rsp.headers.get ('ETag'),
+                             last_modified = rsp.headers.get ('Last-Modified'))
+                self.save (src, meta, b''.join (chunks))
+                return True
+        except (requests.RequestException, ValueError) as err:
+            print (f"Can not fetch image {src} - {err}")
+            meta.update (status = 'failed', error = str (err))
+        except OSError as err:
+            print (f"Can not cache image {src} - {err}")
+            return False
+        try:
+            self.save (src, meta)
+        except OSError as err:
+            print (f"Can not cache image {src} - {err}")
+        return False
+
+@dataclass
+class ImageFetcher:
+    '''Downloads remote images in a small thread pool, on_ready (src) is called from the fetching thread'''
+    store    : ImageStore = None
+    workers  : int        = 4
+    timeout  : float      = IMAGE_TIMEOUT
+    on_ready : Callable   = None
+    retry_after : float   = 60 # seconds before a source is fetched again
+    _executor : ThreadPoolExecutor = field (default = None, repr = False)
+    _pending  : set = field (default_factory = lambda: set (), repr = False)
+    _done     : dict = field (default_factory = lambda: {}, repr = False) # source -> time of last fetch
+    _lock     : threading.Lock = field (default_factory = threading.Lock, repr = False)
+
+    def request (self, src):
+        '''Fetch src in background unless it is already on its way'''
+        with self._lock:
+            if src in self._pending or time.time () - self._done.get (src, 0) < self.retry_after:
+                return
+            self._pending.add (src)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor (max_workers = self.workers, thread_name_prefix = 'fetch')
+            self._executor.submit (self._fetch, src)
+
+    def _fetch (self, src):
+        try:
+            self.store.fetch (src, self.timeout)
+        finally:
+            with self._lock:
+                self._pending.discard (src)
+                self._done [src] = time.time ()
+        if self.on_ready:
+            self.on_ready (src)
+
+    def shutdown (self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            if sys.hexversion >= 0x03090000:
+                executor.shutdown (wait = False, cancel_futures = True)
+            else:
+                executor.shutdown (wait = False)
+
+if __name__ == '__main__':
+    pass
@@ -5,16 +5,17 @@ if sys.hexversion < 0x03070000:
     print("!!! This component requires Python version 3.7 at least !!!")
     sys.exit(1)
 
-import markdown
 import FreeSimpleGUI as sg
 import tkinter as tk
 import base64
+import io
+import os
 import re
 import time
 
 from fsg_calendar import Calendar
-from tkhtmlview import html_parser
 from mdnoteman_pkm import Note, Notebook, CardBox
+import mdnoteman_trace as trace
 from dataclasses import dataclass, field
 from typing import List, Dict, Set
 from copy import copy
@@ -22,26 +23,60 @@ from copy import copy
 debug = False
 window        = None
 window_stack  = []
+trace_shown   = 0 # tracer version in Info summary
+profiler      = None # EventProfiler timing handled events, see mdnoteman_profile
 cal           = Calendar (key_prefix = "Cal")
 
-assets = {}
-
-with open ("assets/head.png", "rb") as ico:
-    assets['win_ico'] = base64.b64encode(ico.read())
-with open ("assets/refresh.png", "rb") as ico:
-    assets['refresh_ico'] = base64.b64encode(ico.read())
-with open ("assets/notes.png", "rb") as ico:
-    assets['note_ico'] = base64.b64encode(ico.read())
-with open ("assets/knowledge-graph.png", "rb") as ico:
-    assets['graph_ico'] = base64.b64encode(ico.read())
-with open ("assets/trash-bin.png", "rb") as ico:
-    assets['trashbin_ico'] = base64.b64encode(ico.read())
-with open ("assets/building-plan.png", "rb") as ico:
-    assets['drawing_ico'] = base64.b64encode(ico.read())
-with open ("assets/color.png", "rb") as ico:
-    assets['color_ico'] = base64.b64encode(ico.read())
-with open ("assets/picture.png", "rb") as ico:
-    assets['picture_ico'] = base64.b64encode(ico.read())
+# Icons are drawn this many times smaller than their file in assets/, window icon at full size
+ICONS = {'win_ico'     : ('head.png', 1),
+         'refresh_ico' : ('refresh.png', 15),
+         'note_ico'    : ('notes.png', 15),
+         'graph_ico'   : ('knowledge-graph.png', 15),
+         'trashbin_ico': ('trash-bin.png', 16),
+         'drawing_ico' : ('building-plan.png', 16),
+         'color_ico'   : ('color.png', 15),
+         'picture_ico' : ('picture.png', 15)}
+
+assets     = {} # icon name -> base64 PNG at display size, filled on first use
+icon_cache = None # folder of scaled icons, set by create_gui
+
+def scale_icon (filename, subsample):
+    '''PNG of assets/filename shrunk as Tk image_subsample would, read from icon_cache once it was made'''
+    src    = os.path.join ('assets', filename)
+    if subsample == 1:
+        with open (src, 'rb') as f:
+            return f.read ()
+    cached = None
+    if icon_cache:
+        cached = os.path.join (icon_cache, f"{os.path.splitext (filename)[0]}-{subsample}.png")
+        try:
+            if os.path.getmtime (cached) >= os.path.getmtime (src):
+                with open (cached, 'rb') as f:
+                    return f.read ()
+        except OSError:
+            pass
+
+    from PIL import Image
+
+    with Image.open (src) as img:
+        size = (-(-img.size[0] // subsample), -(-img.size[1] // subsample))
+        bio  = io.BytesIO ()
+        img.convert ('RGBA').resize (size, Image.LANCZOS).save (bio, format = 'PNG')
+    data = bio.getvalue ()
+    if cached:
+        try:
+            os.makedirs (icon_cache, exist_ok = True)
+            with open (cached + '.tmp', 'wb') as f:
+                f.write (data)
+            os.replace (cached + '.tmp', cached)
+        except OSError as err:
+            print (f"Can not cache icon {cached} - {err}")
+    return data
+
+def icon (name):
+    if name not in assets:
+        assets [name] = base64.b64encode (scale_icon (*ICONS [name]))
+    return assets [name]
 
 def flush_events ():
     global window_stack
@@ -78,6 +113,8 @@ def pop_nested_window (_win = None):
             window_stack[-1][0].read (10) # Flush event read before back to previous window
 
 def set_html (widget, html, strip = True):
+    from tkhtmlview import html_parser # only once a note is previewed
+
     parser = html_parser.HTMLTextParser()
     prev_state = widget.cget('state')
     widget.config(state=sg.tk.NORMAL)
@@ -110,7 +147,7 @@ def make_main_window (cal, label_tree = None, tags = None, notes = None):
 
     menu_def = [['&Notebook', ['&Open::menu', '---', 'E&xit::menu']],
                 ['&Edit', ['Copy (&C)::menu', 'Cut (&X)::menu', 'Paste (&V)::menu', '&Undo::menu', '&Redo::menu']],
-                ['T&ool', ['Settings::menu']],
+                ['T&ool', ['Settings::menu', 'Dump trace::menu']],
                 ['&Help', ['&About...::menu']]]
 
     mene_elem  = sg.Menu (menu_def)
@@ -147,27 +184,28 @@ def make_main_window (cal, label_tree = None, tags = None, notes = None):
                         orientation = 'horizontal', expand_x = True, expand_y = True, key = '-PANE-', relief = 'groove', show_handle = False)
 
     main_layout =  [[sg.Menu (menu_def)]]
-    main_layout += [[sg.Button ('', image_source = assets['note_ico'], border_width = 1, image_subsample = 15,
+    main_layout += [[sg.Button ('', image_source = icon ('note_ico'), border_width = 1,
                                 button_color = (sg.theme_background_color(), sg.theme_background_color ()),
                                 key = '-BTN-NOTE-'),
                      sg.Input (key = '-SEARCH-', expand_x = True,
                                default_text = 'Search query', do_not_clear = True),
-                     sg.Button ('',image_source = assets['graph_ico'], border_width = 1, image_subsample = 15,
+                     sg.Button ('',image_source = icon ('graph_ico'), border_width = 1,
                                 button_color = (sg.theme_background_color(), sg.theme_background_color ()),
                                 key = '-BTN-GRAPH-'),
-                     sg.Button ('', image_source = assets['refresh_ico'], border_width = 1, image_subsample = 15,
+                     sg.Button ('', image_source = icon ('refresh_ico'), border_width = 1,
                                 button_color = (sg.theme_background_color(), sg.theme_background_color ()),
                                 key = '-BTN-REFRESH-')]]
     main_layout += [[main_pane]]
     main_layout += [[sg.Frame ("Info", layout = [[sg.Multiline (key = '-INFO-', expand_x = True, disabled = True,
                                                                 size = (None, 2), write_only = True,
-                                                                reroute_stdout = not debug, autoscroll = True)]],
+                                                                reroute_stdout = not debug, autoscroll = True)],
+                                                 [sg.Text ('', key = '-TRACE-', expand_x = True, font = ("default", 10, 'normal'))]],
                                expand_x = True)]]
 
     win = sg.Window('MD Note Manager', main_layout, finalize = True,
                     use_default_focus = True, grab_anywhere_using_control = True,
                     resizable = True, use_ttk_buttons = True,
-                    ttk_theme = sg.DEFAULT_TTK_THEME, icon = assets['win_ico'])
+                    ttk_theme = sg.DEFAULT_TTK_THEME, icon = icon ('win_ico'))
     push_nested_window (win, False)
 
     rwidth = win['-RIGHT_PANE-'].get_size()[0]
@@ -213,7 +251,11 @@ def create_gui (cfg, label_tree = None):
     global cal
     global cardbox
 
+    global icon_cache
+
     theme = cfg ['Appearance']['Theme']
+    if 'Cache' in cfg:
+        icon_cache = os.path.join (cfg ['Cache']['Path'], 'icons')
 
     sg.theme(theme)
     font = ("default", 15, 'normal')
@@ -291,7 +333,7 @@ def call_tags_chooser_window (title, tags, selected_tags, relax_list_order = Fal
     _win = sg.Window ('', layout = layout, modal = True,
                       no_titlebar = True,
                       keep_on_top = True, location = (location[0], location[1] - 32),
-                      finalize = True, icon = assets['win_ico'],
+                      finalize = True, icon = icon ('win_ico'),
                       resizable = False)
     push_nested_window (_win, True)
     _win.bind ('<FocusOut>', 'LostFocus')
@@ -382,7 +424,7 @@ def call_color_chooser_window (color = None, location = None):
     _win = sg.Window ('', layout = cb, modal = True,
                       no_titlebar = True,
                       keep_on_top = True, location = (location[0], location[1] - 32),
-                      finalize = True, icon = assets['win_ico'],
+                      finalize = True, icon = icon ('win_ico'),
                       resizable = False)
     push_nested_window (_win, True)
     _win.bind ('<FocusOut>', 'LostFocus')
@@ -451,25 +493,24 @@ def call_edit_window (note = None):
 
     layout = [[sg.TabGroup([[sg.Tab('Markdown', md_layout, tooltip = 'Markdown format', key = '-EDT-TAB-'),
                              sg.Tab('Preview', preview_layout, tooltip = 'Preview', key = '-VIEW-TAB-')]], expand_x = True, expand_y = True, enable_events = True)],
-              [sg.Button (key = '-BTN-COLOR-', border_width = 1, image_source = assets['color_ico'],
-                          button_color = (color, color),
-                          image_subsample = 15, tooltip = "Change background color of note"),
+              [sg.Button (key = '-BTN-COLOR-', border_width = 1, image_source = icon ('color_ico'),
+                          button_color = (color, color), tooltip = "Change background color of note"),
                sg.Button ('Add labels'),
                sg.Button ('Add tags'),
-               sg.Button (key = '-BTN-DWG-', border_width = 1, image_source = assets['drawing_ico'],
+               sg.Button (key = '-BTN-DWG-', border_width = 1, image_source = icon ('drawing_ico'),
                           button_color = (sg.theme_background_color(), sg.theme_background_color ()),
-                          image_subsample = 16, tooltip = 'Add drawing to note'),
+                          tooltip = 'Add drawing to note'),
                sg.Push(),
-               sg.Button (key = '-BTN-DEL-', border_width = 1, image_source = assets['trashbin_ico'],
+               sg.Button (key = '-BTN-DEL-', border_width = 1, image_source = icon ('trashbin_ico'),
                           button_color = (sg.theme_background_color(), sg.theme_background_color ()),
-                          image_subsample = 16, tooltip = 'Delete note')],
+                          tooltip = 'Delete note')],
               [sg.Frame ("Assets", layout = [
                         [sg.Listbox(['nothing ...'], expand_x = True, key = '-EDT-ASSETS-')]
                     ], expand_x = True)],
               [sg.Push(), sg.Button ('Save & Close')]]
 
     _win = sg.Window ('Edit note', layout, modal = True, finalize = True, resizable = True,
-                      icon = assets['win_ico'], keep_on_top = True)
+                      icon = icon ('win_ico'), keep_on_top = True)
     push_nested_window (_win, True)
 
     _win.bind ('<Escape>', 'ESC')
@@ -487,6 +528,8 @@ def call_edit_window (note = None):
 
         if event == 0 and values[0] == '-VIEW-TAB-':
             #print (markdown.markdown (values['-EDT-NOTE-']))
+            import markdown
+
             set_html (_win['-VIEW-NOTE-'].Widget, markdown.markdown (values['-EDT-NOTE-']))
             continue
 
@@ -574,7 +617,7 @@ def make_theme_window (theme):
               [sg.Button('OK'), sg.Button('Exit')]]
 
     _win = sg.Window('Theme Browser', layout, modal = True, finalize = True,
-                     icon = assets['win_ico'])
+                     icon = icon ('win_ico'))
     push_nested_window (_win, True)
     return _win
 
@@ -648,10 +691,23 @@ lastxy      = None
 snap_lastxy = None
 in_drag     = False
 
+def update_trace_summary ():
+    global trace_shown
+
+    if trace.tracer.version != trace_shown:
+        trace_shown = trace.tracer.version
+        window ['-TRACE-'].update (value = trace.summary ())
+
 def handle (cb):
+    event, values = window.read(100)
+    if profiler is None:
+        return dispatch (event, values, cb)
+    with profiler.event (event):
+        return dispatch (event, values, cb)
+
+def dispatch (event, values, cb):
     global in_drag, dragging, start_point, drag_fig, lastxy, snap_lastxy
 
-    event, values = window.read(100)
     graph = window [(cardbox.name, "graph")]
 
     #if event not in (None, sg.TIMEOUT_KEY, '__TIMER EVENT__'):
@@ -692,6 +748,10 @@ def handle (cb):
         cb['open'] ()
         return True
 
+    if event == 'Dump trace::menu':
+        cb['trace'] ()
+        return True
+
     if event == 'Delete::fig_menu':
         cb['note'] (cmd = 'delete')
         return True
@@ -801,8 +861,20 @@ def handle (cb):
         cardbox.resize (values ['cardbox'])
         return True
 
+    if event == cardbox.image_event:
+        cardbox.image_ready (values [cardbox.image_event])
+        return True
+
+    if event == cardbox.watch_event:
+        if cardbox.reload_notes (values [cardbox.watch_event]):
+            update_show_tags   (cardbox.notebook.tags)
+            update_show_labels (cardbox.notebook.labels)
+        return True
+
     # Check periodically
     check_resize_cardbox ()
+    cardbox.update_viewport ()
+    update_trace_summary ()
 
     # Call sub-components's handles
     cal.handle (event, values)
@@ -6,430 +6,20 @@ if sys.hexversion < 0x03070000:
     sys.exit(1)
 
 from dataclasses import dataclass, field
-from typing import List, Dict, Set
-import random
+from typing import List, Dict
 import os
-import re
-from datetime import datetime
-from PIL import Image, ImageDraw, ImageFont
 import io
+from PIL import Image
 from copy import copy
 import FreeSimpleGUI as sg
 import fsg_extend as esg
 import mdnoteman_dsl as dsl
-from md2img import Markdown_Ext
-
-def listdir_nohidden (path):
-    return list(filter(lambda f: not f.startswith('.'), os.listdir(path)))
-
-def parse_note_file (path, upd_records = None):
-    records       = []
-    timestamp     = 0
-    new_timestamp = 0
-    content       = ''
-    color         = '#FFFFFF'
-    tags          = []
-    labels        = []
-    links         = []
-    prefer_idx    = 0
-    color_re      = re.compile(r"^\[color:[a-zA-Z0-9#]+\]\s*$")
-    idx_re        = re.compile(r"^\[idx:\d+\]\s*$")
-    timestamp_re  = re.compile(r"^@\[\d+\]$")
-    label_re      = re.compile(r'^[\s\t]*(@\b[^,|&!~\s|]+\b[\s\t]*)+$')
-    tag_re        = re.compile(r'^[\s\t]*(#\b[^,|&!~\s|]+\b[\s\t]*)+$')
-    link_re       = re.compile(r'\(\d+\)')
-
-    fulltxt = ''
-    is_tags_read       = False
-    is_labels_read     = False
-    is_color_read      = False
-    is_prefer_idx_read = False
-
-    def add_txtnote (timestamp, color, prefer_idx, tags, labels, content):
-        txt  = f"@[{timestamp}]\n"
-        txt += f"[color:{color}]\n"
-        txt += f"[idx:{prefer_idx}]\n"
-        if len(tags) > 0:
-            txt += '#' + ' #'.join(tags) + "\n"
-        if len(labels) > 0:
-            txt += '@' + ' @'.join(labels) + "\n"
-        txt += content + "\n"
-        txt += "\n"
-
-        return txt
-
-    #print (path)
-    if os.path.isfile (path):
-        f = open (path, 'r')
-        for line in f:
-            #print (line)
-            if timestamp_re.match(line):
-                if content != '' or len(labels) > 0 or len(tags) > 0:
-                    new_timestamp = int(line.strip()[2:-1])
-                    content = content.rstrip ('\n\t ')
-
-                    if upd_records is not None:
-                        if timestamp in upd_records:
-                            if upd_records[timestamp][1]: # if not deleted
-                                rec = upd_records [timestamp][0]
-                                fulltxt += add_txtnote (rec['timestamp'], rec['color'], rec['prefer_idx'], rec['tags'], rec['labels'], rec['content'])
-                            else: # if deleted, no write
-                                pass
-                            del upd_records [timestamp]
-                        else: # not updated, write old note
-                            fulltxt += add_txtnote (timestamp, color, prefer_idx, tags, labels, content)
-                            #print (fulltxt)
-                    else:
-                        records.append({'timestamp': timestamp, 'tags': list(set(tags)),
-                                        'content': content, 'labels': list(set(labels)),
-                                        'links': list(set(links)), 'color': color, 'prefer_idx': prefer_idx})
-
-                    labels     = []
-                    links      = []
-                    tags       = []
-                    color      = '#FFFFFF'
-                    content    = ''
-                    prefer_idx = 0
-                    is_tags_read       = False
-                    is_labels_read     = False
-                    is_color_read      = False
-                    is_prefer_idx_read = False
-                    timestamp          = new_timestamp
-                else:
-                    timestamp = int(line.strip()[2:-1])
-                continue
-
-            if not is_tags_read:
-                if tag_re.match(line):
-                    for tag in line.split('#'):
-                        t = tag.strip().lower()
-                        if t != '':
-                            tags.append (t)
-                    is_tags_read = True
-                    continue
-
-            if not is_labels_read:
-                if label_re.match(line):
-                    for lbl in line.split('@'):
-                        l = lbl.strip().lower()
-                        if l != '':
-                            labels.append (l)
-                    is_labels_read = True
-                    continue
-
-            if not is_color_read:
-                if color_re.match(line):
-                    color = line.strip()[7:-1]
-                    #print (color)
-                    is_color_read = True
-                    continue
-
-            if not is_prefer_idx_read:
-                if idx_re.match(line):
-                    prefer_idx = int(line.strip()[5:-1])
-                    #print (color)
-                    is_prefer_idx_read = True
-                    continue
-
-            if upd_records is None:
-                links.extend (link_re.findall (line))
-
-            content += line
-
-        f.close()
-
-    if timestamp != 0:
-        content = content.rstrip ('\n\t ')
-
-        if upd_records is not None:
-            if timestamp in upd_records:
-                if upd_records[timestamp][1]: # if not deleted
-                    rec = upd_records [timestamp][0]
-                    fulltxt += add_txtnote (rec['timestamp'], rec['color'], rec['prefer_idx'], rec['tags'], rec['labels'], rec['content'])
-                else: # if deleted, no write
-                    pass
-                del upd_records [timestamp]
-            else: # not updated, write old note
-                fulltxt += add_txtnote (timestamp, color, prefer_idx, tags, labels, content)
-            #print (fulltxt)
-        else:
-            records.append({'timestamp': timestamp, 'tags': list(set(tags)),
-                            'content': content, 'labels': list(set(labels)),
-                            'links': list(set(links)), 'color': color, 'prefer_idx': prefer_idx})
-
-
-    # Write remaining updated notes
-    if upd_records is not None:
-        for timestamp, note in upd_records.items():
-            if upd_records[timestamp][1]: # if not deleted
-                rec = upd_records [timestamp][0]
-                fulltxt += add_txtnote (rec['timestamp'], rec['color'], rec['prefer_idx'], rec['tags'], rec['labels'], rec['content'])
-
-        if os.path.isfile (path) and (fulltxt == ''): #if all notes were deleted, rm file
-            os.remove (path)
-        else:
-            f = open (path, 'w')
-            f.write(fulltxt)
-            f.close ()
-
-    return records
-
-@dataclass
-class Note:
-    tags      : Set[str] = field (default_factory = lambda: {})
-    labels    : Set[str] = field (default_factory = lambda: {})
-    content   : str = ''
-    timestamp : int = 0
-    links     : List[int] = field (default_factory = lambda: [])
-    color     : str = '#FFFFFF'
-    prefer_idx: int = 0 # start from 1, 0 == undefined
-    dirty     : bool = False
-    deleted   : bool = False
-
-    @property
-    def simple_context (self):
-        _content = "---\n\n"
-        _content += ' '.join(['\#' + tag for tag in self.tags]) + "\n\n"
-        _content += ' '.join(['@' + lbl for lbl in self.labels])
-        return _content
-
-    @property
-    def simple_content (self):
-        _content = ''
-        if self.content != '':
-            _content += f"{self.content}\n\n"
-        return _content
-
-    @property
-    def dict (self):
-        return {'timestamp': self.timestamp, 'tags': self.tags.copy(), 'labels': self.labels.copy(),
-                'content': self.content, 'links': self.links.copy(), 'color': self.color, 'prefer_idx': self.prefer_idx}
-
-    def set (self, note_info, set_dirty = False):
-        if isinstance (note_info, dict):
-            for k in note_info:
-                setattr (self, k, note_info [k])
-        else:
-            self.set (note_info.dict)
-        if set_dirty:
-            self.set_dirty ()
-
-    def set_dirty (self, delete = False):
-        self.dirty   = True
-        self.deleted = delete
-
-    def __str__ (self):
-        inf = self.dict.copy ()
-        inf ['content'] = inf ['content'][:20] + ('...' if len(inf['content']) > 20 else '')
-        inf ['dirty'] = self.dirty
-        inf ['deleted'] = self.deleted
-        return f"{inf}"
-
-@dataclass
-class Notebook:
-    tags   : Dict = field (default_factory = lambda: {})
-    labels : Dict = field (default_factory = lambda: {})
-    #labels : Dict = field (default_factory = lambda: {'A': {'count' : 10, 'children': {}},
-    #                                                  'B': {'count' : 5, 'children': {'B1': {'count': 2, 'children': {}},
-    #                                                                                  'B2': {'count': 3, 'children': {}}}},
-    #                                                  'C': {'count' : 3, 'children': {}}})
-    path   : str  = None
-    notes  : List[Note] = field (default_factory = lambda: [])
-
-    @property
-    def labels_flatten (self):
-        def travel_labels (prefix, lbl_dict):
-            lbls = {}
-            for k, v in lbl_dict.items():
-                prefix_k = prefix + k 
-                lbls [prefix_k] = v ['count']
-                if v['children']:
-                    lbls = lbls | travel_labels (prefix_k + '/', v['children'])
-            return lbls
-
-        return travel_labels ('', self.labels)
-
-    def Pull_From_Disk (self):
-        '''Fetch notes from disk, override note by version on disk if it was not modified in app
-        It returns in-app modified version if conflict'''
-
-        file_hndl   = {}
-        filename_re = re.compile(r"\d\d\d\d_\d\d_\d\d\.md")
-
-        for note_file in listdir_nohidden (self.path):
-            if filename_re.match (note_file):
-                filename = os.path.join (self.path, note_file)
-                records  = parse_note_file (filename)
-                #print (records)
-
-                for rec in records:
-                    fetch_en = True
-                    found_idx = self.find_note (rec['timestamp'])
-                    #print (f"{rec['timestamp']} - {rec['tags']}")
-                    #print (found_idx)
-                    if found_idx is not None:
-                        if self.notes[found_idx].dirty:
-                            self.notes[found_idx].prefer_idx = found_idx + 1
-                            if note_file not in file_hndl:
-                                file_hndl [note_file] = {}
-                            file_hndl [note_file][self.notes[found_idx].timestamp] = (self.notes[found_idx].dict, not self.notes[found_idx].deleted)
-                        else:
-                            self.update_note (found_idx, rec)
-                    else:
-                        self.add_note (rec)
-
-        #print (file_hndl)
-        print ("Pulled from storage.")
-        return file_hndl
-
-    def Sync (self, file_records = dict(), delete_sync = False):
-        '''Check and resolve note, tags, labels and index coherency
-        It appends in-app modified version of notes'''
-
-        file_hndl = file_records
-
-        i = 0
-        l = len (self.notes)
-        while i < l:
-            note = self.notes[i]
-            #print (f"{i}: {note.dict}")
-            if note.dirty or (note.prefer_idx != i + 1):
-                dt       = datetime.fromtimestamp (note.timestamp)
-                filename = dt.strftime('%Y_%m_%d.md')
-                #print (f"{note.timestamp} -> {filename}")
-                if filename not in file_hndl:
-                    file_hndl [filename] = {}
-                note.prefer_idx = i + 1
-                file_hndl [filename][note.timestamp] = (note.dict, not note.deleted)
-
-                if note.deleted:
-                    self.remove_note (i, delete = delete_sync)
-                    i += (1 if not delete_sync else 0)
-                    if delete_sync:
-                        l = len (self.notes)
-                else:
-                    i += 1
-
-            else:
-                i += 1
-        print ("Synced notes.")
-        return file_hndl
-
-    def Push_To_Disk (self, file_records):
-        '''Push modified version of notes to disk'''
-
-        file_hndl = file_records
-
-        for fn, records in file_hndl.items():
-            parse_note_file (os.path.join (self.path, fn), records)
-
-        print ("Write-back done.")
-
-    def Refresh (self):
-        file_records = self.Pull_From_Disk ()
-        #print (file_records)
-        #for note in self.notes:
-        #    print (note)
-        file_records = self.Sync (file_records, delete_sync = True)
-        #for note in self.notes:
-        #    print (note)
-        #print (file_records)
-        self.Push_To_Disk (file_records)
-
-    def remove_note (self, idx, delete = False):
-        if delete:
-            note = self.notes.pop (idx)
-        else:
-            note = self.notes [idx]
-
-        for t in note.tags:
-            if t in self.tags:
-                if self.tags[t] > 1:
-                    self.tags[t] -= 1
-                else:
-                    del self.tags[t]
-        for lbl in note.labels:
-            lbls = lbl.split ('/')
-            self.remove_lbl (self.labels, lbls)
-
-        return note
-
-    def find_note (self, timestamp):
-        for i in range(len(self.notes)):
-            if self.notes[i].timestamp == timestamp:
-                return i
-        return None
-
-    def remove_lbl (self, lbl_dict, lbl):
-        #print (lbl)
-        if lbl [0] in lbl_dict:
-            if lbl_dict[lbl[0]]['count'] > 0:
-                lbl_dict[lbl[0]]['count'] -= 1
-                if len (lbl) > 1:
-                    self.remove_lbl (lbl_dict[lbl[0]]['children'], lbl [1:])
-            else:
-                del (lbl_dict[lbl[0]])
-
-    def add_lbl (self, lbl_dict, lbl):
-        if lbl[0] not in lbl_dict:
-            lbl_dict[lbl[0]] = {'count': 1, 'children': {}}
-        else:
-            lbl_dict[lbl[0]]['count'] += 1
-        if len (lbl) > 1:
-            self.add_lbl (lbl_dict[lbl[0]]['children'], lbl [1:])
-
-    def update_note (self, note_or_idx, note_info, set_dirty = False):
-        if isinstance (note_info, Note):
-            rec = note_info.dict
-        else:
-            rec = note_info
-
-        if isinstance (note_or_idx, Note):
-            idx = self.notes.index (note_or_idx)
-        else:
-            idx = note_or_idx
-
-        self.remove_note (idx, delete = False)
-
-        note = self.notes [idx]
-        note.set (rec, set_dirty = set_dirty)
-
-        for t in note.tags:
-            if t not in self.tags:
-                self.tags [t] = 1
-            else:
-                self.tags [t] += 1
-
-        for l in note.labels:
-            lbl = l.split ('/')
-            self.add_lbl (self.labels, lbl)
-
-    def add_note (self, note_info, set_dirty = False):
-        note = Note ()
-        note.set (note_info, set_dirty = set_dirty)
-
-        if note.prefer_idx == 0: # undefined
-            self.notes.append (note)
-        else:
-            i = 0
-            l = len(self.notes)
-            while i < l and self.notes[i].prefer_idx > 0 and self.notes[i].prefer_idx < note.prefer_idx:
-                i += 1
-            self.notes.insert (i, note)
-        for t in note.tags:
-            if t not in self.tags:
-                self.tags [t] = 1
-            else:
-                self.tags [t] += 1
-
-        for l in note.labels:
-            lbl = l.split ('/')
-            self.add_lbl (self.labels, lbl)
-
-    def Create_random_notes (self, name_prf = '', num = 10):
-        for i in range (num):
-            note = Note(name = name_prf + str(i), title = f"Test note {i}", content = "Test note " * random.randrange (2, 240, 2))
-            self.add_note (note)
+import mdnoteman_trace as trace
+from mdnoteman_render import render_card, estimate_height, ThumbnailCache, RenderPool, CardLayout, MIN_POOL_BATCH
+from mdnoteman_fetch import ImageStore, ImageFetcher
+from mdnoteman_watch import Watcher
+from mdnoteman_core import (Note, Notebook, scan_note_file, read_note_file, format_note, write_note_file, # re-exported
+                            parse_note_file, markdown_config, note_file_re, NOTE_ENCODING, SNAPSHOT_VERSION)
 
 @dataclass
 class NoteCard:
@@ -438,6 +28,10 @@ class NoteCard:
     width: int = 240
     _thumbnail: Image = None
     _thumbnail_bio: io.BytesIO = None
+    height_hint: int = 0 # used for layout while not rendered
+    pos: tuple = (0, 0)  # top left of card slot in box
+    fig: tuple = None    # (background, image) figures
+    pending_images: List = field (default_factory = lambda: []) # sources drawn as placeholders
 
     @property
     def thumbnail (self):
@@ -447,25 +41,53 @@ class NoteCard:
     def thumbnail_bio (self):
         return self._thumbnail_bio
 
+    @property
+    def height (self):
+        if self._thumbnail is not None:
+            return self._thumbnail.size[1]
+        return self.height_hint
+
     def set_fig (self, fig):
         self.fig = fig
 
-    def init (self, md = None):
-        self.update (md)
-
-    def update (self, md):
-        ctn       = md.convert_img (self.note.simple_content)
-        ctn_h     = 240 if (ctn.size[1] > 240) else ctn.size[1]
-        ctx       = md.convert_img (self.note.simple_context)
-        ctx_h     = ctx.size [1]
-        img = Image.new ("RGBA", (self.width, ctn_h + ctx_h))
-        img.paste (ctn, (0, 0))
-        img.paste (ctx, (0, ctn_h))
-        bio = io.BytesIO ()
-        img.save (bio, format = "PNG")
-        self._thumbnail = img.copy ()
-        self._thumbnail_bio = bio.getvalue ()
-        del img
+    def init (self, md = None, cache = None):
+        self.update (md, cache)
+
+    def set_thumbnail (self, data):
+        self._thumbnail_bio = data
+        self._thumbnail = Image.open (io.BytesIO (data)) # lazy, only header is read for size
+        self.height_hint = self._thumbnail.size[1]
+
+    def release (self):
+        '''Drop rendered image, keep its height for layout'''
+        self._thumbnail = None
+        self._thumbnail_bio = None
+
+    def render_job (self):
+        return (self.note.simple_content, self.note.simple_context, self.width)
+
+    @trace.traced ('card_update')
+    def update (self, md, cache = None):
+        job  = self.render_job ()
+        data = None
+
+        if cache is not None:
+            key  = cache.key (md, *job)
+            data = cache.get (key)
+            if data is not None:
+                trace.add (bytes_read = len (data))
+
+        self.pending_images = []
+        if data is None:
+            data, self.pending_images = render_card (md, *job)
+            if cache is not None and not self.pending_images:
+                cache.put (key, data)
+                trace.add (bytes_written = len (data))
+        trace.add (items = 1)
+
+        self.set_thumbnail (data)
+        if cache is not None and not self.pending_images:
+            cache.set_height (key, self.height)
 
 @dataclass
 class CardBox:
@@ -475,18 +97,44 @@ class CardBox:
     window   : sg.Window = None
     name     : str = ''
     width    : int = 768
-    md       : Markdown_Ext = None
+    md       : object = None # Markdown_Ext, imported by init with markdown
     graph    : esg.Graph = None
+    _by_ts   : Dict = field (default_factory = lambda: {}, repr = False) # timestamp -> card
+    _pos     : Dict = field (default_factory = lambda: {}, repr = False) # timestamp -> position in cards
+    _pos_stale : bool = field (default = False, repr = False)
+    thumb_cache : ThumbnailCache = None
+    render_pool : RenderPool = None
+    lazy        : bool = True # render only cards around the visible part of box
+    prefetch    : int  = 800  # px above and below visible part rendered in advance
+    _drawn      : Dict = field (default_factory = lambda: {}, repr = False) # timestamp -> card with drawn image
+    _viewport   : tuple = field (default = None, repr = False)
+    _layout     : CardLayout = field (default_factory = lambda: CardLayout (), repr = False)
+    image_fetcher : ImageFetcher = None
+    _waiting    : Dict = field (default_factory = lambda: {}, repr = False) # image source -> timestamps of cards waiting for it
+    watcher     : Watcher = None # note files changed outside of app
 
     def get_note_by_timestamp (self, timestamp):
-        for note in self.cards:
-            if note.note.timestamp == timestamp:
-                return note
-        return None
+        return self._by_ts.get (timestamp)
+
+    def card_pos (self, timestamp):
+        if self._pos_stale:
+            self._pos = {card.note.timestamp: i for i, card in enumerate (self.cards)}
+            self._pos_stale = False
+        return self._pos.get (timestamp)
+
+    def follow_moved_timestamps (self):
+        '''Re-key cards of notes whose timestamp was changed by an edit'''
+        for old_ts, new_ts in self.notebook.moved_timestamps.items ():
+            card = self._by_ts.pop (old_ts, None)
+            if card is not None:
+                self._by_ts [new_ts] = card
+                self._pos_stale = True
+        self.notebook.moved_timestamps.clear ()
 
     def scroll_handle (self, event):
         if self.container_scroll_cb:
             self.container_scroll_cb (event)
+            self.update_viewport ()
         return 'break'
 
     @property
@@ -505,73 +153,251 @@ class CardBox:
         """ return cards of interest """
         return self._cards_oi
 
+    @trace.traced ('filter')
     def filter (self, query_str = ''):
         changed = False
         if query_str != '':
-            l = len (self.cards)
             try:
-                dsl.lexer.input (query_str)
-                flt = dsl.build_ast (dsl.lexer)
+                flt = dsl.compile_query (query_str)
+            except dsl.PlanError:
+                # e.g. 'tags a & labels', analyze failed on it and all cards were shown
+                print ("Invalid query string %s - Ignored" %(query_str))
+                flt = None
+                self._cards_oi = list (self.cards)
+                changed = True
             except ValueError as err:
                 print ("Invalid query string %s - Ignored" %(query_str))
                 flt = None
             if flt:
                 print (flt)
-                self._cards_oi = []
-                tst_ovrd = False
-                for i in range (l):
-                    tst = False
-                    if not tst_ovrd:
-                        try:
-                            tst = flt.analyze (tags = self.cards[i].note.tags, labels = self.cards[i].note.labels, ctn = self.cards[i].note.content)
-                        except ValueError:
-                            print ("Invalid query string %s - Ignored" %(query_str))
-                            tst = True
-                            tst_ovrd = True
-                    if tst_ovrd or tst:
-                        self._cards_oi.append (self.cards[i])
+                try:
+                    ids = flt.select (self.notebook)
+                    self._cards_oi = [self._by_ts[ts] for ts in ids if ts in self._by_ts]
+                    self._cards_oi.sort (key = lambda card: self.card_pos (card.note.timestamp))
+                except ValueError:
+                    print ("Invalid query string %s - Ignored" %(query_str))
+                    self._cards_oi = list (self.cards)
                 changed = True
         else:
             self._cards_oi = self.cards
             changed = True
 
         if changed:
+            trace.add (items = len (self._cards_oi))
             self.refresh_box ()
 
     def set_notebook (self, nb):
         self.notebook = nb
+        if self.image_fetcher is not None and self.image_fetcher.store.base_path != nb.path:
+            # Local images are relative to notebook folder
+            self.image_fetcher.store.base_path = nb.path
+            if self.render_pool is not None:
+                self.render_pool.shutdown () # workers hold a copy of the store
+        self.watch (nb.path)
         self.sync_cards ()
 
-    def sync_cards (self, dirty_only = False):
+    @property
+    def watch_event (self):
+        return (self.name, "watch")
+
+    def watch (self, path):
+        '''Watch note files in path, changes come back to reload_notes as watch_event'''
+        if self.watcher is not None:
+            if self.watcher.path == path:
+                return
+            self.watcher.stop ()
+            self.watcher = None
+        if self.window and path and os.path.isdir (path):
+            window = self.window
+            self.watcher = Watcher (path = path, pattern = note_file_re,
+                                    on_change = lambda names: window.write_event_value (self.watch_event, names))
+            self.watcher.start ()
+
+    def reload_notes (self, note_files):
+        '''Handle watch_event, pull changed note files and sync the cards of notes in them only
+        Return True if any note was added, changed or removed'''
+        if self.notebook is None or self.watcher is None or self.notebook.path != self.watcher.path:
+            return False
+        changed = self.notebook.Reload (note_files)
+        if not changed:
+            return False
+        self.sync_cards (timestamps = changed)
+        return True
+
+    @trace.traced ('sync_cards')
+    def sync_cards (self, dirty_only = False, timestamps = None):
+        '''Sync cards of notes (all or those of timestamps) to box, cards of notes gone from notebook are removed'''
         print ("Syncing cards to box ...")
 
-        for note in self.notebook.notes:
+        self.follow_moved_timestamps ()
+        self.prune_cards (self._by_ts if timestamps is None else timestamps)
+
+        if timestamps is None:
+            notes = self.notebook.notes
+        else:
+            notes = [self.notebook.get_note (timestamp) for timestamp in timestamps]
+            notes = sorted ((note for note in notes if note is not None),
+                            key = lambda note: self.notebook.find_note (note.timestamp))
+
+        synced    = []
+        new_cards = []
+        for note in notes:
             if (not dirty_only) or (note.dirty):
                 card = NoteCard(note = note)
-                card.init (self.md)
-                self.add_or_replace (card)
-
+                if note.timestamp in self._by_ts:
+                    synced.append (card)
+                elif not note.deleted:
+                    new_cards.append (card)
+
+        if self.lazy:
+            for card in synced + new_cards:
+                self.hint_height (card)
+        else:
+            self.render_cards ([card for card in synced if not card.note.deleted] + new_cards)
+        for card in synced:
+            self.add_or_replace (card)
+
+        if new_cards:
+            # Same order as inserting one by one at the top
+            new_cards.reverse ()
+            self.cards [0:0] = new_cards
+            for card in new_cards:
+                self._by_ts [card.note.timestamp] = card
+            self._pos_stale = True
+
+        trace.add (items = len (synced) + len (new_cards))
         self.filter ()
 
         print ("Sync notes to cardbox done.")
 
+    def prune_cards (self, timestamps):
+        '''Remove cards of timestamps whose note is no longer in notebook'''
+        gone = {timestamp for timestamp in timestamps
+                if timestamp in self._by_ts and self.notebook.get_note (timestamp) is None}
+        if gone:
+            self.cards [:] = [card for card in self.cards if card.note.timestamp not in gone]
+            for timestamp in gone:
+                del self._by_ts [timestamp]
+            self._pos_stale = True
+        return len (gone)
+
+    @trace.traced ('render_cards')
+    def render_cards (self, cards):
+        '''Render thumbnails of cards, misses of thumbnail cache go to the render pool if enabled'''
+        trace.add (items = len (cards))
+        if self.render_pool is None:
+            for card in cards:
+                card.init (self.md, self.thumb_cache)
+            self.request_images (cards)
+            return
+
+        jobs    = []
+        pending = []
+        for card in cards:
+            job  = card.render_job ()
+            key  = self.thumb_cache.key (self.md, *job) if self.thumb_cache else None
+            data = self.thumb_cache.get (key) if self.thumb_cache else None
+            if data is None:
+                jobs.append (job)
+                pending.append ((card, key))
+            else:
+                card.set_thumbnail (data)
+                trace.add (bytes_read = len (data))
+
+        if len (jobs) < MIN_POOL_BATCH:
+            results = [render_card (self.md, *job) for job in jobs]
+        else:
+            results = self.render_pool.render (jobs)
+
+        for (card, key), (data, images) in zip (pending, results):
+            card.set_thumbnail (data)
+            card.pending_images = images
+            if self.thumb_cache and not images: # placeholders are not cached
+                self.thumb_cache.put (key, data)
+                self.thumb_cache.set_height (key, card.height)
+                trace.add (bytes_written = len (data))
+        self.request_images (cards)
+
+    @property
+    def image_event (self):
+        return (self.name, "image")
+
+    def request_images (self, cards):
+        '''Fetch images that cards were rendered without, see image_ready'''
+        if self.image_fetcher is None:
+            return
+        for card in cards:
+            for src in card.pending_images:
+                self._waiting.setdefault (src, set ()).add (card.note.timestamp)
+                self.image_fetcher.request (src)
+
+    def image_ready (self, src):
+        '''Handle image_event, render again the cards drawn with a placeholder for src'''
+        cards = []
+        for timestamp in self._waiting.pop (src, ()):
+            card = self._by_ts.get (timestamp)
+            if card is not None and src in card.pending_images:
+                cards.append (card)
+        if not cards:
+            return
+
+        if self.lazy:
+            # Drop images, visible cards are rendered again by update_viewport
+            for card in cards:
+                if card.fig is not None and card.fig[1] is not None:
+                    self.graph.delete_figure (card.fig[1])
+                    card.set_fig ((card.fig[0], None))
+                card.release ()
+                self._drawn.pop (card.note.timestamp, None)
+            self.update_viewport (force = True)
+        else:
+            self.render_cards (cards)
+            self.refresh_box ()
+
+    def hint_height (self, card):
+        '''Set layout height of a card before it is rendered, exact if it was rendered before'''
+        old = self._by_ts.get (card.note.timestamp)
+        job = card.render_job ()
+        h   = None
+        if self.thumb_cache is not None and self.md is not None:
+            h = self.thumb_cache.height (self.thumb_cache.key (self.md, *job))
+        if h is None and old is not None and old.note is card.note and old.height_hint:
+            h = old.height_hint
+        card.height_hint = h if h is not None else estimate_height (job[0], job[1])
+
+    def close (self):
+        if self.watcher is not None:
+            self.watcher.stop ()
+        if self.image_fetcher is not None:
+            self.image_fetcher.shutdown ()
+        if self.render_pool is not None:
+            self.render_pool.shutdown ()
+        if self.thumb_cache is not None:
+            self.thumb_cache.save ()
+
     def add_or_replace (self, card):
-        l = len(self.cards)
-        i = 0
-        while i < l:
-            if self.cards[i].note.timestamp == card.note.timestamp:
-                break
-            i += 1
-
-        if i < l:
+        timestamp = card.note.timestamp
+        i = self.card_pos (timestamp) if timestamp in self._by_ts else None
+
+        if i is not None:
             if not card.note.deleted:
-                ret = self.cards[i]
                 self.cards[i] = card
+                self._by_ts [timestamp] = card
             else:
-                self.card.pop (i)
+                self.remove_card (self.cards[i])
         else:
             if not card.note.deleted:
                 self.cards.insert (0, card)
+                self._by_ts [timestamp] = card
+                self._pos_stale = True
+
+    def remove_card (self, card):
+        timestamp = card.note.timestamp
+        i = self.card_pos (timestamp)
+        if i is not None and self.cards[i] is card:
+            self.cards.pop (i)
+            del self._by_ts [timestamp]
+            self._pos_stale = True
 
     def erase (self):
         self.window[self.name].set_vscroll_position (0)
@@ -589,68 +415,140 @@ class CardBox:
         if self.n_cols != old_n_cols:
             self.refresh_box ()
 
-    def rearrange_box (self):
-        N = len (self.cards_oi)
-
-        c = 0
-        for n in range (N):
-            i = 1
-            y = 0
-            upper_n = n - i*self.n_cols
-            while (upper_n >= 0):
-                y += (self.cards_oi[upper_n].thumbnail.size[1] + 16)
-                i += 1
-                upper_n = n - i*self.n_cols
-
-            w,h = self.cards_oi[n].thumbnail.size
-            if y + 16 + h > self.graph.CanvasSize [1]:
-                self.graph.set_size ((self.width, y + 16 + h))
-                self.graph.change_coordinates ((0, y + 16 + h), (self.width, 0))
-
-            (ox1, oy1), (ox2, oy2) = self.graph.get_bounding_box (self.cards_oi[n].fig[0])
-            self.graph.move_figure (self.cards_oi[n].fig[0], c * 256 + 6 - ox1, y + 6 - oy1)
-            (ox1, oy1), (ox2, oy2) = self.graph.get_bounding_box (self.cards_oi[n].fig[1])
-            self.graph.move_figure (self.cards_oi[n].fig[1], c * 256 + 8 - ox1, y + 8 - oy1)
-            c = 0 if (c + 1 == self.n_cols) else c + 1
+    def layout_cards (self, cols = None):
+        '''Set slot position of cards of interest (only in given columns if any), grow canvas to fit'''
+        N       = len (self.cards_oi)
+        heights = [card.height for card in self.cards_oi]
+
+        if cols is None or self._layout.n_cols != self.n_cols:
+            self._layout = CardLayout (n_cols = self.n_cols).build (heights)
+            slots = range (N)
+        else:
+            self._layout.update_columns (heights, cols)
+            slots = self._layout.column_slots (cols, N)
+
+        for n in slots:
+            self.cards_oi[n].pos = self._layout.position (n)
+
+        h = self._layout.height
+        if h > self.graph.CanvasSize [1]:
+            self.graph.set_size ((self.width, h))
+            self.graph.change_coordinates ((0, h), (self.width, 0))
+
+        return slots
+
+    def draw_card (self, card):
+        x, y = card.pos
+        w, h = card.width, card.height
+        bg  = self.graph.draw_rectangle (top_left = (x + 6, y + 6),
+                                         bottom_right = (x + 8 + w + 2, y + 8 + h + 2),
+                                         line_color = 'black', line_width = 1,
+                                         fill_color = card.note.color)
+        fig = None
+        if card.thumbnail_bio is not None:
+            fig = self.graph.draw_image (data = card.thumbnail_bio, location = (x + 8, y + 8))
+            self._drawn [card.note.timestamp] = card
+        card.set_fig ((bg, fig))
+
+    def visible_range (self):
+        canvas = self.window [self.name].TKColFrame.canvas
+        top    = canvas.canvasy (0)
+        return (int (top), int (top + canvas.winfo_height ()))
+
+    def update_viewport (self, force = False):
+        '''Render and draw cards near the visible part of box, release the others'''
+        if not (self.lazy and self.window):
+            return
+
+        viewport = self.visible_range ()
+        if viewport == self._viewport and not force:
+            return
+        self._viewport = viewport
+
+        lo = viewport[0] - self.prefetch
+        hi = viewport[1] + self.prefetch
+        slots   = self._layout.slots_in_range (lo, hi)
+        visible = [self.cards_oi[n] for n in slots]
+
+        # Release cards gone out of range
+        visible_ts = set (card.note.timestamp for card in visible)
+        for timestamp, card in list (self._drawn.items ()):
+            if timestamp not in visible_ts:
+                if card.fig is not None and card.fig[1] is not None:
+                    self.graph.delete_figure (card.fig[1])
+                    card.set_fig ((card.fig[0], None))
+                card.release ()
+                del self._drawn [timestamp]
+
+        to_render = [(n, card, card.height_hint) for n, card in zip (slots, visible) if card.thumbnail is None]
+        self.render_cards ([card for n, card, hint in to_render])
+
+        changed = [(n, card) for n, card, hint in to_render if card.height != hint]
+        if changed:
+            # Estimates were off, move cards of affected columns to new slots then draw
+            for n, card in changed:
+                if card.fig is not None:
+                    self.graph.delete_figure (card.fig[0])
+                    card.set_fig (None)
+            self.rearrange_box (draw = False, cols = set (n % self.n_cols for n, card in changed))
+            for n, card in changed:
+                self.draw_card (card)
+            self._viewport = None
+            self.update_viewport ()
+            return
+
+        for card in visible:
+            if card.fig is None or card.fig[1] is None:
+                if card.fig is not None:
+                    self.graph.delete_figure (card.fig[0])
+                self.draw_card (card)
+
+    def rearrange_box (self, draw = True, cols = None):
+        for n in self.layout_cards (cols):
+            card = self.cards_oi[n]
+            x, y = card.pos
+            if card.fig is None:
+                continue
+            (ox1, oy1), (ox2, oy2) = self.graph.get_bounding_box (card.fig[0])
+            self.graph.move_figure (card.fig[0], x + 6 - ox1, y + 6 - oy1)
+            if card.fig[1] is not None:
+                (ox1, oy1), (ox2, oy2) = self.graph.get_bounding_box (card.fig[1])
+                self.graph.move_figure (card.fig[1], x + 8 - ox1, y + 8 - oy1)
 
         self.window [self.name].widget.update ()
         self.window [self.name].contents_changed ()
         self.window [self.name].expand (expand_row = True)
 
+        if draw:
+            self.update_viewport (force = True)
+
+    @trace.traced ('refresh_box')
     def refresh_box (self):
         self.n_cols = self.width // 256
-        N = len (self.cards_oi)
 
         if self.window:
+            trace.add (items = len (self.cards_oi))
             self.erase ()
+            drawn = self._drawn
+            self._drawn = {}
+            self._viewport = None
 
-            c = 0
-            for n in range (N):
-                i = 1
-                y = 0
-                upper_n = n - i*self.n_cols
-                while (upper_n >= 0):
-                    y += (self.cards_oi[upper_n].thumbnail.size[1] + 16)
-                    i += 1
-                    upper_n = n - i*self.n_cols
-
-                w,h = self.cards_oi[n].thumbnail.size
-                if y + 16 + h > self.graph.CanvasSize [1]:
-                    self.graph.set_size ((self.width, y + 16 + h))
-                    self.graph.change_coordinates ((0, y + 16 + h), (self.width, 0))
-
-                bg  = self.graph.draw_rectangle (top_left = (c * 256 + 6, y + 6),
-                                                 bottom_right = (c * 256 + 8 + w + 2, y + 8 + h + 2),
-                                                 line_color = 'black', line_width = 1,
-                                                 fill_color = self.cards_oi[n].note.color)
-                fig = self.graph.draw_image (data = self.cards_oi[n].thumbnail_bio, location = (c * 256 + 8, y + 8))
-                self.cards_oi[n].set_fig ((bg, fig))
-                c = 0 if (c + 1 == self.n_cols) else c + 1
+            # Cards not rendered yet are drawn as placeholders, images come with update_viewport
+            self.layout_cards ()
+            for card in self.cards_oi:
+                self.draw_card (card)
+
+            if self.lazy:
+                for timestamp, card in drawn.items ():
+                    if timestamp not in self._drawn:
+                        card.release ()
 
             self.window [self.name].widget.update ()
             self.window [self.name].contents_changed ()
             self.window [self.name].expand (expand_row = True)
 
+            self.update_viewport ()
+
     def find_note_at_fig (self, fig):
         for card in self.cards_oi:
             if card.fig == fig:
@@ -687,22 +585,22 @@ class CardBox:
                 #print (note2_idx)
 
                 # Swap in notebook
-                tmp_note = self.notebook.notes[note1_idx]
-                self.notebook.notes[note1_idx] = self.notebook.notes[note2_idx]
-                self.notebook.notes[note2_idx] = tmp_note
-                self.notebook.notes[note1_idx].set_dirty ()
-                self.notebook.notes[note2_idx].set_dirty ()
+                self.notebook.swap_notes (note1_idx, note2_idx)
                 self.notebook.notes[note1_idx].prefer_idx = note1_idx + 1
                 self.notebook.notes[note2_idx].prefer_idx = note2_idx + 1
+                self.notebook.mark_dirty (self.notebook.notes[note1_idx])
+                self.notebook.mark_dirty (self.notebook.notes[note2_idx])
 
                 # Swpa in cardbox
                 tmp_note = self.cards_oi [fig1_idx]
                 self.cards_oi [fig1_idx] = self.cards_oi [fig2_idx]
                 self.cards_oi [fig2_idx] = tmp_note
+                if self.cards_oi is self.cards:
+                    self._pos_stale = True
 
                 # Refresh
                 if not always_refresh:
-                    self.rearrange_box ()
+                    self.rearrange_box (cols = {fig1_idx % self.n_cols, fig2_idx % self.n_cols})
 
         # Refresh
         if always_refresh:
@@ -717,8 +615,10 @@ class CardBox:
 
     def delete_note (self, notes):
         for note in notes:
-            self.cards_oi.remove (note)
-            note.note.set_dirty (delete = True)
+            if self.cards_oi is not self.cards:
+                self.cards_oi.remove (note)
+            self.remove_card (note)
+            self.notebook.mark_dirty (note.note, delete = True)
         self.notebook.Sync ()
         self.refresh_box ()
         print ("Deleted note.")
@@ -727,7 +627,7 @@ class CardBox:
         for note in notes:
             if color != note.note.color:
                 note.note.color = color
-                note.note.set_dirty ()
+                self.notebook.mark_dirty (note.note)
                 (x, y), (x_w, y_h) = self.graph.get_bounding_box (note.fig[0])
                 self.graph.delete_figure(note.fig[0])
                 bg  = self.graph.draw_rectangle (top_left = (x, y),
@@ -767,15 +667,23 @@ class CardBox:
             self.refresh_box ()
 
     def init (self, window, cfg, container_scroll_cb = None):
-        config = {'color': (0,0,0,255), 'margin_bottom': 8,
-                  'bold_font_path' : cfg['Fonts']['Bold'],
-                  'code_font_path' : cfg['Fonts']['Code'],
-                  'code_font_size' : int(cfg['Fonts']['Code_size']),
-                  'default_font_path': cfg['Fonts']['Dflt'],
-                  'italics_font_path': cfg['Fonts']['Italic'],
-                  'font_size': int(cfg['Fonts']['Size'])}
+        from md2img import Markdown_Ext
+
+        config = markdown_config (cfg)
 
         self.md = Markdown_Ext ([(0, 0, 240)], config)
+        if 'Cache' in cfg:
+            store = ImageStore (path = os.path.join (cfg['Cache']['Path'], 'images'))
+            self.thumb_cache = ThumbnailCache (path = os.path.join (cfg['Cache']['Path'], 'thumbs'), image_store = store)
+            self.md.image_loader = store.load
+            self.image_fetcher = ImageFetcher (store = store,
+                                               on_ready = lambda src: window.write_event_value (self.image_event, src))
+        if 'Render' in cfg:
+            workers = cfg['Render']['Workers'].strip ().lower ()
+            if workers not in ('0', 'off', ''):
+                self.render_pool = RenderPool (width_spec = [(0, 0, 240)], config = config,
+                                               workers = 0 if workers == 'auto' else int (workers),
+                                               image_store = self.image_fetcher.store if self.image_fetcher else None)
         self.window = window
         self.graph = self.window[(self.name, "graph")]
         self.container_scroll_cb = container_scroll_cb
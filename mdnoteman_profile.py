@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+import sys
+if sys.hexversion < 0x03070000:
+    print("!!! This component requires Python version 3.7 at least !!!")
+    sys.exit(1)
+
+import os
+import io
+import re
+import time
+import pstats
+import cProfile
+import threading
+import traceback
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import List
+
+import mdnoteman_trace as trace
+
+SLOW_EVENT_MS = 100 # dispatched events taking longer are reported
+STALL_MS      = 500 # main loop busy that long gets its stack captured
+PROFILE_LINES = 40  # functions listed in a saved profile
+
+def event_name (event):
+    if isinstance (event, tuple):
+        return '/'.join (str (part) for part in event)
+    return str (event)
+
+@dataclass
+class EventProfiler:
+    '''Times events dispatched by gui.handle, reports slow ones and saves stacks of the main thread
+    when one is still running after stall_ms (watchdog thread). With cprofile each event runs under
+    cProfile and the profile of slow ones is saved into path'''
+    slow_ms  : float = SLOW_EVENT_MS
+    stall_ms : float = STALL_MS
+    cprofile : bool  = False
+    path     : str   = None # folder of stall and profile reports
+    timeout_event : object = None # periodic event of window.read, only traced when slow
+    slow     : List  = field (default_factory = lambda: []) # (event name, ms, report files) of slow events
+    _current : tuple = field (default = None, repr = False) # (event name, start) while an event runs
+    _stalled : str   = field (default = None, repr = False) # report of current event if it stalled
+    _main    : int   = field (default = None, repr = False) # thread id of event loop
+    _stop    : threading.Event = field (default_factory = threading.Event, repr = False)
+    _thread  : threading.Thread = field (default = None, repr = False)
+
+    def start (self):
+        self._main = threading.get_ident ()
+        if self.stall_ms and self._thread is None:
+            self._stop.clear ()
+            self._thread = threading.Thread (target = self._watch, name = 'watchdog', daemon = True)
+            self._thread.start ()
+
+    def stop (self):
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set ()
+            thread.join ()
+
+    def report_file (self, kind, name):
+        safe = re.sub (r'[^\w.-]+', '_', name)[:40]
+        return os.path.join (self.path or '.', time.strftime (f'{kind}-%Y%m%d-%H%M%S-') + safe + '.txt')
+
+    def write_report (self, filename, text):
+        try:
+            os.makedirs (os.path.dirname (filename), exist_ok = True)
+            with open (filename, 'w') as f:
+                f.write (text)
+            return filename
+        except OSError as err:
+            sys.__stderr__.write (f"Can not write {filename} - {err}\n")
+            return None
+
+    def _watch (self):
+        '''Watchdog, runs in its own thread and never touches the GUI'''
+        interval = self.stall_ms / 4000
+        reported = None
+        while not self._stop.wait (interval):
+            current = self._current
+            if current is None or current is reported:
+                continue
+            name, start = current
+            busy = (time.perf_counter () - start) * 1000
+            if busy < self.stall_ms:
+                continue
+            frame = sys._current_frames ().get (self._main)
+            if frame is None:
+                continue
+            stack = ''.join (traceback.format_stack (frame))
+            reported = current
+            text = f"Event {name} busy for {busy:.0f} ms, main thread stack:\n{stack}"
+            sys.__stderr__.write (text)
+            trace.count ('stalls')
+            self._stalled = self.write_report (self.report_file ('stall', name), text) or 'stderr'
+
+    @contextmanager
+    def event (self, event):
+        name     = event_name (event)
+        periodic = event == self.timeout_event
+        profile  = cProfile.Profile () if self.cprofile else None
+        self._stalled = None
+        start = time.perf_counter ()
+        self._current = (name, start)
+        try:
+            if periodic:
+                if profile:
+                    profile.enable ()
+                yield
+            else:
+                with trace.span ('event ' + name):
+                    if profile:
+                        profile.enable ()
+                    yield
+        finally:
+            if profile:
+                profile.disable ()
+            self._current = None
+            ms = (time.perf_counter () - start) * 1000
+            if ms >= self.slow_ms:
+                self.slow_event (name, ms, periodic, profile)
+
+    def slow_event (self, name, ms, periodic, profile):
+        if periodic:
+            trace.tracer.record (trace.Span (name = 'event ' + name, start = time.time () - ms / 1000, ms = ms,
+                                             thread = threading.current_thread ().name))
+        trace.count ('slow events')
+        reports = [self._stalled] if self._stalled else []
+        if profile is not None:
+            out = io.StringIO ()
+            pstats.Stats (profile, stream = out).sort_stats ('cumulative').print_stats (PROFILE_LINES)
+            report = self.write_report (self.report_file ('profile', name), f"Event {name} took {ms:.0f} ms\n{out.getvalue ()}")
+            if report:
+                reports.append (report)
+        self.slow.append ((name, ms, reports))
+        print (f"Slow event {name}: {ms:.0f} ms" + (f", see {', '.join (reports)}" if reports else ''))
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+import sys
+if sys.hexversion < 0x03070000:
+    print("!!! This component requires Python version 3.7 at least !!!")
+    sys.exit(1)
+
+import os
+import io
+import json
+import hashlib
+import multiprocessing
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Dict
+from PIL import Image
+
+from mdnoteman_fetch import image_sources
+
+CONTENT_MAX_HEIGHT = 240
+MIN_POOL_BATCH     = 8 # smaller batches are rendered in-process
+WORKER_PRELOAD     = ['md2img', 'mdnoteman_render'] # imported once by the fork server, workers start from its copy
+
+_worker_md = None
+
+def render_card (md, content, context, width):
+    '''Render note content (cropped to CONTENT_MAX_HEIGHT) and its tags/labels context
+    into one card image, return (PNG bytes, sources of images still pending)'''
+
+    ctn     = md.convert_img (content)
+    pending = list (md.pending_images)
+    ctn_h   = 0 if ctn == '' else min (ctn.size[1], CONTENT_MAX_HEIGHT)
+    ctx     = md.convert_img (context)
+    pending.extend (md.pending_images)
+    ctx_h = 0 if ctx == '' else ctx.size[1]
+
+    img = Image.new ("RGBA", (width, ctn_h + ctx_h))
+    if ctn_h > 0:
+        img.paste (ctn, (0, 0))
+    if ctx_h > 0:
+        img.paste (ctx, (0, ctn_h))
+    bio = io.BytesIO ()
+    img.save (bio, format = "PNG")
+    return bio.getvalue (), pending
+
+def estimate_height (content, context, chars_per_line = 36, line_height = 18):
+    '''Rough card height of a note that has never been rendered'''
+    lines = 0
+    for line in content.split ('\n'):
+        lines += 1 + len (line) // chars_per_line
+    ctn_h = min (lines * line_height, CONTENT_MAX_HEIGHT) if content.strip () else 0
+    return ctn_h + (2 + len (context) // (chars_per_line * 2)) * line_height
+
+@dataclass
+class ThumbnailCache:
+    '''Content-addressed store of rendered card PNGs, one file per key under path
+    Heights of stored cards are kept in an index so layout can be done without reading them
+    Embedded images are part of the key, with their version from image_store, so a changed image renders again'''
+    path    : str  = None
+    heights : Dict = None
+    image_store : object = None # ImageStore of the Markdown_Ext image_loader
+    _heights_dirty : bool = False
+
+    def key (self, md, content, context, width):
+        h = hashlib.sha1 ()
+        h.update (md.fingerprint.encode ())
+        h.update (str (width).encode ())
+        h.update (b'\0' + content.encode ())
+        h.update (b'\0' + context.encode ())
+        for src in image_sources (content):
+            h.update (b'\0' + src.encode ())
+            if self.image_store is not None:
+                h.update (b'\0' + self.image_store.identity (src).encode ())
+        return h.hexdigest ()
+
+    def file (self, key):
+        return os.path.join (self.path, key[:2], key[2:] + '.png')
+
+    def get (self, key):
+        try:
+            with open (self.file (key), 'rb') as f:
+                return f.read ()
+        except OSError:
+            return None
+
+    def height (self, key):
+        if self.heights is None:
+            try:
+                with open (os.path.join (self.path, 'heights.json'), 'r') as f:
+                    self.heights = json.load (f)
+            except (OSError, ValueError):
+                self.heights = {}
+        return self.heights.get (key)
+
+    def set_height (self, key, height):
+        if self.height (key) != height:
+            self.heights [key] = height
+            self._heights_dirty = True
+
+    def save (self):
+        if self._heights_dirty:
+            try:
+                os.makedirs (self.path, exist_ok = True)
+                tmp = os.path.join (self.path, f"heights.json.{os.getpid ()}.tmp")
+                with open (tmp, 'w') as f:
+                    json.dump (self.heights, f)
+                os.replace (tmp, os.path.join (self.path, 'heights.json'))
+                self._heights_dirty = False
+            except OSError as err:
+                print (f"Can not save thumbnail heights - {err}")
+
+    def put (self, key, data):
+        filename = self.file (key)
+        try:
+            os.makedirs (os.path.dirname (filename), exist_ok = True)
+            tmp = f"{filename}.{os.getpid ()}.tmp"
+            with open (tmp, 'wb') as f:
+                f.write (data)
+            os.replace (tmp, filename)
+        except OSError as err:
+            print (f"Can not cache thumbnail - {err}")
+
+@dataclass
+class CardLayout:
+    '''Masonry of cards in n_cols columns, card n goes to column n % n_cols under the previous one'''
+    n_cols    : int  = 3
+    col_width : int  = 256
+    gap       : int  = 16
+    tops      : List = field (default_factory = lambda: []) # per column, y of each card in it
+    bottoms   : List = field (default_factory = lambda: []) # per column, running height
+
+    def build (self, heights):
+        self.tops    = [[] for c in range (self.n_cols)]
+        self.bottoms = [0] * self.n_cols
+        for n, h in enumerate (heights):
+            c = n % self.n_cols
+            self.tops[c].append (self.bottoms[c])
+            self.bottoms[c] += h + self.gap
+        return self
+
+    def update_columns (self, heights, cols):
+        '''Recompute only given columns, e.g. after two cards were swapped'''
+        for c in cols:
+            tops = []
+            y    = 0
+            for n in range (c, len (heights), self.n_cols):
+                tops.append (y)
+                y += heights[n] + self.gap
+            self.tops[c]    = tops
+            self.bottoms[c] = y
+
+    def column_slots (self, cols, count):
+        return sorted (n for c in cols for n in range (c, count, self.n_cols))
+
+    def position (self, n):
+        c = n % self.n_cols
+        return (c * self.col_width, self.tops[c][n // self.n_cols])
+
+    @property
+    def height (self):
+        return max (self.bottoms, default = 0)
+
+    def slots_in_range (self, lo, hi):
+        '''Indices of cards overlapping vertical range [lo, hi]'''
+        slots = []
+        for c, tops in enumerate (self.tops):
+            first = max (0, bisect_right (tops, lo) - 1)
+            last  = bisect_right (tops, hi)
+            slots.extend (c + k * self.n_cols for k in range (first, last))
+        slots.sort ()
+        return slots
+
+def _init_worker (width_spec, config, image_store):
+    global _worker_md
+    from md2img import Markdown_Ext # fonts are loaded once per worker
+
+    _worker_md = Markdown_Ext (width_spec, config)
+    if image_store is not None:
+        _worker_md.image_loader = image_store.load
+
+def _render_job (job):
+    content, context, width = job
+    return render_card (_worker_md, content, context, width)
+
+@dataclass
+class RenderPool:
+    '''Renders cards in worker processes, each worker owns one Markdown_Ext'''
+    width_spec : List = field (default_factory = lambda: [(0, 0, 240)])
+    config     : dict = None
+    workers    : int  = 0 # 0 == one per core
+    image_store : object = None # ImageStore, workers never fetch, they only read its cache
+    _executor  : ProcessPoolExecutor = None
+
+    @staticmethod
+    def context ():
+        '''Start method of workers, never fork: the app forks with Tk, fetch and watcher threads running
+        and a child could inherit a lock held by one of them'''
+        if 'forkserver' in multiprocessing.get_all_start_methods ():
+            ctx = multiprocessing.get_context ('forkserver')
+            ctx.set_forkserver_preload (WORKER_PRELOAD)
+            return ctx
+        return multiprocessing.get_context ('spawn')
+
+    def start (self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor (max_workers = self.workers or os.cpu_count (),
+                                                  mp_context = self.context (),
+                                                  initializer = _init_worker,
+                                                  initargs = (list (self.width_spec), self.config, self.image_store))
+        return self._executor
+
+    def render (self, jobs):
+        '''jobs: list of (content, context, width), returns results of render_card in the same order'''
+        if len (jobs) == 0:
+            return []
+        executor  = self.start ()
+        chunksize = max (1, len (jobs) // ((self.workers or os.cpu_count ()) * 4))
+        return list (executor.map (_render_job, jobs, chunksize = chunksize))
+
+    def shutdown (self):
+        if self._executor is not None:
+            if sys.hexversion >= 0x03090000:
+                self._executor.shutdown (wait = False, cancel_futures = True)
+            else:
+                self._executor.shutdown (wait = False)
+            self._executor = None
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import sys
+if sys.hexversion < 0x03070000:
+    print("!!! This component requires Python version 3.7 at least !!!")
+    sys.exit(1)
+
+import time
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict
+
+import mdnoteman_trace as trace
+
+AUTOSAVE_DELAY     = 2  # seconds without new changes before dirty notes are written
+AUTOSAVE_MAX_DELAY = 30 # seconds a change may wait while edits keep coming
+
+def note_file_name (timestamp):
+    '''Daily note file a note is stored in'''
+    return datetime.fromtimestamp (timestamp).strftime ('%Y_%m_%d.md')
+
+@dataclass
+class AutoSaver:
+    '''Writes notes marked dirty in a Notebook to disk in background
+    Notes are snapshot when marked (on the GUI thread), coalesced per daily file and flushed by
+    one worker thread once no change came for delay seconds (max_delay at most)'''
+    delay     : float = AUTOSAVE_DELAY
+    max_delay : float = AUTOSAVE_MAX_DELAY
+    notebook  : object = None
+    _pending  : Dict = field (default_factory = lambda: {}, repr = False) # file -> {timestamp: (record, keep, refreshes)}
+    _writing  : int   = field (default = 0, repr = False) # notes of the batch being written
+    _first    : float = field (default = None, repr = False) # time of oldest pending change
+    _last     : float = field (default = None, repr = False) # time of newest pending change
+    _stop     : bool  = field (default = False, repr = False)
+    _thread   : threading.Thread = field (default = None, repr = False)
+    _cond     : threading.Condition = field (default_factory = threading.Condition, repr = False)
+    _flushing : threading.Lock = field (default_factory = threading.Lock, repr = False) # batches are written in order
+    _stats    : Dict = field (default_factory = lambda: {'flushes': 0, 'notes': 0, 'files': 0, 'errors': 0,
+                                                         'last_ms': 0.0, 'max_ms': 0.0, 'total_ms': 0.0,
+                                                         'modes': {}}, repr = False)
+
+    def attach (self, notebook):
+        '''Save dirty notes of notebook from now on, changes pending for a previous one are written first'''
+        if self.notebook is not None and self.notebook is not notebook:
+            self.flush ()
+            self.notebook.on_dirty = None
+        self.notebook = notebook
+        notebook.on_dirty = self.mark
+
+    def mark (self, note):
+        '''on_dirty callback of Notebook, keep a copy of note to be written to its daily file'''
+        if not self.notebook.path:
+            return
+        rec = note.dict
+        idx = self.notebook.find_note (note.timestamp)
+        if idx is not None:
+            rec ['prefer_idx'] = idx + 1
+        fn  = note_file_name (note.timestamp)
+        with self._cond:
+            self._pending.setdefault (fn, {}) [note.timestamp] = (rec, not note.deleted, self.notebook.refreshes)
+            now = time.monotonic ()
+            if self._first is None:
+                self._first = now
+            self._last = now
+            if self._thread is None:
+                self._stop   = False
+                self._thread = threading.Thread (target = self._run, name = 'autosave', daemon = True)
+                self._thread.start ()
+            self._cond.notify ()
+
+    @property
+    def pending (self):
+        '''(notes, files) waiting to be written, notes being written included'''
+        with self._cond:
+            return self._writing + sum (len (recs) for recs in self._pending.values ()), len (self._pending)
+
+    @property
+    def metrics (self):
+        with self._cond:
+            stats = dict (self._stats, modes = dict (self._stats['modes']))
+            stats ['pending_notes'] = self._writing + sum (len (recs) for recs in self._pending.values ())
+            stats ['pending_files'] = len (self._pending)
+        stats ['avg_ms'] = stats ['total_ms'] / stats ['flushes'] if stats ['flushes'] else 0.0
+        return stats
+
+    def _due (self):
+        return min (self._last + self.delay, self._first + self.max_delay)
+
+    def _take (self):
+        batch, self._pending = self._pending, {}
+        self._first = self._last = None
+        self._writing = sum (len (recs) for recs in batch.values ())
+        return batch
+
+    def _run (self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stop:
+                    self._cond.wait ()
+                while self._pending and not self._stop:
+                    wait = self._due () - time.monotonic ()
+                    if wait <= 0:
+                        break
+                    self._cond.wait (wait)
+                if self._stop:
+                    return
+            self.flush ()
+
+    def _write (self, batch):
+        '''Write a batch taken from pending, records of files that failed go back to pending'''
+        nb     = self.notebook
+        start  = time.perf_counter ()
+        failed = {}
+        notes  = files = 0
+        modes  = {}
+        with nb.io_lock, trace.span ('autosave'):
+            for fn, records in batch.items ():
+                # Notes dirtied before a Refresh are still dirty, Refresh wrote their latest version
+                records = {ts: (rec, keep) for ts, (rec, keep, refreshes) in records.items ()
+                           if refreshes == nb.refreshes}
+                if not records:
+                    continue
+                try:
+                    mode = nb.write_records (fn, records)
+                except OSError as err:
+                    print (f"Can not save notes to {fn} - {err}")
+                    failed [fn] = batch [fn]
+                    continue
+                modes [mode] = modes.get (mode, 0) + 1
+                notes += len (records)
+                files += 1
+            if files:
+                try:
+                    nb.save_manifest ()
+                except OSError as err:
+                    print (f"Can not save manifest - {err}")
+        elapsed = (time.perf_counter () - start) * 1000
+
+        with self._cond:
+            for fn, records in failed.items (): # retried with next change or after delay
+                newer = self._pending.setdefault (fn, {})
+                for ts, rec in records.items ():
+                    newer.setdefault (ts, rec)
+            if failed:
+                self._first = self._last = time.monotonic ()
+            self._writing = 0
+            stats = self._stats
+            stats ['flushes']  += 1
+            stats ['notes']    += notes
+            stats ['files']    += files
+            stats ['errors']   += len (failed)
+            stats ['last_ms']   = elapsed
+            stats ['max_ms']    = max (stats ['max_ms'], elapsed)
+            stats ['total_ms'] += elapsed
+            for mode, n in modes.items ():
+                stats ['modes'][mode] = stats ['modes'].get (mode, 0) + n
+
+    def flush (self):
+        '''Write all pending changes now, in calling thread'''
+        with self._flushing:
+            with self._cond:
+                batch = self._take ()
+            if batch:
+                self._write (batch)
+
+    def stop (self):
+        '''Stop worker thread and write what is still pending'''
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._stop = True
+            self._cond.notify ()
+        if thread is not None:
+            thread.join ()
+        self.flush ()
+
+if __name__ == '__main__':
+    pass
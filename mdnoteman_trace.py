@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+import sys
+if sys.hexversion < 0x03070000:
+    print("!!! This component requires Python version 3.7 at least !!!")
+    sys.exit(1)
+
+import os
+import json
+import time
+import platform
+import threading
+import functools
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+from typing import Dict
+
+TRACE_SIZE    = 4096 # spans kept in ring buffer
+SUMMARY_BURST = 2.0  # seconds, root spans this close to the last one are summed up in summary
+
+@dataclass
+class Span:
+    name          : str   = ''
+    start         : float = 0.0 # wall clock, seconds
+    ms            : float = 0.0
+    items         : int   = 0
+    bytes_read    : int   = 0
+    bytes_written : int   = 0
+    depth         : int   = 0 # spans open in same thread when this one started
+    thread        : str   = ''
+
+@dataclass
+class Tracer:
+    '''Durations, items processed and bytes read/written of named spans, recent spans are kept in a ring buffer
+    Spans nest per thread, add () accounts to the innermost open span of calling thread'''
+    size     : int  = TRACE_SIZE
+    enabled  : bool = True
+    version  : int  = 0 # bumped each time a span ends
+    spans    : deque = None
+    totals   : Dict = field (default_factory = lambda: {}) # name -> {count, ms, max_ms, items, bytes_read, bytes_written}
+    counters : Dict = field (default_factory = lambda: {})
+    _lock    : threading.Lock = field (default_factory = threading.Lock, repr = False)
+    _local   : threading.local = field (default_factory = threading.local, repr = False)
+
+    def __post_init__ (self):
+        if self.spans is None:
+            self.spans = deque (maxlen = self.size)
+
+    def _stack (self):
+        stack = getattr (self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def span (self, name, items = 0):
+        if not self.enabled:
+            yield None
+            return
+        stack = self._stack ()
+        span  = Span (name = name, start = time.time (), items = items, depth = len (stack),
+                      thread = threading.current_thread ().name)
+        stack.append (span)
+        t0 = time.perf_counter ()
+        try:
+            yield span
+        finally:
+            span.ms = (time.perf_counter () - t0) * 1000
+            stack.pop ()
+            self.record (span)
+
+    def traced (self, name):
+        '''Decorator, run function in a span'''
+        def wrap (fn):
+            @functools.wraps (fn)
+            def traced_fn (*args, **kwargs):
+                with self.span (name):
+                    return fn (*args, **kwargs)
+            return traced_fn
+        return wrap
+
+    def add (self, items = 0, bytes_read = 0, bytes_written = 0):
+        stack = self._stack () if self.enabled else None
+        if stack:
+            span = stack [-1]
+            span.items         += items
+            span.bytes_read    += bytes_read
+            span.bytes_written += bytes_written
+
+    def count (self, name, n = 1):
+        with self._lock:
+            self.counters [name] = self.counters.get (name, 0) + n
+
+    def record (self, span):
+        with self._lock:
+            self.spans.append (span)
+            total = self.totals.get (span.name)
+            if total is None:
+                total = self.totals [span.name] = {'count': 0, 'ms': 0.0, 'max_ms': 0.0,
+                                                   'items': 0, 'bytes_read': 0, 'bytes_written': 0}
+            total ['count']         += 1
+            total ['ms']            += span.ms
+            total ['max_ms']         = max (total ['max_ms'], span.ms)
+            total ['items']         += span.items
+            total ['bytes_read']    += span.bytes_read
+            total ['bytes_written'] += span.bytes_written
+            self.version += 1
+
+    def recent (self):
+        '''Root spans of the last burst of activity summed up by name, list of (span, count) in order of start'''
+        with self._lock:
+            spans = list (self.spans)
+        burst = {}
+        last  = None
+        for span in reversed (spans):
+            if span.depth > 0:
+                continue
+            end = span.start + span.ms / 1000
+            if last is None:
+                last = end
+            elif last - end > SUMMARY_BURST:
+                break
+            if span.name not in burst:
+                burst [span.name] = [Span (name = span.name, thread = span.thread), 0]
+            total, n = burst [span.name]
+            total.start          = span.start
+            total.ms            += span.ms
+            total.items         += span.items
+            total.bytes_read    += span.bytes_read
+            total.bytes_written += span.bytes_written
+            burst [span.name][1] = n + 1
+        return sorted (((total, n) for total, n in burst.values ()), key = lambda sn: sn[0].start)
+
+    def summary (self):
+        parts = []
+        for span, n in self.recent ():
+            info = []
+            if span.items:
+                info.append (f"{span.items} items")
+            if span.bytes_read:
+                info.append (f"{format_bytes (span.bytes_read)} read")
+            if span.bytes_written:
+                info.append (f"{format_bytes (span.bytes_written)} written")
+            name = span.name if n == 1 else f"{span.name} x{n}"
+            parts.append (f"{name} {span.ms:.1f} ms" + (f" ({', '.join (info)})" if info else ''))
+        return ' | '.join (parts)
+
+    def dump (self, path):
+        '''Write totals, counters and all spans in ring buffer to a JSON file at path'''
+        with self._lock:
+            trace = {'time': time.strftime ('%Y-%m-%dT%H:%M:%S'), 'pid': os.getpid (),
+                     'python': platform.python_version (), 'platform': platform.platform (),
+                     'totals': {name: dict (total) for name, total in self.totals.items ()},
+                     'counters': dict (self.counters),
+                     'spans': [asdict (span) for span in self.spans]}
+        folder = os.path.dirname (path)
+        if folder:
+            os.makedirs (folder, exist_ok = True)
+        with open (path, 'w') as f:
+            json.dump (trace, f, indent = 1)
+        return path
+
+def format_bytes (n):
+    for unit in ('B', 'KB', 'MB'):
+        if n < 1024 or unit == 'MB':
+            return f"{n:.0f} {unit}" if unit == 'B' else f"{n:.1f} {unit}"
+        n /= 1024
+
+tracer  = Tracer () # process wide
+span    = tracer.span
+traced  = tracer.traced
+add     = tracer.add
+count   = tracer.count
+summary = tracer.summary
+dump    = tracer.dump
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+import sys
+if sys.hexversion < 0x03070000:
+    print("!!! This component requires Python version 3.7 at least !!!")
+    sys.exit(1)
+
+import os
+import errno
+import select
+import struct
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict
+
+POLL_INTERVAL = 1.0 # seconds between scans of the polling backend
+WATCH_SETTLE  = 0.2 # seconds without events before changed files are reported
+
+# inotify (7)
+IN_MODIFY      = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+IN_EVENT       = struct.Struct ('iIII') # wd, mask, cookie, len, then len bytes of name
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+def inotify_open (path):
+    '''inotify file descriptor watching path, None if inotify is not available'''
+    if not sys.platform.startswith ('linux'):
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL (None, use_errno = True)
+        fd = libc.inotify_init1 (IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch (fd, os.fsencode (path), WATCH_MASK) < 0:
+            os.close (fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+def parse_events (data):
+    '''Yield (mask, name) of inotify events read in data'''
+    pos = 0
+    while pos + IN_EVENT.size <= len (data):
+        wd, mask, cookie, length = IN_EVENT.unpack_from (data, pos)
+        pos += IN_EVENT.size
+        name = data [pos:pos + length].rstrip (b'\0')
+        pos += length
+        yield mask, os.fsdecode (name)
+
+@dataclass
+class Watcher:
+    '''Reports files of a folder that were created, changed, renamed or removed, e.g. by another editor
+    Uses inotify on Linux and scans folder every interval seconds elsewhere
+    on_change (names) is called from the watcher thread, with names matching pattern (hidden files never do),
+    names is None if events were lost and any file may have changed'''
+    path      : str      = None
+    on_change : Callable = None
+    pattern   : object   = None # compiled regex, whole file name must match
+    interval  : float    = POLL_INTERVAL
+    settle    : float    = WATCH_SETTLE
+    backend   : str      = None # 'inotify' or 'poll' once started
+    _thread   : threading.Thread = field (default = None, repr = False)
+    _stop     : threading.Event  = field (default_factory = threading.Event, repr = False)
+    _wake     : tuple = field (default = None, repr = False) # pipe waking up inotify thread on stop
+    _files    : Dict  = field (default_factory = lambda: {}, repr = False) # name -> (mtime, size) for polling
+
+    def match (self, name):
+        return not name.startswith ('.') and (self.pattern is None or self.pattern.fullmatch (name) is not None)
+
+    def scan (self):
+        files = {}
+        try:
+            with os.scandir (self.path) as it:
+                for entry in it:
+                    if self.match (entry.name):
+                        try:
+                            st = entry.stat ()
+                        except OSError:
+                            continue
+                        files [entry.name] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            pass
+        return files
+
+    def start (self):
+        if self._thread is not None:
+            return
+        self._stop.clear ()
+        fd = inotify_open (self.path)
+        if fd is not None:
+            self.backend = 'inotify'
+            self._wake   = os.pipe ()
+            target = lambda: self._run_inotify (fd)
+        else:
+            self.backend = 'poll'
+            self._files  = self.scan ()
+            target = self._run_poll
+        self._thread = threading.Thread (target = target, name = 'watcher', daemon = True)
+        self._thread.start ()
+
+    def stop (self):
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._stop.set ()
+        if self._wake is not None:
+            os.write (self._wake[1], b'\0')
+        thread.join ()
+        if self._wake is not None:
+            for fd in self._wake:
+                os.close (fd)
+            self._wake = None
+
+    def _report (self, names):
+        if (names is None or names) and self.on_change is not None:
+            self.on_change (names)
+
+    def _run_inotify (self, fd):
+        changed = set ()
+        lost    = False
+        try:
+            while not self._stop.is_set ():
+                # Wait for first event, then until events settle down
+                ready, _, _ = select.select ([fd, self._wake[0]], [], [], self.settle if changed or lost else None)
+                if self._wake[0] in ready:
+                    break
+                if fd not in ready:
+                    self._report (None if lost else changed)
+                    changed = set ()
+                    lost    = False
+                    continue
+                try:
+                    data = os.read (fd, 64 * 1024)
+                except OSError as err:
+                    if err.errno in (errno.EAGAIN, errno.EINTR):
+                        continue
+                    raise
+                for mask, name in parse_events (data):
+                    if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF):
+                        lost = True
+                    elif self.match (name):
+                        changed.add (name)
+        finally:
+            os.close (fd)
+
+    def _run_poll (self):
+        while not self._stop.wait (self.interval):
+            files   = self.scan ()
+            changed = set (name for name in files.keys () | self._files.keys ()
+                           if files.get (name) != self._files.get (name))
+            self._files = files
+            self._report (changed)
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,148 @@
+import io
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+from PIL import Image
+
+from mdnoteman_fetch import ImageStore, ImageFetcher
+
+def png (color, size = (4, 2)):
+    bio = io.BytesIO ()
+    Image.new ('RGB', size, color).save (bio, format = 'PNG')
+    return bio.getvalue ()
+
+class Handler (BaseHTTPRequestHandler):
+    '''/img.png is served with an ETag and revalidated, /missing.png is a 404, /flaky.png fails until fixed'''
+    def do_GET (self):
+        server = self.server
+        server.requests.append ((self.path, self.headers.get ('If-None-Match')))
+        if self.path == '/img.png' or (self.path == '/flaky.png' and server.fixed):
+            etag = f'"{server.version}"'
+            if self.headers.get ('If-None-Match') == etag:
+                self.send_response (304)
+                self.end_headers ()
+                return
+            body = server.images [server.version]
+            self.send_response (200)
+            self.send_header ('Content-Type', 'image/png')
+            self.send_header ('Content-Length', str (len (body)))
+            self.send_header ('ETag', etag)
+            self.end_headers ()
+            self.wfile.write (body)
+        else:
+            self.send_response (404)
+            self.end_headers ()
+
+    def log_message (self, *args):
+        pass
+
+@pytest.fixture (autouse = True)
+def no_proxy (monkeypatch):
+    for name in ('http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY', 'ALL_PROXY', 'all_proxy'):
+        monkeypatch.delenv (name, raising = False)
+
+@pytest.fixture
+def server ():
+    httpd = HTTPServer (('127.0.0.1', 0), Handler)
+    httpd.requests = []
+    httpd.images   = [png ('red'), png ('blue', (6, 3))]
+    httpd.version  = 0
+    httpd.fixed    = False
+    thread = threading.Thread (target = httpd.serve_forever, kwargs = {'poll_interval': 0.05}, daemon = True)
+    thread.start ()
+    yield httpd
+    httpd.shutdown ()
+    httpd.server_close ()
+
+def url (server, path):
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+@pytest.fixture
+def store (tmp_path):
+    return ImageStore (path = str (tmp_path / 'images'), base_path = str (tmp_path))
+
+def test_not_fetched_is_pending (server, store):
+    assert store.load (url (server, '/img.png')) == (None, True)
+    assert server.requests == []
+
+def test_fetch_then_load (server, store):
+    src = url (server, '/img.png')
+    assert store.fetch (src)
+    img, pending = store.load (src)
+    assert not pending
+    assert img.size == (4, 2) and img.getpixel ((0, 0)) == (255, 0, 0, 255)
+    assert store.meta (src)['etag'] == '"0"'
+
+def test_load_downscales_to_max_width (server, store):
+    server.version = 1
+    src = url (server, '/img.png')
+    store.fetch (src)
+    img, pending = store.load (src, max_width = 2)
+    assert img.size == (2, 1) and not pending
+
+def test_stale_copy_is_revalidated (server, store):
+    src = url (server, '/img.png')
+    store.fetch (src)
+    store.max_age = -1
+    img, pending = store.load (src)
+    assert img is not None and pending # still drawn, checked again
+
+    assert store.fetch (src)
+    assert server.requests [-1] == ('/img.png', '"0"')
+    store.max_age = 60
+    img, pending = store.load (src)
+    assert img.size == (4, 2) and not pending
+
+def test_changed_image_replaces_cached_copy (server, store):
+    src = url (server, '/img.png')
+    store.fetch (src)
+    server.version = 1
+    assert store.fetch (src)
+    img, pending = store.load (src)
+    assert img.size == (6, 3) and img.getpixel ((0, 0)) == (0, 0, 255, 255)
+    assert store.meta (src)['etag'] == '"1"'
+
+def test_failed_fetch_stays_pending (server, store):
+    src = url (server, '/missing.png')
+    assert not store.fetch (src)
+    assert store.meta (src)['status'] == 'failed'
+    assert store.load (src) == (None, True)
+
+def test_failed_fetch_recovers (server, store):
+    src = url (server, '/flaky.png')
+    assert not store.fetch (src)
+    assert store.load (src)[1]
+    server.fixed = True
+    assert store.fetch (src)
+    img, pending = store.load (src)
+    assert img is not None and not pending
+
+def test_unreachable_host_stays_pending (store):
+    src = 'http://127.0.0.1:9/none.png' # discard port, nothing listens
+    assert not store.fetch (src, timeout = 2)
+    assert store.load (src) == (None, True)
+
+def test_local_images (tmp_path, store):
+    (tmp_path / 'pic.png').write_bytes (png ('red'))
+    img, pending = store.load ('pic.png')
+    assert img.size == (4, 2) and not pending
+    assert store.load ('nothing.png') == (None, False)
+
+def test_fetcher_calls_back_once_per_request (server, store):
+    ready = []
+    done  = threading.Event ()
+    def on_ready (src):
+        ready.append (src)
+        done.set ()
+    fetcher = ImageFetcher (store = store, on_ready = on_ready)
+    src = url (server, '/img.png')
+    try:
+        fetcher.request (src)
+        assert done.wait (10)
+        fetcher.request (src) # within retry_after, not fetched again
+    finally:
+        fetcher.shutdown ()
+    assert ready == [src]
+    assert [path for path, _ in server.requests] == ['/img.png']
+    assert store.load (src)[0] is not None
@@ -0,0 +1,181 @@
+import time
+import random
+
+import pytest
+
+import mdnoteman_core
+import mdnoteman_dsl as dsl
+from mdnoteman_core import Notebook
+
+TAGS   = ['a', 'b', 'c', 'Mixed', 'todo']
+LABELS = ['work', 'work/proj', 'work/proj/x', 'home', 'Home/garden']
+WORDS  = ['alpha', 'beta', 'gamma', 'delta', 'alphabet', 'Beta', 'meeting', 'notes']
+
+QUERIES = [
+    'tag a',
+    'tags a, b',
+    'tag mixed',
+    'label work',
+    'label work/proj',
+    'label home',
+    'not tag a',
+    'tag a & label home',
+    '(tag a | tag b) & label work',
+    '! label home | tag c',
+    '"alpha"',
+    '"alpha beta"',
+    '"lph"',
+    '"Beta  gamma"',
+    'tag a & not "beta"',
+    'label work | "meeting"',
+]
+
+def random_rec (rnd, timestamp):
+    return {'timestamp': timestamp,
+            'color': '#FFFFFF',
+            'prefer_idx': 0,
+            'tags': sorted (rnd.sample (TAGS, rnd.randrange (0, 3))),
+            'labels': sorted (rnd.sample (LABELS, rnd.randrange (0, 3))),
+            'content': ' '.join (rnd.choice (WORDS) for _ in range (rnd.randrange (1, 12)))}
+
+def make_notebook (seed = 1, count = 300):
+    rnd = random.Random (seed)
+    nb  = Notebook ()
+    for i in range (count):
+        nb.add_note (random_rec (rnd, 1000 + i))
+    return nb, rnd
+
+def parse (query):
+    lexer = dsl.get_lexer ()
+    lexer.input (dsl.normalize_query (query))
+    return dsl.build_ast (lexer)
+
+def brute_force (nb, query):
+    '''Notes matching query by walking its AST with Node.analyze, the evaluator filter used before plans'''
+    ast = parse (query)
+    return set (note.timestamp for note in nb.notes
+                if not note.deleted and ast.analyze (tags = note.tags, labels = note.labels, ctn = note.content))
+
+def random_query (rnd, depth = 0):
+    '''Query of tag, label and content terms joined by &, | and not, in parentheses at random'''
+    if depth > 2 or rnd.random () < 0.4:
+        kind = rnd.randrange (3)
+        if kind == 0:
+            return 'tags ' + ', '.join (rnd.sample (TAGS, rnd.randrange (1, 3)))
+        if kind == 1:
+            return 'labels ' + rnd.choice (LABELS)
+        return '"' + ' '.join (rnd.sample (WORDS, rnd.randrange (1, 3)))[:rnd.randrange (3, 20)].strip () + '"'
+    query = random_query (rnd, depth + 1) + rnd.choice ([' & ', ' | ', ' and not ']) + random_query (rnd, depth + 1)
+    if rnd.random () < 0.3:
+        query = '(' + query + ')'
+    return ('not ' if rnd.random () < 0.2 else '') + query
+
+def selected (nb, query):
+    return set (dsl.compile_query (query).select (nb))
+
+def check_all (nb):
+    for query in QUERIES:
+        try:
+            ids = selected (nb, query)
+        except dsl.PlanError:
+            with pytest.raises (ValueError): # analyze fails on some note as well
+                brute_force (nb, query)
+            continue
+        assert ids == brute_force (nb, query), query
+
+@pytest.mark.parametrize ('query', QUERIES)
+def test_select_matches_brute_force (query):
+    nb, _ = make_notebook ()
+    assert selected (nb, query) == brute_force (nb, query)
+
+def test_compiled_predicate_matches_analyze ():
+    nb, _ = make_notebook (seed = 3, count = 100)
+    for query in QUERIES:
+        q, ast = dsl.compile_query (query), parse (query)
+        for note in nb.notes:
+            assert q.match (note.tags, note.labels, note.content) == \
+                   ast.analyze (tags = note.tags, labels = note.labels, ctn = note.content), (query, note.timestamp)
+
+@pytest.mark.parametrize ('seed', range (5))
+def test_random_queries (seed, monkeypatch):
+    nb, rnd = make_notebook (seed = seed, count = 200)
+    for n in range (60):
+        query = random_query (rnd)
+        if n % 2:
+            monkeypatch.setattr (dsl.Query, 'REFINE_LIMIT', 0)
+        else:
+            monkeypatch.undo ()
+        try:
+            ids = selected (nb, query)
+        except dsl.PlanError:
+            with pytest.raises (ValueError): # analyze fails on some note as well
+                brute_force (nb, query)
+            continue
+        assert ids == brute_force (nb, query), query
+
+@pytest.mark.parametrize ('query', ['tags a & labels', '!', 'tags !', 'not', '(tags a'])
+def test_invalid_plan (query):
+    '''Queries analyze can not evaluate do not compile either, filter then shows all cards'''
+    nb, _ = make_notebook (count = 10)
+    with pytest.raises (ValueError):
+        brute_force (nb, query)
+    with pytest.raises (dsl.PlanError):
+        dsl.compile_query (query)
+
+def test_select_on_index_only (monkeypatch):
+    '''AND refines on notes once few candidates are left, keep every term on the index'''
+    monkeypatch.setattr (dsl.Query, 'REFINE_LIMIT', 0)
+    nb, _ = make_notebook ()
+    check_all (nb)
+
+def test_content_scan_then_full_text_index ():
+    nb, _ = make_notebook ()
+    expected = brute_force (nb, '"alpha beta"')
+    for _ in range (mdnoteman_core.FT_INDEX_AFTER):
+        assert selected (nb, '"alpha beta"') == expected
+        assert not nb._ft_idx_ready
+    assert selected (nb, '"alpha beta"') == expected
+    assert nb._ft_idx_ready
+    check_all (nb)
+
+@pytest.mark.parametrize ('full_text', [False, True])
+def test_index_follows_changes (full_text):
+    nb, rnd = make_notebook (seed = 2)
+    nb.build_query_index (full_text = full_text)
+    check_all (nb)
+
+    for i in range (20):
+        nb.add_note (random_rec (rnd, 5000 + i))
+    check_all (nb)
+
+    for _ in range (40):
+        idx  = rnd.randrange (len (nb.notes))
+        rec  = random_rec (rnd, nb.notes [idx].timestamp)
+        nb.update_note (idx, rec)
+    check_all (nb)
+
+    # Edit moving a note to another timestamp
+    note = nb.notes [3]
+    rec  = dict (note.dict, timestamp = 9999, tags = ['todo'], content = 'alpha beta moved')
+    nb.update_note (note, rec)
+    assert 9999 in selected (nb, '"alpha beta"') and 9999 in selected (nb, 'tag todo')
+    check_all (nb)
+
+    for _ in range (30):
+        nb.remove_note (rnd.randrange (len (nb.notes)), delete = True)
+    check_all (nb)
+
+def test_case_insensitive_tags_and_labels ():
+    nb = Notebook ()
+    nb.add_note ({'timestamp': 1, 'tags': ['Mixed'], 'labels': ['Home/Garden'], 'content': 'x', 'color': '#FFFFFF', 'prefer_idx': 0})
+    assert selected (nb, 'tag MIXED') == {1}
+    assert selected (nb, 'label home') == {1}
+    assert selected (nb, 'label home/garden') == {1}
+    assert selected (nb, 'label garden') == set ()
+
+def test_long_query_after_content_term ():
+    '''Content token regex used to backtrack exponentially on the words after a quoted term'''
+    start = time.perf_counter ()
+    query = '"alpha beta" & ' + ' & '.join (f'tags t{i}' for i in range (40))
+    assert dsl.compile_query (query).plan [0] == 'AND'
+    assert time.perf_counter () - start < 1
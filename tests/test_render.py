@@ -0,0 +1,52 @@
+import os
+import time
+from types import SimpleNamespace
+
+from mdnoteman_fetch import ImageStore, image_sources
+from mdnoteman_render import ThumbnailCache
+
+MD = SimpleNamespace (fingerprint = 'fonts') # key only reads the fingerprint of Markdown_Ext
+
+def test_image_sources ():
+    text = ("# Title ![a](pic.png) and ![b]( <http://x.org/b.jpg> \"title\")\n"
+            "<p><IMG alt='c' src='dir/c.gif'></p>\n"
+            "[ref]: http://x.org/d.png\n"
+            "a [link](page.html) is no image")
+    assert image_sources (text) == ['pic.png', 'http://x.org/b.jpg', 'dir/c.gif', 'http://x.org/d.png']
+    assert image_sources ('no images here') == []
+
+def touch (path, data):
+    path.write_bytes (data)
+    st = path.stat ()
+    os.utime (path, ns = (st.st_atime_ns, st.st_mtime_ns + 1000000000)) # mtime changes even on a coarse clock
+
+def test_key_follows_local_image (tmp_path):
+    store = ImageStore (path = str (tmp_path / 'images'), base_path = str (tmp_path))
+    cache = ThumbnailCache (path = str (tmp_path / 'thumbs'), image_store = store)
+    content = 'see ![pic](pic.png)'
+    missing = cache.key (MD, content, '', 240)
+    touch (tmp_path / 'pic.png', b'one')
+    first = cache.key (MD, content, '', 240)
+    assert first != missing
+    assert cache.key (MD, content, '', 240) == first
+    touch (tmp_path / 'pic.png', b'two')
+    assert cache.key (MD, content, '', 240) != first
+
+def test_key_follows_cached_remote_copy (tmp_path):
+    store = ImageStore (path = str (tmp_path / 'images'))
+    cache = ThumbnailCache (path = str (tmp_path / 'thumbs'), image_store = store)
+    src = 'http://x.org/a.png'
+    content = f'![a]({src})'
+    store.save (src, {'src': src, 'status': 'ok', 'etag': '"1"', 'checked': time.time ()}, b'one')
+    first = cache.key (MD, content, '', 240)
+    store.save (src, {'src': src, 'status': 'ok', 'etag': '"1"', 'checked': time.time () + 10}) # revalidated, 304
+    assert cache.key (MD, content, '', 240) == first
+    time.sleep (0.01)
+    store.save (src, {'src': src, 'status': 'ok', 'etag': '"2"', 'checked': time.time ()}, b'changed')
+    assert cache.key (MD, content, '', 240) != first
+
+def test_key_of_card_without_images (tmp_path):
+    cache = ThumbnailCache (path = str (tmp_path / 'thumbs'), image_store = ImageStore (path = str (tmp_path)))
+    plain = ThumbnailCache (path = str (tmp_path / 'thumbs'))
+    assert cache.key (MD, 'text', '#tag', 240) == plain.key (MD, 'text', '#tag', 240)
+    assert cache.key (MD, 'text', '#tag', 240) != cache.key (MD, 'text', '#tag', 200)
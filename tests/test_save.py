@@ -0,0 +1,92 @@
+import os
+import time
+
+import pytest
+
+from mdnoteman_core import Notebook, read_note_file
+from mdnoteman_save import AutoSaver, note_file_name
+
+TS = int (time.mktime ((2024, 3, 5, 12, 0, 0, 0, 0, -1)))
+
+def rec (timestamp, content = 'text', tags = ()):
+    return {'timestamp': timestamp, 'content': content, 'tags': list (tags), 'labels': [],
+            'color': '#FFFFFF', 'prefer_idx': 0}
+
+def wait_for (cond, timeout = 5):
+    end = time.monotonic () + timeout
+    while not cond ():
+        if time.monotonic () > end:
+            return False
+        time.sleep (0.01)
+    return True
+
+def on_disk (nb, timestamp):
+    path = os.path.join (nb.path, note_file_name (timestamp))
+    if not os.path.exists (path):
+        return {}
+    return {r['timestamp']: r for r in read_note_file (path)}
+
+@pytest.fixture
+def notebook (tmp_path):
+    path = tmp_path / 'notes'
+    path.mkdir ()
+    return Notebook (path = str (path), cache_path = str (tmp_path / 'cache'))
+
+@pytest.fixture
+def saver (notebook):
+    saver = AutoSaver (delay = 0.05, max_delay = 1)
+    saver.attach (notebook)
+    yield saver
+    saver.stop ()
+
+def test_dirty_note_written_after_delay (notebook, saver):
+    notebook.add_note (rec (TS, 'hello', ['a']), set_dirty = True)
+    assert saver.pending == (1, 1)
+    assert wait_for (lambda: saver.pending == (0, 0))
+    got = on_disk (notebook, TS)
+    assert got [TS]['content'] == 'hello' and got [TS]['tags'] == ['a']
+    assert note_file_name (TS) in notebook.manifest
+
+def test_changes_coalesced_per_note (notebook, saver):
+    saver.delay = 0.3
+    notebook.add_note (rec (TS, 'v0'), set_dirty = True)
+    for i in range (1, 5):
+        notebook.update_note (notebook.get_note (TS), rec (TS, f'v{i}'), set_dirty = True)
+    assert saver.pending == (1, 1)
+    assert wait_for (lambda: saver.metrics ['flushes'] >= 1)
+    assert saver.metrics ['notes'] == 1
+    assert on_disk (notebook, TS)[TS]['content'] == 'v4'
+
+def test_notes_of_one_day_share_a_file (notebook, saver):
+    for i in range (3):
+        notebook.add_note (rec (TS + i, f'note {i}'), set_dirty = True)
+    notebook.add_note (rec (TS + 86400, 'next day'), set_dirty = True)
+    assert saver.pending == (4, 2)
+    assert wait_for (lambda: saver.pending == (0, 0))
+    assert sorted (on_disk (notebook, TS)) == [TS, TS + 1, TS + 2]
+    assert list (on_disk (notebook, TS + 86400)) == [TS + 86400]
+
+def test_stop_writes_pending (notebook):
+    saver = AutoSaver (delay = 60, max_delay = 60)
+    saver.attach (notebook)
+    notebook.add_note (rec (TS, 'late'), set_dirty = True)
+    saver.stop ()
+    assert saver.pending == (0, 0)
+    assert on_disk (notebook, TS)[TS]['content'] == 'late'
+
+def test_deleted_note_removed_from_file (notebook, saver):
+    notebook.add_note (rec (TS, 'keep'), set_dirty = True)
+    notebook.add_note (rec (TS + 1, 'drop'), set_dirty = True)
+    saver.flush ()
+    notebook.mark_dirty (notebook.get_note (TS + 1), delete = True)
+    saver.flush ()
+    assert list (on_disk (notebook, TS)) == [TS]
+
+def test_changes_before_refresh_left_to_it (notebook, saver):
+    saver.delay = 60
+    saver.max_delay = 60
+    notebook.add_note (rec (TS, 'first'), set_dirty = True)
+    notebook.Refresh () # writes the note itself
+    os.remove (os.path.join (notebook.path, note_file_name (TS)))
+    saver.flush ()
+    assert on_disk (notebook, TS) == {} # stale copy of autosave not written
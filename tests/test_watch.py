@@ -0,0 +1,73 @@
+import os
+import queue
+
+import pytest
+
+import mdnoteman_watch
+from mdnoteman_core import note_file_re
+from mdnoteman_watch import Watcher
+
+@pytest.fixture (params = ['inotify', 'poll'])
+def watch (request, tmp_path, monkeypatch):
+    '''Started watcher of tmp_path and the queue of reported names'''
+    if request.param == 'poll':
+        monkeypatch.setattr (mdnoteman_watch, 'inotify_open', lambda path: None)
+    else:
+        fd = mdnoteman_watch.inotify_open (str (tmp_path))
+        if fd is None:
+            pytest.skip ('inotify not available')
+        os.close (fd)
+    changes = queue.Queue ()
+    watcher = Watcher (path = str (tmp_path), on_change = changes.put, pattern = note_file_re,
+                       interval = 0.05, settle = 0.05)
+    watcher.start ()
+    assert watcher.backend == request.param
+    yield tmp_path, changes
+    watcher.stop ()
+
+def reported (changes, timeout = 5):
+    '''Names reported until nothing more comes for a while'''
+    names = set (changes.get (timeout = timeout))
+    while True:
+        try:
+            names |= changes.get (timeout = 0.2)
+        except queue.Empty:
+            return names
+
+def test_created_file_reported (watch):
+    path, changes = watch
+    (path / '2024_01_01.md').write_text ('@[1]\n')
+    assert reported (changes) == {'2024_01_01.md'}
+
+def test_modified_and_removed_file_reported (watch):
+    path, changes = watch
+    note = path / '2024_01_01.md'
+    note.write_text ('@[1]\n')
+    reported (changes)
+    with open (note, 'a') as f:
+        f.write ('more text\n')
+    assert reported (changes) == {'2024_01_01.md'}
+    note.unlink ()
+    assert reported (changes) == {'2024_01_01.md'}
+
+def test_renamed_file_reported_under_both_names (watch):
+    path, changes = watch
+    (path / '2024_01_01.md').write_text ('@[1]\n')
+    reported (changes)
+    os.replace (path / '2024_01_01.md', path / '2024_01_02.md')
+    assert reported (changes) == {'2024_01_01.md', '2024_01_02.md'}
+
+def test_other_files_ignored (watch):
+    path, changes = watch
+    (path / '.2024_01_01.md.swp').write_text ('x')
+    (path / 'readme.txt').write_text ('x')
+    (path / '2024_01_03.md').write_text ('@[3]\n')
+    assert reported (changes) == {'2024_01_03.md'}
+
+def test_stop_ends_thread (tmp_path):
+    watcher = Watcher (path = str (tmp_path), on_change = lambda names: None, interval = 0.05)
+    watcher.start ()
+    thread = watcher._thread
+    watcher.stop ()
+    assert not thread.is_alive ()
+    watcher.stop () # twice is harmless
@@ -0,0 +1,95 @@
+import pytest
+
+from mdnoteman_core import write_note_file, read_note_file, NOTE_ENCODING
+
+def rec (timestamp, content = 'text', tags = (), labels = (), color = '#FFFFFF', prefer_idx = 0):
+    return {'timestamp': timestamp, 'content': content, 'tags': list (tags), 'labels': list (labels),
+            'color': color, 'prefer_idx': prefer_idx, 'links': []}
+
+def note_file (tmp_path, text, newline = '\n'):
+    path = tmp_path / '2024_01_01.md'
+    path.write_bytes (text.replace ('\n', newline).encode (NOTE_ENCODING))
+    return str (path)
+
+def notes (path):
+    return {r['timestamp']: r for r in read_note_file (path)}
+
+@pytest.mark.parametrize ('newline', ['\n', '\r\n'])
+def test_delete_and_append_without_trailing_newline (tmp_path, newline):
+    path = note_file (tmp_path, "@[1691]\n[color:#FFFFFF]\n[idx:1]\nline1\nline2", newline)
+    write_note_file (path, {1691: (rec (1691), False), 2025: (rec (2025, 'new'), True)})
+    got = notes (path)
+    assert list (got) == [2025]
+    assert got [2025]['content'] == 'new'
+
+@pytest.mark.parametrize ('newline', ['\n', '\r\n'])
+def test_append_after_header_only_note (tmp_path, newline):
+    path = note_file (tmp_path, "@[1057]\n[color:#FFFFFF]\n[idx:7]\nfirst\n\n"
+                                "@[1746]\n[color:#FFFFFF]\n[idx:8]", newline)
+    write_note_file (path, {1057: (rec (1057), False), 2090: (rec (2090, 'new', color = '#FFF2AB', prefer_idx = 9), True)})
+    got = notes (path)
+    assert list (got) == [1746, 2090]
+    assert got [1746]['content'] == ''
+    assert got [2090]['color'] == '#FFF2AB' and got [2090]['prefer_idx'] == 9
+    assert got [2090]['content'] == 'new'
+
+@pytest.mark.parametrize ('text', ["@[1]\n[color:#FFFFFF]\n[idx:1]\nabc",
+                                   "@[1]\n[color:#FFFFFF]\n[idx:1]\nabc\n",
+                                   "@[1]\n[color:#FFFFFF]\n[idx:1]"])
+def test_append_in_place (tmp_path, text):
+    path = note_file (tmp_path, text)
+    assert write_note_file (path, {2: (rec (2, 'two'), True)}) == 'append'
+    got = notes (path)
+    assert list (got) == [1, 2]
+    assert got [2]['content'] == 'two'
+
+def test_append_to_empty_file (tmp_path):
+    path = note_file (tmp_path, '')
+    write_note_file (path, {5: (rec (5, 'five'), True)})
+    with open (path, 'rb') as f:
+        assert f.read ().startswith (b'@[5]')
+    assert list (notes (path)) == [5]
+
+def test_new_file (tmp_path):
+    path = str (tmp_path / '2024_01_02.md')
+    write_note_file (path, {5: (rec (5, 'five', tags = ['a']), True)})
+    got = notes (path)
+    assert got [5]['tags'] == ['a']
+
+def test_untouched_notes_kept_byte_for_byte (tmp_path):
+    text = "@[1]\n[color:#FFFFFF]\n[idx:1]\n#x\n  odd   spacing\n\n\n@[2]\n[color:#FFFFFF]\n[idx:2]\nold\n\n"
+    path = note_file (tmp_path, text)
+    write_note_file (path, {2: (rec (2, 'a much longer replacement'), True)})
+    with open (path, 'rb') as f:
+        assert f.read ().startswith (text.split ('@[2]')[0].encode ())
+    assert notes (path)[2]['content'] == 'a much longer replacement'
+
+def test_same_size_update_in_place (tmp_path):
+    path = note_file (tmp_path, "@[1]\n[color:#FFFFFF]\n[idx:1]\nabc\n\n@[2]\n[color:#FFFFFF]\n[idx:2]\ndef\n\n")
+    assert write_note_file (path, {1: (rec (1, 'xyz', prefer_idx = 1), True)}) == 'inplace'
+    got = notes (path)
+    assert got [1]['content'] == 'xyz' and got [2]['content'] == 'def'
+
+def test_unchanged (tmp_path):
+    path = note_file (tmp_path, "@[1]\n[color:#FFFFFF]\n[idx:1]\nabc\n\n")
+    assert write_note_file (path, {1: (rec (1, 'abc', prefer_idx = 1), True)}) == 'unchanged'
+
+def test_delete_last_note_removes_file (tmp_path):
+    path = note_file (tmp_path, "@[1]\n[color:#FFFFFF]\n[idx:1]\nabc\n\n")
+    assert write_note_file (path, {1: (rec (1), False)}) == 'removed'
+    assert not (tmp_path / '2024_01_01.md').exists ()
+
+@pytest.mark.parametrize ('newline', ['\n', '\r\n'])
+def test_round_trip_many_appends (tmp_path, newline):
+    path     = note_file (tmp_path, "@[1]\n[color:#FFFFFF]\n[idx:1]\nfirst", newline)
+    expected = {1: 'first'}
+    for ts in range (2, 6):
+        keep = ts % 2 == 0 # previous note is updated or deleted
+        write_note_file (path, {ts - 1: (rec (ts - 1, f"edit {ts - 1}"), keep),
+                                ts: (rec (ts, f"note {ts}\n\nsecond paragraph"), True)})
+        if keep:
+            expected [ts - 1] = f"edit {ts - 1}"
+        else:
+            del expected [ts - 1]
+        expected [ts] = f"note {ts}\n\nsecond paragraph"
+        assert {ts: r['content'] for ts, r in notes (path).items ()} == expected